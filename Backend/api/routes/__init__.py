@@ -3,7 +3,13 @@
 from fastapi import APIRouter
 from .process_complete_plan import router as get_all_templates_from_pdf
 from .segment_legend import router as get_all_symbols_from_legend
+from .jobs import router as plan_jobs
+from .artifacts import router as plan_artifacts
+from .metrics import router as pipeline_metrics
 
 router = APIRouter()
 router.include_router(get_all_templates_from_pdf, tags=["Get All TemplateMatching From Pdf"]) # , prefix="/"
 router.include_router(get_all_symbols_from_legend, tags=["Get All symbols From Legend"]) # , prefix="/"
+router.include_router(plan_jobs, tags=["Plan Processing Jobs"])
+router.include_router(plan_artifacts, tags=["Plan Artifacts"])
+router.include_router(pipeline_metrics, tags=["Metrics"])
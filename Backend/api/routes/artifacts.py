@@ -0,0 +1,61 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from core.artifacts import artifact_store
+from core.image_encoding import image_encoder
+from typing import Optional
+import asyncio
+import hashlib
+
+
+router = APIRouter()
+
+# Artifacts never change once created, clients can keep them as long as the store does
+ARTIFACT_CACHE_CONTROL = "private, max-age=3600, immutable"
+
+
+def get_artifacts_or_404(artifact_id: str):
+    artifacts = artifact_store.get(artifact_id)
+    if artifacts is None:
+        raise HTTPException(status_code=404, detail=f"Artifacts {artifact_id} not found or expired")
+    return artifacts
+
+
+async def png_response(request: Request, etag_key: str, render) -> Response:
+    """
+    PNG response with a strong ETag, the image is only rendered and encoded if the client does not have it yet.
+    """
+    etag = '"' + hashlib.sha1(etag_key.encode()).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": ARTIFACT_CACHE_CONTROL}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    # Encoding a full page takes a while, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    content = await loop.run_in_executor(None, lambda: image_encoder.encode(render(), image_format="png"))
+    return Response(content=content, media_type="image/png", headers=headers)
+
+
+@router.get("/artifacts/{artifact_id}/crops/{index}.png")
+async def get_crop(artifact_id: str, index: int, request: Request) -> Response:
+    """
+    PNG of a matched symbol, `index` is the one of its `crop_url` in the plan response.
+    """
+    artifacts = get_artifacts_or_404(artifact_id)
+    if index < 0 or index >= len(artifacts.crop_boxes):
+        raise HTTPException(status_code=404, detail=f"Crop {index} not found in {artifact_id}")
+    return await png_response(request, f"{artifact_id}/crop/{index}", lambda: artifacts.crop(index))
+
+
+@router.get("/artifacts/{artifact_id}/page.png")
+async def get_page(artifact_id: str, request: Request, annotated: bool = False, scale: Optional[float] = 1.0) -> Response:
+    """
+    PNG of the processed page.
+
+    ### Parameters:
+    - `annotated` (bool): Draw the matched symbols in the colour of their legend symbol and the unmatched ones in grey.
+    - `scale` (float): Resize the page, in (0, 1], full resolution pages are large.
+    """
+    artifacts = get_artifacts_or_404(artifact_id)
+    if not 0 < scale <= 1:
+        raise HTTPException(status_code=400, detail="scale must be in (0, 1]")
+    return await png_response(request, f"{artifact_id}/page/{annotated}/{scale}",
+                              lambda: artifacts.page(scale=scale, annotated=annotated))
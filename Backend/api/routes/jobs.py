@@ -0,0 +1,85 @@
+from fastapi import APIRouter, UploadFile, File, HTTPException
+from models import ProcessPDFTemplateMatchingResponse2, JobStatusResponse
+from core.jobs import JobQueueFull, PlanJobRequest, get_job_backend
+from core.apikey_auth import APIKeyAuth
+from api.routes.utils import parse_include
+from fastapi import Security, Depends
+from typing import Optional
+
+
+router = APIRouter()
+
+
+def get_job_or_404(job_id: str):
+    job = get_job_backend().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
+
+
+@router.post("/jobs/process_complete_plan", response_model=JobStatusResponse, status_code=202)
+async def submit_process_complete_plan(
+    # api_key: str = Depends(APIKeyAuth),
+    pdffile: UploadFile = File(..., description="The PDF file of Plans to be processed."),
+    legendImageFile: UploadFile = File(..., description="The image file of the legend which contains all the legends"),
+    page_num: Optional[int] = 1,
+    include: Optional[str] = None
+) -> JobStatusResponse:
+    """
+    Queues the processing of a PDF plan, same inputs as `/process_complete_plan`, `include=crops,timings` included.
+
+    The response carries the `job_id` to poll `/jobs/{job_id}` for the progress and to fetch
+    `/jobs/{job_id}/result` once the job has succeeded.
+
+    Raises:
+    - HTTPException 429: If the job queue is full, retry later.
+    """
+    include_fields = parse_include(include)
+    request = PlanJobRequest(pdf_bytes=await pdffile.read(),
+                             pdf_filename=pdffile.filename,
+                             legend_bytes=await legendImageFile.read(),
+                             page_num=page_num,
+                             inline_crops="crops" in include_fields,
+                             include_timings="timings" in include_fields)
+    try:
+        job = await get_job_backend().submit(request)
+    except JobQueueFull as ex:
+        raise HTTPException(status_code=429, detail=str(ex))
+    return job.snapshot()
+
+
+@router.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job_status(job_id: str) -> JobStatusResponse:
+    """
+    Status of a job and its progress: current stage, tiles detected out of the total and legend
+    symbols matched out of the total.
+    """
+    return get_job_or_404(job_id).snapshot()
+
+
+@router.get("/jobs/{job_id}/result", response_model=ProcessPDFTemplateMatchingResponse2)
+async def get_job_result(job_id: str) -> ProcessPDFTemplateMatchingResponse2:
+    """
+    Result of a succeeded job, the same response as `/process_complete_plan`.
+
+    Raises:
+    - HTTPException 404: If the job does not exist or has expired.
+    - HTTPException 409: If the job is not finished, was cancelled or failed.
+    """
+    job = get_job_or_404(job_id)
+    if job.status != "succeeded":
+        detail = f"Job {job_id} is {job.status}"
+        if job.error:
+            detail += f": {job.error}"
+        raise HTTPException(status_code=409, detail=detail)
+    return job.result
+
+
+@router.delete("/jobs/{job_id}", response_model=JobStatusResponse)
+async def cancel_job(job_id: str) -> JobStatusResponse:
+    """
+    Cancels a queued or running job. A running job stops at the next batch of its current stage.
+    """
+    get_job_or_404(job_id)
+    job = await get_job_backend().cancel(job_id)
+    return job.snapshot()
@@ -1,105 +1,26 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
-from models import ProcessPDFTemplateMatchingResponse2, LegendTemplateResponse2
-from core.pdf_to_images.processpdf import process_pdf
-from core.detection.symbol.process_symbols import detect_symbols
-from core.pdf_to_images.getimages import patch_sections_together, adjust_bounding_boxes
-from core.template_similarity.dino_vectorbase import filter_bounding_boxes
-from core.detection.legend.process_legend import detection_legend
+from fastapi.responses import StreamingResponse
+from models import ProcessPDFTemplateMatchingResponse2
+from core.pipeline import PlanProgress, process_plan
 from core.apikey_auth import APIKeyAuth
+from core.config import global_params, logger
+from api.routes.utils import parse_include
 from fastapi import Security, Depends
-from core.config import global_params, settings, logger
-from api.routes.utils import image_to_base64
-from typing import Optional, List, Tuple
-import os
-import cv2 
-import numpy as np 
-import time  
-import json 
-import logging 
+from typing import AsyncIterator, Optional
+import asyncio
+import json
 
 
-logger_active = logger.isEnabledFor(logging.DEBUG)
-
 router = APIRouter()
 
 
-async def process_symbols_detection(image: np.ndarray, 
-                                  sections_in_folder: str ,
-                                  sections_list: List[np.ndarray],
-                                  locations_sections: List[Tuple[int, int]]) -> Tuple[List[Tuple[Tuple[int, int], Tuple[int, int]]], np.ndarray]:
-    """
-    Process image sections for symbol detection and reconstruct the processed image.
-
-    Parameters:
-    - image (str): Original complete image as nparray.
-    - sections_list (str): List of numpy array of image sections.
-    - locations_sections (List[Tuple[int, int]]): Locations of the sections in the original image.
-
-    Returns:
-    - Tuple[List[Tuple[Tuple[int, int], Tuple[int, int]]], np.ndarray]: Adjusted bounding boxes and the complete processed image.
-    
-    Raises:
-    - FileNotFoundError: If the image file or sections are not found.
-    - Exception: For other processing errors.
-    """
-
-    original_complete_image = image
-    original_shape = original_complete_image.shape 
-    logger.debug(f"Full image shape {original_shape}")
-    logger.debug(f"Sucessfully processed the patches of the image, found {len(sections_list)} sections")
-    processed_sections = []
-    processed_boxes = []
-    # Step2: Process each section for template matching 
-    try:
-      processed_sections, processed_boxes = await detect_symbols(sections_list)
-    except Exception as ex: 
-        logger.info(f"Got error while performing detection of symbols: {ex}")
-
-    logger.debug(f"Detected {len(processed_boxes)} symbols in the complete plan.")
-    if(logger_active):
-        try:
-            json_data = {}
-            for i,bboxes_sections in enumerate(processed_boxes):
-                json_data.update({f"section_bbox-{i}":bboxes_sections})
-            json.dump(json_data,
-                    open(sections_in_folder+f"/processed/all-symbol-detected.json","w"),
-                    indent=4)
-        except Exception as ex:
-            logger.info(f"Could not save Processed Boxes {ex}")
-
-    # Step3: Put together everything wrt to the original image
-    # Step3.1: Put together the sections to get back the complete image 
-    process_complete_image = patch_sections_together(processed_sections, 
-                                                    original_shape, 
-                                                    locations_sections)
-    if(logger_active): 
-        cv2.imwrite(sections_in_folder+f"/processed/all-symbols-detected.png",process_complete_image)
-        cv2.imwrite(f"static/images/all_result.png",process_complete_image)
-    # Step3.2: Adjust the bounding boxes of the sections to get bounding boxes wrt. to complete image. 
-    adjusted_boxes = adjust_bounding_boxes(processed_boxes, locations_sections)
-    logger.debug("adjusting boxes")
-
-    drawn_original_complete_image = image 
-    show_with_color = (255,120,50)
-    json_data = {}
-    for i in range(len(adjusted_boxes)):
-            (x_min, y_min), (x_max, y_max) = adjusted_boxes[i]
-            drawn_original_complete_image = cv2.rectangle(drawn_original_complete_image, (x_min, y_min), (x_max, y_max), show_with_color, 3)
-            if(logger_active):
-                try:
-                  json_data.update({f"bbox-{i}":adjusted_boxes[i]})
-                  json.dump(json_data,open(sections_in_folder+f"/processed/adjusted_symbols.json","w"),indent=4)
-                except Exception as ex:
-                    logger.info(f"Could not save processed detection as json {ex}")
-
-    return adjusted_boxes,drawn_original_complete_image
-
 @router.post("/process_complete_plan", response_model=ProcessPDFTemplateMatchingResponse2)
 async def get_templates_from_pdf(
     # api_key: str = Depends(APIKeyAuth),
     pdffile: UploadFile = File(..., description="The PDF file of Plans to be processed."),
     legendImageFile: UploadFile = File(..., description="The image file of the legend which contains all the legends"),
-    page_num: Optional[int] = 1
+    page_num: Optional[int] = 1,
+    include: Optional[str] = None
 ) -> ProcessPDFTemplateMatchingResponse2:
     """
     Processes a PDF plan by extracting symbols from the specified page and matching them against symbols from a provided legend image. 
@@ -116,12 +37,15 @@ async def get_templates_from_pdf(
     - `pdffile` (UploadFile): The PDF file of plans to be processed.
     - `legendImageFile` (UploadFile): The image file of the legend containing all the symbols.
     - `page_num` (Optional[int]): Page number to process from the PDF file. Defaults to the first page.
+    - `include` (Optional[str]): Comma separated optional fields, `crops` to inline the PNG of every crop in `mask_base64`,
+      `timings` to add the seconds spent in each stage in `timings`.
 
     ### Returns:
     A `ProcessPDFTemplateMatchingResponse2` object containing the following fields:
     - `image_base64` (str): A Base64-encoded string of the plan image from the specified page. This is the raw image of the plan without any annotations.
     - `template_response` (List[dict]): A list of objects, each representing a detected symbol in the plan. Each object includes:
-      - `mask_base64` (str): Base64-encoded image of the symbol's bounding box region from the plan image.
+      - `mask_base64` (str): Base64-encoded image of the symbol's bounding box region from the plan image, empty unless `include=crops`.
+      - `crop_url` (str): Path of the PNG of the symbol's bounding box region, served by the artifact endpoints.
       - `bbox` (List[List[int]]): Coordinates of the bounding box around the detected symbol, specified as `[x, y, width, height]`.
       - `score` (float): Confidence score of the symbol detection, where 1.0 indicates 100% confidence.
       - `point_coord` (List[List[float]]): Center coordinates of the bounding box, specified as `[center_x, center_y]`.
@@ -131,6 +55,12 @@ async def get_templates_from_pdf(
       - `symbol_Type` (int): A unique identifier for the symbol type. Symbols with the same `symbol_Type` are considered to represent the same object.
     - `all_symbols_image_base64` (str): Base64-encoded image of the plan with all detected symbols highlighted with bounding boxes.
     - `processing_time` (float): Total time taken to process the plan, in minutes, providing insight into the performance of the processing operation.
+    - `sections_total` (int): Number of sections the page was split into.
+    - `sections_skipped` (int): Number of blank sections which were not sent to the symbol detector.
+    - `artifact_id` (str): Id of the images of this plan in the artifact store, they are kept for a limited time.
+    - `page_url` (str): Path of the PNG of the page.
+    - `timings` (Dict[str, float]): Seconds spent per stage, e.g. `render`, `symbol_detection`, `template_matching`, `encoding`, only with `include=timings`.
+    - `annotated_page_url` (str): Path of the PNG of the page with the matched symbols drawn, add `&scale=0.25` for a preview.
 
     Note: The processing logic may raise exceptions for invalid inputs or unforeseen processing errors. These are handled by returning appropriate HTTP error responses to the client.
 
@@ -142,7 +72,8 @@ async def get_templates_from_pdf(
       "image_base64": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAA...",
       "template_response": [
         {
-          "mask_base64": "data:image/png;base64,iVBORw0K...",
+          "mask_base64": "",
+          "crop_url": "/artifacts/4f1c2b0e9a7d4c35b8e6f0a1d2c3b4a5/crops/0.png",
           "bbox": [
             [100, 200, 50, 75]
           ],
@@ -159,126 +90,145 @@ async def get_templates_from_pdf(
         }
       ],
       "all_symbols_image_base64": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAA...",
-      "processing_time": 2.34
+      "processing_time": 2.34,
+      "sections_total": 1218,
+      "sections_skipped": 804,
+      "artifact_id": "4f1c2b0e9a7d4c35b8e6f0a1d2c3b4a5",
+      "page_url": "/artifacts/4f1c2b0e9a7d4c35b8e6f0a1d2c3b4a5/page.png",
+      "annotated_page_url": "/artifacts/4f1c2b0e9a7d4c35b8e6f0a1d2c3b4a5/page.png?annotated=true"
     }
     ```
 
 
     """
+    include_fields = parse_include(include)
+    pdf_bytes = await pdffile.read()
+    legend_bytes = await legendImageFile.read()
+    return await process_plan(pdf_bytes=pdf_bytes,
+                              pdf_filename=pdffile.filename,
+                              legend_bytes=legend_bytes,
+                              page_num=page_num,
+                              inline_crops="crops" in include_fields,
+                              include_timings="timings" in include_fields)
 
 
-    template_response = []
-
-
-
-    save_symbols_path = global_params.temp_dir
-    start_time = time.time()
-    # Step1: Get the sections of the page of the pdf which can be found in sections_in_folder
-    try:
-      process_pdf_response= await process_pdf(file=pdffile, 
-                                              page_num=page_num)
-    except Exception as ex:
-        raise HTTPException(status_code=500, detail=f"Could not convert pdf to sections: {ex}")
-    selected_page_image, image_path, sections_in_folder,sections_nparray_list,locations_sections= process_pdf_response
-    logger.debug(f"Obtained {len(locations_sections)} sections from the pdf image")
-    
-    all_symbols_drawn_image = selected_page_image.copy()
-    if(logger_active):
-        save_symbols_path = sections_in_folder+"/symbols"
-        os.makedirs(sections_in_folder+"/processed", exist_ok=True)
-
-    logger.debug(f"Detecting symbols in legend image")
-    symbols_nparray_list = await detection_legend(file=legendImageFile,
-                                                save_symbols_path=save_symbols_path)
-
-    logger.debug(f"Detected {len(symbols_nparray_list)} symbols in the legend image")         
-    all_adjusted_boxes,drawn_original_complete_image = await process_symbols_detection(selected_page_image, 
-                                                                                      sections_in_folder,
-                                                                                      sections_nparray_list,
-                                                                                      locations_sections)
-
-    
-
-
+STREAM_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "sse": "text/event-stream"}
 
-    json_data = {}
 
-    for idx,template_np_image in enumerate(symbols_nparray_list):
-        # Step2: Process each template image to get the final bounding boxes wrt to the full complete image along with the bounding boxes drawn complete image
-        logger.debug(f"Processing template matching for symbol {idx+1} out of {len(symbols_nparray_list)}") 
-        
-        refined_bounding_boxes = await filter_bounding_boxes(boxes=all_adjusted_boxes,
-                                                             full_image=drawn_original_complete_image,
-                                                             target_template=template_np_image)
+def format_event(event: str, data: dict, stream_format: str) -> str:
+    """
+    One event as an NDJSON line or as a server-sent event.
+    """
+    if stream_format == "sse":
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, **data}) + "\n"
 
-        if(logger_active):
-            try:
-                json_data.update({f"template-{idx}":refined_bounding_boxes})
-                json.dump(json_data,open(sections_in_folder+f"/processed/all-symbol-refined-detected.json","w"),
-                            indent=4)
-            except:
-                logger.debug("Could not save Processed Boxes {idx}")
 
+async def plan_events(pdf_bytes: bytes, pdf_filename: str, legend_bytes: bytes,
+                      page_num: int, stream_format: str, inline_crops: bool = False,
+                      include_timings: bool = False) -> AsyncIterator[str]:
+    """
+    Runs the pipeline and yields its events as they happen:
+    - `progress`: the stage and counters of the plan, every `global_params.stream_progress_interval` seconds.
+    - `template`: the responses of one legend symbol, as soon as they are built.
+    - `done`: the processing time, section counts and timings, or `error` if the processing failed.
+
+    Every stage of the pipeline, the render and the legend detection included, runs off the
+    event loop, so the progress events keep coming while a large page is processed.
+    If the client goes away the generator is closed and the processing is cancelled.
+    """
+    progress = PlanProgress()
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def on_template(idx, responses):
+        snapshot = progress.snapshot()
+        await events.put(("template", {"symbol_type": idx,
+                                       "templates_matched": snapshot["templates_matched"],
+                                       "templates_total": snapshot["templates_total"],
+                                       "template_response": [response.model_dump() for response in responses]}))
+
+    task = asyncio.create_task(process_plan(pdf_bytes=pdf_bytes,
+                                            pdf_filename=pdf_filename,
+                                            legend_bytes=legend_bytes,
+                                            page_num=page_num,
+                                            progress=progress,
+                                            on_template=on_template,
+                                            inline_crops=inline_crops,
+                                            include_timings=include_timings))
+    try:
+        yield format_event("progress", progress.snapshot(), stream_format)
+        while True:
+            get_event = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({get_event, task},
+                                         timeout=global_params.stream_progress_interval,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if get_event in done:
+                event, data = get_event.result()
+                yield format_event(event, data, stream_format)
+                continue
+            get_event.cancel()
+            if task.done():
+                break
+            yield format_event("progress", progress.snapshot(), stream_format)
+
+        while not events.empty():
+            event, data = events.get_nowait()
+            yield format_event(event, data, stream_format)
+        yield format_event("progress", progress.snapshot(), stream_format)
         try:
-            show_with_color = global_params.color_lists[idx]
-        except:
-            show_with_color = (255,120,50)
-
-        for _, bbox in enumerate(refined_bounding_boxes):
-            (x, y), (x_end, y_end) = bbox
-            area = (x_end - x) * (y_end - y)
-            all_symbols_drawn_image = cv2.rectangle(all_symbols_drawn_image, (int(x), int(y)), (int(x_end), int(y_end)), show_with_color, 3)
-            # Proceed only if the area is greater than 0
-            if area > 10:
-                roi = selected_page_image[int(y): int(y_end), int(x): int(x_end)]
-                mask_base64 = image_to_base64(roi)
-                response_this_template = LegendTemplateResponse2(mask_base64=mask_base64,
-                                                                bbox=[(x, y, x_end-x, y_end-y)],
-                                                                 score=1.0,
-                                                                 point_coord=[(0.0,0.0)],
-                                                                 uncertain_iou=1.0,
-                                                                 area=area,
-                                                                 color=[(255,255,255)], 
-                                                                 symbol_type=idx)
-                template_response.append(response_this_template)
-
-        all_adjusted_boxes = [box for box in all_adjusted_boxes if box not in refined_bounding_boxes]
-
-
-        if(logger_active): 
-            cv2.imwrite(sections_in_folder+f"/processed/all-symbols-refined-detected.png",all_symbols_drawn_image)
-            cv2.imwrite(f"static/images/result.png",all_symbols_drawn_image)
-    
-        logger.debug(f"Found {len(refined_bounding_boxes)} templates out of {len(all_adjusted_boxes)}")
-        logger.debug(f"Template matching completed for {idx+1} out of {len(symbols_nparray_list)}")
-
-    show_with_color = (125,125,125)
-    for _, bbox in enumerate(all_adjusted_boxes):
-                (x, y), (x_end, y_end) = bbox
-                area = (x_end - x) * (y_end - y)
-                if(area > 40 and (x_end - x) > 16 and (y_end - y) > 16):
-                  all_symbols_drawn_image = cv2.rectangle(all_symbols_drawn_image, (int(x), int(y)), (int(x_end), int(y_end)), show_with_color, 5)
-
-    total_time_taken = (time.time() - start_time)/60.0
-    all_symbols_drawn_image_base64 = image_to_base64(all_symbols_drawn_image)
-
-    if(logger_active): 
-        cv2.imwrite(sections_in_folder+f"/processed/all-symbols-refined-detected.png",all_symbols_drawn_image)
-        cv2.imwrite(f"static/images/result.png",all_symbols_drawn_image)
+            result = task.result()
+            yield format_event("done", {"processing_time": result.processing_time,
+                                        "sections_total": result.sections_total,
+                                        "sections_skipped": result.sections_skipped,
+                                        "artifact_id": result.artifact_id,
+                                        "page_url": result.page_url,
+                                        "annotated_page_url": result.annotated_page_url,
+                                        "timings": result.timings}, stream_format)
+        except Exception as ex:
+            logger.exception(f"Streamed processing of {pdf_filename} failed: {ex}")
+            yield format_event("error", {"detail": getattr(ex, "detail", None) or str(ex)}, stream_format)
+    finally:
+        if not task.done():
+            logger.info(f"Client left the stream of {pdf_filename}, cancelling its processing")
+            progress.cancel()
+            task.cancel()
 
-    if(len(template_response)==0):
-        response_this_template = LegendTemplateResponse2(mask_base64="",
-                                                        bbox=[(0,0,0,0)],
-                                                        score=1.0,
-                                                        point_coord=[(0.0,0.0)],
-                                                        uncertain_iou=1.0,
-                                                        area=0,
-                                                        color=[(255,255,255)], 
-                                                        symbol_Type=0)
-        template_response.append(response_this_template)
 
+@router.post("/process_complete_plan/stream")
+async def stream_templates_from_pdf(
+    # api_key: str = Depends(APIKeyAuth),
+    pdffile: UploadFile = File(..., description="The PDF file of Plans to be processed."),
+    legendImageFile: UploadFile = File(..., description="The image file of the legend which contains all the legends"),
+    page_num: Optional[int] = 1,
+    stream_format: str = "ndjson",
+    include: Optional[str] = None
+) -> StreamingResponse:
+    """
+    Streaming variant of `/process_complete_plan`, the results are sent as soon as each legend symbol is matched.
 
+    ### Parameters:
+    - Same as `/process_complete_plan`.
+    - `stream_format` (str): `ndjson` for one JSON object per line, each with an `event` key, or `sse` for server-sent events.
 
-    return ProcessPDFTemplateMatchingResponse2(template_response=template_response,
-                                               processing_time=total_time_taken)
+    ### Events:
+    - `progress`: `stage`, `tiles_detected`, `tiles_total`, `legend_symbols`, `templates_matched`, `templates_total`, sent periodically.
+    - `template`: `symbol_type` and the `template_response` items (`LegendTemplateResponse2`) of one legend symbol.
+    - `done`: `processing_time`, `sections_total`, `sections_skipped`, `artifact_id`, the page urls and the `timings` with `include=timings`, the last event of a successful run.
+    - `error`: `detail` of the error which stopped the processing.
 
+    Closing the connection cancels the processing.
+    """
+    if stream_format not in STREAM_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"stream_format must be one of {list(STREAM_MEDIA_TYPES)}")
+    include_fields = parse_include(include)
+    pdf_bytes = await pdffile.read()
+    legend_bytes = await legendImageFile.read()
+    return StreamingResponse(plan_events(pdf_bytes=pdf_bytes,
+                                         pdf_filename=pdffile.filename,
+                                         legend_bytes=legend_bytes,
+                                         page_num=page_num,
+                                         stream_format=stream_format,
+                                         inline_crops="crops" in include_fields,
+                                         include_timings="timings" in include_fields),
+                             media_type=STREAM_MEDIA_TYPES[stream_format],
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
 from models import LegendTemplate
 from core.detection.legend.process_legend import detection_legend
-from api.routes.utils import image_to_base64
+from core.image_encoding import image_encoder
+from core.config import global_params
 from fastapi import Security, HTTPException, Depends
 from core.apikey_auth import APIKeyAuth
 from typing import Optional, List, Tuple
@@ -37,7 +38,7 @@ async def get_images_from_legend(
     """
 
     symbols_generated = await detection_legend(file=file,
-                                                    save_symbols_path="temp")
-    all_symbols_base64 = [image_to_base64(symbol) for symbol in symbols_generated]
+                                                    save_symbols_path=f"{global_params.temp_dir}/legend_symbols")
+    all_symbols_base64 = image_encoder.encode_many_base64(symbols_generated)
 
     return {"symbols_base64": all_symbols_base64}
@@ -6,16 +6,20 @@ from PIL import Image
 from pathlib import Path
 import json 
 import cv2 
+from fastapi import HTTPException
+from core.image_encoding import image_encoder
+from core.metrics import metrics
 
+@metrics.timed("image_to_base64")
 def image_to_base64(image_array: np.ndarray) -> str:
     """
     Convert a numpy array to a base64 encoded string.
 
     This function takes an image in numpy array format (Height x Width x 3 channels)
     and converts it to a base64 encoded string. The numpy array should represent
-    an image in BGR format (which is typical of OpenCV images). The image is first
-    converted to RGB, then encoded to PNG format, and finally encoded to a base64
-    string.
+    an image in BGR format (which is typical of OpenCV images). The image is
+    encoded to PNG format with `image_encoder`, then encoded to a base64 string.
+    Use `image_encoder.encode_many_base64` to encode many images in parallel.
 
     Parameters:
     image_array (np.ndarray): The image in numpy array format. This should be a 3-channel
@@ -30,15 +34,26 @@ def image_to_base64(image_array: np.ndarray) -> str:
     >>> print(base64_image)  # This will print the base64 encoded string of the image.
     """
 
-    # Convert the NumPy array to an RGB image using PIL
-    image = Image.fromarray(cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB))
+    return image_encoder.encode_base64(image_array, image_format="png")
 
-    # Save the image to a buffer in PNG format
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
 
-    # Encode the buffer's contents into a base64 string
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+def image_to_png(image_array: np.ndarray) -> bytes:
+    """
+    Encode a BGR numpy array to PNG bytes, the same encoding as `image_to_base64`.
+    """
+    return image_encoder.encode(image_array, image_format="png")
+
 
-    return img_str
+def parse_include(include: str, allowed=("crops", "timings")) -> set:
+    """
+    Parse the comma separated `include` projection parameter of the routes.
+
+    Raises:
+    - HTTPException: If an unknown field is asked for.
+    """
+    fields = {field.strip() for field in (include or "").split(",") if field.strip()}
+    unknown = fields - set(allowed)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown include fields {sorted(unknown)}, expected some of {list(allowed)}")
+    return fields
       
@@ -0,0 +1,97 @@
+"""
+Check that the batched DINOv2 embeddings match the per-crop torchvision ones.
+
+The similarity thresholds were tuned on embeddings of crops resized with
+`transforms.Resize(224)`, one forward pass per crop. This embeds a sample of the candidate
+crops of an example plan both ways and compares the embeddings and the L2 distances between
+them (normalized, as searched by the matching). The run fails (exit code 1) above the tolerances.
+
+Run from the Backend folder:
+    python -m benchmarks.dino_preprocessing --example Example1 --sample 200
+"""
+import argparse
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from torchvision import transforms
+from PIL import Image
+
+from benchmarks.suite import EXAMPLES_DIR, find_example, render_pdf_page
+from core.config import global_params, logger
+from core.detection.symbol.process_symbols import detect_symbols_sync
+from core.pdf_to_images.getimages import adjust_bounding_boxes, split_image_into_sections
+from core.template_similarity.dino_model import dino_backbone, size_buckets
+from core.template_similarity.dino_vectorbase import crop_candidates
+
+
+def reference_embeddings(crops, img_size: int = 224) -> np.ndarray:
+    """
+    Embeddings of the crops one at a time, with the torchvision transform they were tuned with.
+    """
+    transform = transforms.Compose([transforms.Resize(img_size),
+                                    transforms.ToTensor(),
+                                    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
+    vectors = []
+    with torch.inference_mode():
+        for crop in crops:
+            pixel_values = transform(Image.fromarray(np.ascontiguousarray(crop)))[:3].unsqueeze(0)
+            outputs = dino_backbone.model(pixel_values=pixel_values.to(dino_backbone.device))
+            vectors.append(outputs.last_hidden_state.mean(dim=1).float().cpu().numpy()[0])
+    return np.stack(vectors)
+
+
+def l2_distances(vectors: np.ndarray) -> np.ndarray:
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.linalg.norm(vectors[:, None] - vectors[None], axis=-1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--example", default="Example1")
+    parser.add_argument("--sample", type=int, default=200, help="Candidate crops compared")
+    parser.add_argument("--dpi", type=int, default=global_params.dpi)
+    parser.add_argument("--max-distance-change", type=float, default=1e-3,
+                        help="Max change of the L2 distance between two normalized embeddings")
+    parser.add_argument("--min-cosine", type=float, default=0.9999,
+                        help="Min cosine similarity of the two embeddings of a crop")
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+    global_params.embedding_cache_enabled = False
+
+    pdf_path, _ = find_example(os.path.join(EXAMPLES_DIR, args.example))
+    with open(pdf_path, "rb") as f:
+        page = render_pdf_page(f.read(), dpi=args.dpi)
+    _, sections, locations = split_image_into_sections(page, os.path.basename(pdf_path))
+    boxes, _ = detect_symbols_sync(sections, page=page, locations=locations)
+    crops, _ = crop_candidates(adjust_bounding_boxes(boxes, locations), page)
+    buckets = size_buckets(crops, dino_backbone.img_size)
+    batches = sum(-(-len(indices) // global_params.dino_batch_size) for indices in buckets.values())
+    print(f"{len(crops)} candidate crops of {args.example} in {len(buckets)} size buckets, "
+          f"{batches} forward passes of up to {global_params.dino_batch_size} crops")
+    rng = np.random.default_rng(0)
+    sample = sorted(rng.choice(len(crops), size=min(args.sample, len(crops)), replace=False).tolist())
+    crops = [crops[i] for i in sample]
+    if not crops:
+        raise SystemExit(f"No candidate crops found in {pdf_path}")
+
+    reference = reference_embeddings(crops)
+    forward_passes = dino_backbone.forward_passes
+    batched = dino_backbone.embed(crops, batch_size=global_params.dino_batch_size)
+    forward_passes = dino_backbone.forward_passes - forward_passes
+    cosine = np.sum(reference * batched, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(batched, axis=1))
+    distance_change = np.abs(l2_distances(reference) - l2_distances(batched))
+    print(f"{len(crops)} crops of {args.example}: min cosine {cosine.min():.6f}, "
+          f"max distance change {distance_change.max():.2e}, "
+          f"max embedding difference {np.abs(reference - batched).max():.2e}, "
+          f"{len(size_buckets(crops, dino_backbone.img_size))} size buckets, {forward_passes} forward passes")
+    if cosine.min() < args.min_cosine or distance_change.max() > args.max_distance_change:
+        print("The batched embeddings differ from the reference ones")
+        sys.exit(1)
+    print("The batched embeddings match the reference ones")
+
+
+if __name__ == "__main__":
+    main()
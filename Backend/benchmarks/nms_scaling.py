@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the page level NMS against the number of boxes.
+
+Run from the Backend folder:
+    python -m benchmarks.nms_scaling --counts 1000 5000 20000
+"""
+import argparse
+import time
+from typing import Tuple
+
+import numpy as np
+
+from core.detection.inference import nms
+from core.detection.page_nms import grid_nms
+
+
+def synthetic_page_boxes(count: int, page_size: Tuple[int, int] = (7200, 10800),
+                         duplicate_ratio: float = 0.3, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Random symbol sized boxes over a page, a share of them duplicated with a small jitter.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = page_size
+    unique_count = max(1, int(count * (1 - duplicate_ratio)))
+    xy = rng.uniform(0, [width - 64, height - 64], (unique_count, 2))
+    wh = rng.uniform(16, 64, (unique_count, 2))
+    boxes = np.concatenate([xy, xy + wh], axis=1)
+    duplicates = boxes[rng.integers(0, unique_count, count - unique_count)]
+    duplicates = duplicates + rng.uniform(-3, 3, duplicates.shape)
+    boxes = np.concatenate([boxes, duplicates]).astype(np.int32)
+    scores = rng.uniform(0.1, 1.0, len(boxes)).astype(np.float32)
+    return boxes, scores
+
+
+def time_call(function, *args, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[500, 1000, 2000, 5000, 10000, 20000])
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--skip-reference", action="store_true",
+                        help="Only time grid_nms, the reference nms gets slow on large counts")
+    args = parser.parse_args()
+
+    print(f"{'boxes':>8} {'grid_nms (ms)':>14} {'us/box':>8} {'nms (ms)':>10} {'kept':>8}")
+    for count in args.counts:
+        boxes, scores = synthetic_page_boxes(count)
+        grid_time = time_call(grid_nms, boxes, scores, args.iou, repeat=args.repeat)
+        kept = len(grid_nms(boxes, scores, args.iou))
+        reference = ""
+        if not args.skip_reference:
+            reference = f"{1000 * time_call(nms, boxes, scores, args.iou, repeat=args.repeat):10.1f}"
+        print(f"{count:>8} {1000 * grid_time:14.1f} {1e6 * grid_time / count:8.1f} {reference:>10} {kept:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Local stand-in for the OpenAI chat completions API, for tests and benchmarks of the vision verifier.
+
+Answers are deterministic: a pair image gets Yes or No from its hash, a montage of K candidates
+gets {"matches": [...]} with its odd numbered candidates.
+Latency and a share of failed requests (429/500) can be injected to exercise the retries.
+
+Run from the Backend folder:
+    STUB_LATENCY=0.5 STUB_FAILURE_RATE=0.1 uvicorn benchmarks.openai_stub:app --port 8090
+and point the backend to it:
+    OPENAI_BASE_URL=http://127.0.0.1:8090/v1
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+STUB_LATENCY = float(os.environ.get("STUB_LATENCY", "0.2")) # Seconds per request
+STUB_FAILURE_RATE = float(os.environ.get("STUB_FAILURE_RATE", "0.0")) # Share of requests answered with 429 or 500
+
+app = FastAPI(title="OpenAI vision stub")
+app.state.requests = 0
+
+
+def image_digest(payload: dict) -> str:
+    """
+    Hash of the images of a chat completions request.
+    """
+    digest = hashlib.sha1()
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                digest.update(part["image_url"]["url"].encode())
+    return digest.hexdigest()
+
+
+def prompt_text(payload: dict) -> str:
+    texts = []
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                texts.append(part["text"])
+    return "\n".join(texts)
+
+
+def answer_for(payload: dict) -> str:
+    montage = re.search(r"candidates numbered 1 to (\d+)", prompt_text(payload))
+    if montage:
+        return json.dumps({"matches": list(range(1, int(montage.group(1)) + 1, 2))})
+    same = int(image_digest(payload), 16) % 2 == 0
+    return "Yes, the two symbols are the same." if same else "No, the two symbols are different."
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    payload = await request.json()
+    app.state.requests += 1
+    await asyncio.sleep(STUB_LATENCY)
+    if random.random() < STUB_FAILURE_RATE:
+        status_code = random.choice([429, 500])
+        return JSONResponse(status_code=status_code, content={"error": {"message": "Injected failure"}})
+    return {
+        "id": f"stub-{app.state.requests}",
+        "object": "chat.completion",
+        "model": payload.get("model"),
+        "choices": [{"index": 0,
+                     "message": {"role": "assistant", "content": answer_for(payload)},
+                     "finish_reason": "stop"}],
+    }
+
+
+@app.get("/stats")
+async def stats():
+    return {"requests": app.state.requests}
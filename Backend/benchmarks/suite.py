@@ -0,0 +1,296 @@
+"""
+Benchmark suite of the processing pipeline, compared against a saved baseline.
+
+- `micro`: the hot functions on fixed inputs (infer_onnx, nms, split_image_into_sections,
+  adjust_bounding_boxes, VectorStore build and search, image_to_base64).
+- `e2e`: the whole pipeline on the plans of `Examples/`, with the time of each stage.
+- `synthetic`: the whole pipeline on generated plans of growing symbol density and sheet size.
+
+Every benchmark keeps the best of `--repeat` runs, with the page and embedding caches off so
+that each run does the full work. The run fails (exit code 1) when a benchmark is slower than
+the baseline by more than its tolerance, see `benchmarks/tolerances.json`.
+
+Run from the Backend folder:
+    python -m benchmarks.suite --save-baseline      # on the reference machine
+    python -m benchmarks.suite                      # compare against benchmarks/baseline.json
+    python -m benchmarks.suite --only micro e2e --examples Example1 --tolerance 0.1
+"""
+import argparse
+import asyncio
+import fnmatch
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import fitz
+import numpy as np
+
+from benchmarks.nms_scaling import synthetic_page_boxes
+from benchmarks.synthetic_plan import SHEET_SIZES, make_plan
+from core.config import global_params, logger
+from core.pipeline import process_plan
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES_DIR = os.path.join(BENCHMARKS_DIR, "..", "..", "Examples")
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, "baseline.json")
+DEFAULT_TOLERANCES = os.path.join(BENCHMARKS_DIR, "tolerances.json")
+
+LEGEND_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# (sheet, symbols per square foot) of the synthetic plans
+SYNTHETIC_PLANS = (("B", 20), ("B", 80), ("D", 20), ("D", 80))
+
+
+def measure(function: Callable, repeat: int, warmup: int = 1) -> dict:
+    """
+    Best and median duration of `repeat` calls, after `warmup` calls which are not counted.
+    """
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+    return {"seconds": min(durations), "median": statistics.median(durations), "runs": repeat}
+
+
+def render_pdf_page(pdf_bytes: bytes, dpi: int) -> np.ndarray:
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        pixmap = doc.load_page(0).get_pixmap(dpi=dpi)
+    return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)[:, :, :3].copy()
+
+
+def micro_benchmarks(repeat: int) -> Dict[str, dict]:
+    # Imported here so that the e2e benchmarks alone do not load what they do not need
+    from api.routes.utils import image_to_base64
+    from core.detection.inference import infer_onnx, nms
+    from core.boxes import BoxSet
+    from core.pdf_to_images.getimages import adjust_bounding_boxes, split_image_into_sections
+    from core.template_similarity.dino_vectorbase import VectorStore
+
+    dpi = 300
+    plan = make_plan(sheet_size=SHEET_SIZES["B"], density=150, seed=0)
+    page = render_pdf_page(plan.pdf_bytes, dpi=dpi)
+    crops = [page[int(y0 * dpi):int(y1 * dpi), int(x0 * dpi):int(x1 * dpi)] for _, (x0, y0, x1, y1) in plan.symbols]
+    section_height, section_width = global_params.section_size
+    tile = page[:section_height, :section_width]
+    boxes, scores = synthetic_page_boxes(2000)
+    _, sections, locations = split_image_into_sections(image=page, image_name="benchmark")
+    rng = np.random.default_rng(0)
+    section_boxes = BoxSet.from_section_boxes([[((int(x), int(y)), (int(x) + 40, int(y) + 40)) for x, y in rng.integers(0, 470, (10, 2))]
+                                               for _ in sections])
+    templates = crops[:4]
+
+    results = {}
+    results["micro/infer_onnx"] = measure(lambda: infer_onnx(global_params.symbol_yolo_model_path, tile), repeat)
+    results["micro/nms_2000"] = measure(lambda: nms(boxes, scores, 0.5), repeat)
+    results["micro/split_image_into_sections"] = measure(lambda: split_image_into_sections(image=page, image_name="benchmark"), repeat)
+    results["micro/adjust_bounding_boxes"] = measure(lambda: adjust_bounding_boxes(section_boxes, locations), repeat)
+    results["micro/vectorstore_build"] = measure(lambda: VectorStore(crops), repeat)
+    store = VectorStore(crops)
+    results["micro/vectorstore_search"] = measure(lambda: store.find_index_batch(templates), repeat)
+    results["micro/image_to_base64_crops"] = measure(lambda: [image_to_base64(crop) for crop in crops], repeat)
+    results["micro/image_to_base64_page"] = measure(lambda: image_to_base64(page), repeat)
+    return results
+
+
+def run_plan(pdf_bytes: bytes, pdf_filename: str, legend_bytes: bytes, page_num: int = 1):
+    return asyncio.run(process_plan(pdf_bytes=pdf_bytes,
+                                    pdf_filename=pdf_filename,
+                                    legend_bytes=legend_bytes,
+                                    page_num=page_num,
+                                    include_timings=True))
+
+
+def plan_benchmark(prefix: str, pdf_bytes: bytes, pdf_filename: str, legend_bytes: bytes,
+                   page_num: int, repeat: int, info: Dict[str, dict]) -> Dict[str, dict]:
+    """
+    Run a plan `repeat` times, the best time of each stage is kept, `plan` being the whole run.
+    """
+    stage_durations: Dict[str, List[float]] = {}
+    for _ in range(repeat):
+        response = run_plan(pdf_bytes, pdf_filename, legend_bytes, page_num)
+        for stage, seconds in response.timings.items():
+            stage_durations.setdefault(stage, []).append(seconds)
+    info[prefix] = {"matches": len(response.template_response),
+                    "sections_total": response.sections_total,
+                    "sections_skipped": response.sections_skipped}
+    logger.warning(f"{prefix}: {min(stage_durations['plan']):.2f}s, {info[prefix]}")
+    return {f"{prefix}/{stage}": {"seconds": min(durations), "median": statistics.median(durations), "runs": repeat}
+            for stage, durations in stage_durations.items()}
+
+
+def find_example(example_dir: str) -> Tuple[str, str]:
+    """
+    The PDF and the legend image of an example folder.
+    """
+    names = sorted(os.listdir(example_dir))
+    pdfs = [name for name in names if name.lower().endswith(".pdf")]
+    legends = [name for name in names if name.lower().endswith(LEGEND_EXTENSIONS)]
+    if len(pdfs) != 1 or len(legends) != 1:
+        raise ValueError(f"{example_dir} should have one PDF and one legend image, found {names}")
+    return os.path.join(example_dir, pdfs[0]), os.path.join(example_dir, legends[0])
+
+
+def e2e_benchmarks(examples: Optional[List[str]], page_num: int, repeat: int, info: Dict[str, dict]) -> Dict[str, dict]:
+    results = {}
+    for example in examples or sorted(os.listdir(EXAMPLES_DIR)):
+        pdf_path, legend_path = find_example(os.path.join(EXAMPLES_DIR, example))
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+        with open(legend_path, "rb") as f:
+            legend_bytes = f.read()
+        results.update(plan_benchmark(f"e2e/{example}", pdf_bytes, os.path.basename(pdf_path), legend_bytes,
+                                      page_num, repeat, info))
+    return results
+
+
+def synthetic_benchmarks(repeat: int, info: Dict[str, dict]) -> Dict[str, dict]:
+    results = {}
+    for sheet, density in SYNTHETIC_PLANS:
+        plan = make_plan(sheet_size=SHEET_SIZES[sheet], density=density, seed=0)
+        results.update(plan_benchmark(f"synthetic/{plan.name}", plan.pdf_bytes, f"{plan.name}.pdf", plan.legend_bytes,
+                                      1, repeat, info))
+    return results
+
+
+def load_json(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def tolerance_for(name: str, tolerances: dict) -> float:
+    """
+    Relative slowdown allowed for a benchmark, the first matching pattern of `overrides` wins.
+    """
+    for pattern, tolerance in tolerances.get("overrides", {}).items():
+        if fnmatch.fnmatch(name, pattern):
+            return tolerance
+    return tolerances.get("default", 0.2)
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerances: dict) -> List[Tuple[str, str]]:
+    """
+    Print the benchmarks next to the baseline and return the (name, reason) of the regressions.
+
+    A benchmark regresses when it is slower than the baseline by more than its tolerance and by
+    more than `min_delta_seconds`, so that noise on the very fast ones does not fail the run.
+    """
+    min_delta = tolerances.get("min_delta_seconds", 0.0)
+    regressions = []
+    print(f"{'benchmark':<60} {'baseline':>10} {'current':>10} {'change':>8}  status")
+    for name in sorted(set(results) | set(baseline)):
+        if name not in results:
+            print(f"{name:<60} {baseline[name]['seconds']:>10.4f} {'':>10} {'':>8}  missing")
+            continue
+        current = results[name]["seconds"]
+        if name not in baseline:
+            print(f"{name:<60} {'':>10} {current:>10.4f} {'':>8}  new")
+            continue
+        reference = baseline[name]["seconds"]
+        change = current / reference - 1 if reference > 0 else 0.0
+        tolerance = tolerance_for(name, tolerances)
+        status = "ok"
+        if change > tolerance and current - reference > min_delta:
+            status = f"REGRESSION (> {tolerance:+.0%})"
+            regressions.append((name, f"{reference:.4f}s -> {current:.4f}s ({change:+.1%}, tolerance {tolerance:+.0%})"))
+        elif change < -abs(tolerance):
+            status = "faster"
+        print(f"{name:<60} {reference:>10.4f} {current:>10.4f} {change:>+8.1%}  {status}")
+    return regressions
+
+
+def environment() -> dict:
+    import onnxruntime
+    return {"python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "onnxruntime": onnxruntime.__version__,
+            "onnx_profile": global_params.onnx_profile,
+            "dpi": global_params.dpi,
+            "section_size": list(global_params.section_size)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=["micro", "e2e", "synthetic"], default=["micro", "e2e", "synthetic"])
+    parser.add_argument("--examples", nargs="+", help="Example folders to run, all of them by default")
+    parser.add_argument("--page-num", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each micro benchmark")
+    parser.add_argument("--plan-repeat", type=int, default=1, help="Runs of each e2e and synthetic plan")
+    parser.add_argument("--dpi", type=int, help="Render the plans at this dpi instead of global_params.dpi")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerances", default=DEFAULT_TOLERANCES)
+    parser.add_argument("--tolerance", type=float, help="Override the default tolerance, e.g. 0.1 for 10%%")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--output", default=os.path.join(global_params.temp_dir, "benchmarks", "results.json"))
+    parser.add_argument("--verbose", action="store_true", help="Keep the INFO logs of the pipeline")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    if args.dpi:
+        global_params.dpi = args.dpi
+    # Every run has to do the full work
+    global_params.page_cache_enabled = False
+    global_params.embedding_cache_enabled = False
+
+    results: Dict[str, dict] = {}
+    info: Dict[str, dict] = {}
+    start_time = time.perf_counter()
+    if "micro" in args.only:
+        results.update(micro_benchmarks(args.repeat))
+    if "e2e" in args.only:
+        results.update(e2e_benchmarks(args.examples, args.page_num, args.plan_repeat, info))
+    if "synthetic" in args.only:
+        results.update(synthetic_benchmarks(args.plan_repeat, info))
+    report = {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "environment": environment(),
+              "results": results,
+              "info": info}
+
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Ran {len(results)} benchmarks in {time.perf_counter() - start_time:.1f}s, results in {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the baseline to {args.baseline}")
+        return
+
+    baseline = load_json(args.baseline)
+    if baseline is None:
+        print(f"No baseline at {args.baseline}, run with --save-baseline on the reference machine first")
+        return
+    if baseline.get("environment") != report["environment"]:
+        print(f"Warning: the baseline was made on another environment: {baseline.get('environment')}")
+    tolerances = load_json(args.tolerances) or {}
+    if args.tolerance is not None:
+        tolerances["default"] = args.tolerance
+    # Only compare what was run this time, e.g. with --only micro
+    compared_baseline = {name: value for name, value in baseline["results"].items()
+                         if name.split("/")[0] in args.only
+                         and (not args.examples or not name.startswith("e2e/") or name.split("/")[1] in args.examples)}
+    regressions = compare(results, compared_baseline, tolerances)
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed:")
+        for name, reason in regressions:
+            print(f"  {name}: {reason}")
+        sys.exit(1)
+    print("No regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
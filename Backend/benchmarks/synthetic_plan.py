@@ -0,0 +1,173 @@
+"""
+Synthetic plans to benchmark the pipeline against the symbol density and the sheet size.
+
+The plan is a vector PDF like the CAD exports the service gets: walls on a grid of rooms and
+symbols of a few kinds scattered over the sheet. The legend is rendered from the same shapes.
+
+Run from the Backend folder to write one to disk:
+    python -m benchmarks.synthetic_plan --sheet D --density 40 --out temp/synthetic
+"""
+import argparse
+import os
+from typing import List, Tuple
+
+import fitz
+import numpy as np
+
+
+POINTS_PER_INCH = 72
+
+# ANSI sheet sizes, (width, height) in inches
+SHEET_SIZES = {"A": (11, 8.5), "B": (17, 11), "C": (22, 17), "D": (34, 22), "E": (44, 34)}
+
+SYMBOL_KINDS = ("circle", "square_cross", "triangle", "diamond", "double_circle", "hexagon", "circle_cross", "star")
+
+
+def draw_symbol(page: fitz.Page, kind: str, center: Tuple[float, float], size: float, width: float = 1.0) -> None:
+    """
+    Draw one symbol of `kind`, `size` points wide, centered on `center`.
+    """
+    x, y = center
+    r = size / 2
+    if kind in ("circle", "double_circle", "circle_cross"):
+        page.draw_circle((x, y), r, color=(0, 0, 0), width=width)
+        if kind == "double_circle":
+            page.draw_circle((x, y), r / 2, color=(0, 0, 0), width=width)
+        if kind == "circle_cross":
+            page.draw_line((x - r, y), (x + r, y), color=(0, 0, 0), width=width)
+            page.draw_line((x, y - r), (x, y + r), color=(0, 0, 0), width=width)
+        return
+    if kind == "square_cross":
+        page.draw_rect(fitz.Rect(x - r, y - r, x + r, y + r), color=(0, 0, 0), width=width)
+        page.draw_line((x - r, y - r), (x + r, y + r), color=(0, 0, 0), width=width)
+        page.draw_line((x - r, y + r), (x + r, y - r), color=(0, 0, 0), width=width)
+        return
+    if kind == "star":
+        angles = np.pi / 2 + np.arange(10) * np.pi / 5
+        radii = np.where(np.arange(10) % 2 == 0, r, r / 2.5)
+    else:
+        corners = {"triangle": 3, "diamond": 4, "hexagon": 6}[kind]
+        angles = np.pi / 2 + np.arange(corners) * 2 * np.pi / corners
+        radii = np.full(corners, r)
+    points = [(x + radius * np.cos(angle), y - radius * np.sin(angle)) for radius, angle in zip(radii, angles)]
+    page.draw_polyline(points + points[:1], color=(0, 0, 0), width=width, closePath=True)
+
+
+class SyntheticPlan():
+    """
+    A generated plan and its legend, with the symbols drawn on the plan as ground truth.
+    """
+
+    def __init__(self, pdf_bytes: bytes, legend_bytes: bytes, sheet_size: Tuple[float, float],
+                 density: float, symbols: List[Tuple[str, Tuple[float, float, float, float]]]):
+        self.pdf_bytes = pdf_bytes
+        self.legend_bytes = legend_bytes
+        self.sheet_size = sheet_size
+        self.density = density
+        self.symbols = symbols # (kind, (x0, y0, x1, y1) in inches)
+
+    @property
+    def name(self) -> str:
+        width, height = self.sheet_size
+        return f"{width:g}x{height:g}in_{self.density:g}per_sqft"
+
+
+def make_legend(kinds: List[str], symbol_size: float, dpi: int = 150) -> bytes:
+    """
+    PNG of a legend table, one row per symbol kind with its label.
+    """
+    row_height = symbol_size * 2
+    doc = fitz.open()
+    page = doc.new_page(width=symbol_size * 8, height=row_height * (len(kinds) + 1))
+    page.insert_text((symbol_size / 2, row_height * 0.6), "LEGEND", fontsize=symbol_size * 0.5)
+    for i, kind in enumerate(kinds):
+        y = row_height * (i + 1.5)
+        draw_symbol(page, kind, (symbol_size, y), symbol_size)
+        page.insert_text((symbol_size * 2.2, y + symbol_size * 0.15), kind.replace("_", " ").upper(),
+                         fontsize=symbol_size * 0.4)
+    legend_bytes = page.get_pixmap(dpi=dpi).tobytes("png")
+    doc.close()
+    return legend_bytes
+
+
+def make_plan(sheet_size: Tuple[float, float] = SHEET_SIZES["D"], density: float = 20.0, kinds: int = 4,
+              symbol_size: float = 0.3, room_size: Tuple[float, float] = (4.0, 8.0), seed: int = 0) -> SyntheticPlan:
+    """
+    Generate a plan with `density` symbols per square foot of sheet.
+
+    Parameters:
+    - sheet_size: Tuple[float, float], (width, height) of the sheet in inches, see `SHEET_SIZES`.
+    - density: float, symbols per square foot, capped to one symbol per square inch.
+    - kinds: int, number of different symbols, all of them are in the legend.
+    - symbol_size: float, width of the symbols in inches.
+    - room_size: Tuple[float, float], range of the sizes of the rooms drawn as walls, in inches.
+    - seed: int, seed of the layout, the same arguments always give the same plan.
+
+    Returns:
+    - SyntheticPlan, with the PDF and legend PNG bytes.
+    """
+    rng = np.random.default_rng(seed)
+    kind_names = list(SYMBOL_KINDS[:max(1, min(kinds, len(SYMBOL_KINDS)))])
+    width, height = sheet_size
+    doc = fitz.open()
+    page = doc.new_page(width=width * POINTS_PER_INCH, height=height * POINTS_PER_INCH)
+
+    # Walls, rooms of random sizes inside a half inch border
+    margin = 0.5
+    page.draw_rect(fitz.Rect(margin, margin, width - margin, height - margin) * POINTS_PER_INCH, color=(0, 0, 0), width=3)
+    for axis, length, span in ((0, width, height), (1, height, width)):
+        position = margin + rng.uniform(*room_size)
+        while position < length - margin:
+            start, end = sorted(rng.uniform(margin, span - margin, 2))
+            if axis == 0:
+                page.draw_line((position * POINTS_PER_INCH, start * POINTS_PER_INCH),
+                               (position * POINTS_PER_INCH, end * POINTS_PER_INCH), color=(0, 0, 0), width=2)
+            else:
+                page.draw_line((start * POINTS_PER_INCH, position * POINTS_PER_INCH),
+                               (end * POINTS_PER_INCH, position * POINTS_PER_INCH), color=(0, 0, 0), width=2)
+            position += rng.uniform(*room_size)
+
+    # Symbols in distinct one inch cells so that they do not overlap
+    columns, rows = int(width - 2 * margin), int(height - 2 * margin)
+    count = min(int(round(density * width * height / 144)), columns * rows)
+    cells = rng.choice(columns * rows, size=count, replace=False)
+    size = symbol_size * POINTS_PER_INCH
+    symbols = []
+    for cell in cells:
+        kind = kind_names[rng.integers(len(kind_names))]
+        x = margin + cell % columns + rng.uniform(symbol_size, 1 - symbol_size)
+        y = margin + cell // columns + rng.uniform(symbol_size, 1 - symbol_size)
+        draw_symbol(page, kind, (x * POINTS_PER_INCH, y * POINTS_PER_INCH), size)
+        half = symbol_size / 2
+        symbols.append((kind, (x - half, y - half, x + half, y + half)))
+
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return SyntheticPlan(pdf_bytes=pdf_bytes,
+                         legend_bytes=make_legend(kind_names, size),
+                         sheet_size=sheet_size,
+                         density=density,
+                         symbols=symbols)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sheet", default="D", help=f"Sheet size, one of {list(SHEET_SIZES)} or WIDTHxHEIGHT in inches")
+    parser.add_argument("--density", type=float, default=20.0, help="Symbols per square foot")
+    parser.add_argument("--kinds", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="temp/synthetic")
+    args = parser.parse_args()
+
+    sheet_size = SHEET_SIZES.get(args.sheet) or tuple(float(value) for value in args.sheet.lower().split("x"))
+    plan = make_plan(sheet_size=sheet_size, density=args.density, kinds=args.kinds, seed=args.seed)
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, f"{plan.name}.pdf"), "wb") as f:
+        f.write(plan.pdf_bytes)
+    with open(os.path.join(args.out, f"{plan.name}_legend.png"), "wb") as f:
+        f.write(plan.legend_bytes)
+    print(f"Wrote {plan.name} with {len(plan.symbols)} symbols to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Pick the fastest onnxruntime inference profile for this host.
+
+Every profile of `global_params.onnx_profiles` runs the bundled models (legend YOLO, symbol YOLO
+on a batch of sections and the Siamese network on a batch of pairs) on random inputs. The profile
+with the lowest total median time is written as ONNX_PROFILE in the .env file, which
+`global_params.onnx_profile` reads at startup.
+
+Run from the Backend folder:
+    python -m benchmarks.tune_onnx
+    python -m benchmarks.tune_onnx --profiles default extended single_thread --repeat 20 --dry-run
+"""
+import argparse
+import logging
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+from dotenv import set_key
+
+from benchmarks.suite import measure
+from core.config import global_params, logger
+from core.onnx_sessions import create_session, profile_providers
+
+
+INPUT_DTYPES = {"tensor(float)": np.float32, "tensor(float16)": np.float16, "tensor(double)": np.float64}
+
+
+def bundled_models() -> Dict[str, dict]:
+    """
+    Path of each model with the batch size it runs with in the pipeline.
+    """
+    return {"legend_yolo": {"path": global_params.legend_yolo_model_path, "batch_size": 1},
+            "symbol_yolo": {"path": global_params.symbol_yolo_model_path,
+                            "batch_size": global_params.symbol_detection_batch_size},
+            # The images of a batch are split over the two inputs of the network
+            "siamese": {"path": global_params.image_similarity_weight_file,
+                        "batch_size": max(1, global_params.image_similarity_batch_size // 2)}}
+
+
+def random_feeds(session, batch_size: int, rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    """
+    Random inputs of a session, the dynamic axes are the batch size.
+    """
+    feeds = {}
+    for model_input in session.get_inputs():
+        shape = [dim if isinstance(dim, int) else batch_size for dim in model_input.shape]
+        feeds[model_input.name] = rng.random(shape).astype(INPUT_DTYPES.get(model_input.type, np.float32))
+    return feeds
+
+
+def benchmark_profile(profile: str, models: Dict[str, dict], repeat: int) -> Dict[str, dict]:
+    results = {}
+    rng = np.random.default_rng(0)
+    for name, model in models.items():
+        start_time = time.perf_counter()
+        session = create_session(model["path"], profile=profile)
+        load_time = time.perf_counter() - start_time
+        feeds = random_feeds(session, model["batch_size"], rng)
+        results[name] = {**measure(lambda: session.run(None, feeds), repeat=repeat, warmup=2),
+                         "load_time": load_time}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", choices=sorted(global_params.onnx_profiles),
+                        help="Profiles to compare, all of them by default")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs of each model with each profile")
+    parser.add_argument("--env-file", default=".env", help="File the fastest profile is written to")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the results")
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    models = bundled_models()
+    profiles: List[str] = args.profiles or list(global_params.onnx_profiles)
+    totals = {}
+    print(f"{'profile':<16} " + " ".join(f"{name:>12}" for name in models) + f" {'total':>10}  providers")
+    for profile in profiles:
+        try:
+            results = benchmark_profile(profile, models, args.repeat)
+        except Exception as ex:
+            print(f"{profile:<16} failed: {ex}")
+            continue
+        totals[profile] = sum(result["median"] for result in results.values())
+        print(f"{profile:<16} " + " ".join(f"{results[name]['median']:>12.4f}" for name in models)
+              + f" {totals[profile]:>10.4f}  {profile_providers(profile)}")
+
+    if not totals:
+        raise SystemExit("No profile could run the models")
+    fastest = min(totals, key=totals.get)
+    current = global_params.onnx_profile
+    if current in totals and current != fastest:
+        print(f"Fastest profile: {fastest}, {1 - totals[fastest] / totals[current]:.1%} faster than {current}")
+    else:
+        print(f"Fastest profile: {fastest}")
+    if args.dry_run:
+        return
+    if not os.path.exists(args.env_file):
+        open(args.env_file, "a").close()
+    set_key(args.env_file, "ONNX_PROFILE", fastest)
+    print(f"Wrote ONNX_PROFILE={fastest} to {args.env_file}")
+
+
+if __name__ == "__main__":
+    main()
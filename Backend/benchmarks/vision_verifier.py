@@ -0,0 +1,58 @@
+"""
+Benchmark of the vision verifier against the local OpenAI stub.
+
+Start the stub first, then run from the Backend folder:
+    uvicorn benchmarks.openai_stub:app --port 8090
+    OPENAI_BASE_URL=http://127.0.0.1:8090/v1 python -m benchmarks.vision_verifier --boxes 200 --montage-size 1 16
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from core.config import global_params
+from core.template_similarity.openai_vision import filter_bounding_parallel, vision_verifier
+
+
+def synthetic_boxes(count: int, page_size=(2000, 2000), seed: int = 0):
+    """
+    A random page with `count` symbol sized boxes on it.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = page_size
+    full_image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    xy = rng.integers(0, [width - 64, height - 64], (count, 2))
+    wh = rng.integers(16, 64, (count, 2))
+    boxes = [((int(x), int(y)), (int(x + w), int(y + h))) for (x, y), (w, h) in zip(xy, wh)]
+    template = full_image[:48, :48].copy()
+    return boxes, full_image, template
+
+
+async def run(boxes, full_image, template, montage_sizes, repeat: int):
+    for montage_size in montage_sizes:
+        global_params.openai_montage_size = montage_size
+        for run_index in range(repeat):
+            requests_sent = vision_verifier.requests_sent
+            start_time = time.perf_counter()
+            refined = await filter_bounding_parallel(boxes, full_image, template)
+            elapsed = time.perf_counter() - start_time
+            print(f"montage size {montage_size}, run {run_index}: {len(boxes)} boxes, {len(refined)} kept "
+                  f"in {elapsed:.2f}s with {vision_verifier.requests_sent - requests_sent} requests")
+    print(vision_verifier.stats())
+    await vision_verifier.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--boxes", type=int, default=200)
+    parser.add_argument("--montage-size", type=int, nargs="+", default=[1, global_params.openai_montage_size],
+                        help="Candidates per request, 1 asks about each box on its own")
+    parser.add_argument("--repeat", type=int, default=2,
+                        help="Runs after the first one are answered from the verifier cache")
+    args = parser.parse_args()
+    asyncio.run(run(*synthetic_boxes(args.boxes), montage_sizes=args.montage_size, repeat=args.repeat))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from core.config import global_params, logger
+from core.boxes import BoxSet
+from core.metrics import metrics
+
+
+DETECTED_COLOR = (255, 120, 50)
+UNMATCHED_COLOR = (125, 125, 125)
+
+
+def symbol_color(symbol_type: int) -> Tuple[int, int, int]:
+    """
+    Colour the boxes of a legend symbol are drawn in.
+    """
+    if 0 <= symbol_type < len(global_params.color_lists):
+        return global_params.color_lists[symbol_type]
+    return DETECTED_COLOR
+
+
+def draw_plan_boxes(image: np.ndarray, boxes: BoxSet, scale: float = 1.0) -> np.ndarray:
+    """
+    Draw the boxes of a plan on `image` in place, in one pass over the final box set.
+
+    Every candidate is drawn in orange, the matched ones over it in the colour of their symbol,
+    and the unmatched ones large enough to be a symbol in grey. With `scale` the boxes and the
+    lines are scaled to an image resized by it.
+    """
+    def draw(selected: BoxSet, colors, thickness: int) -> None:
+        xyxy = np.rint(selected.xyxy * scale).astype(np.int64).tolist()
+        line = max(1, round(thickness * scale))
+        for (x_min, y_min, x_max, y_max), color in zip(xyxy, colors):
+            cv2.rectangle(image, (x_min, y_min), (x_max, y_max), color, line)
+
+    draw(boxes, [DETECTED_COLOR] * len(boxes), 3)
+    matched = boxes[boxes.symbol_types >= 0]
+    draw(matched, [symbol_color(symbol_type) for symbol_type in matched.symbol_types.tolist()], 3)
+    unmatched = boxes[boxes.symbol_types < 0].filter_area(min_area=40, min_width=16, min_height=16)
+    draw(unmatched, [UNMATCHED_COLOR] * len(unmatched), 5)
+    return image
+
+
+class PlanArtifacts():
+    """
+    Images of one processed plan, produced on demand instead of being encoded into the response.
+
+    Holds the page the symbols were matched on (already in memory, or mapped from the page cache),
+    the boxes of the crops in response order and the final boxes of the plan. The page itself is
+    never drawn on: the annotated page is rendered from the boxes, see `draw_plan_boxes`, only
+    when it is asked for.
+    """
+
+    def __init__(self, page_image: np.ndarray, boxes: Optional[BoxSet] = None):
+        self.page_image = page_image
+        self.boxes = BoxSet() if boxes is None else boxes
+        self.crop_boxes: List[Tuple[int, int, int, int]] = []
+        self.created_at = time.time()
+        self._rendered: Dict[Tuple[float, bool], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def add_crop(self, box: Tuple[int, int, int, int]) -> int:
+        """
+        Registers the (x_min, y_min, x_max, y_max) box of a crop, returns its index.
+        """
+        self.crop_boxes.append(tuple(int(v) for v in box))
+        return len(self.crop_boxes) - 1
+
+    def crop(self, index: int) -> np.ndarray:
+        x_min, y_min, x_max, y_max = self.crop_boxes[index]
+        return self.page_image[y_min:y_max, x_min:x_max]
+
+    def page(self, scale: float = 1.0, annotated: bool = False) -> np.ndarray:
+        """
+        The page, with the boxes drawn if `annotated`, resized by `scale`.
+
+        A downscaled page is resized first and the boxes are drawn on the small image, so only
+        full resolution annotated pages copy the whole page. Downscaled variants are kept once
+        rendered, full resolution ones are not to bound the memory.
+        """
+        if scale == 1.0 and not annotated:
+            return self.page_image
+        with self._lock:
+            rendered = self._rendered.get((scale, annotated))
+            if rendered is None:
+                if scale != 1.0:
+                    height, width = self.page_image.shape[:2]
+                    rendered = cv2.resize(self.page_image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                          interpolation=cv2.INTER_AREA)
+                else:
+                    rendered = np.array(self.page_image, copy=True)
+                if annotated:
+                    draw_plan_boxes(rendered, self.boxes, scale=scale)
+                if scale != 1.0:
+                    self._rendered[(scale, annotated)] = rendered
+            return rendered
+
+    @property
+    def memory_bytes(self) -> int:
+        """
+        Bytes held on the heap: the page unless it is mapped from the page cache, and the downscaled variants.
+        """
+        page_bytes = 0 if isinstance(self.page_image, np.memmap) else self.page_image.nbytes
+        with self._lock:
+            return page_bytes + sum(rendered.nbytes for rendered in self._rendered.values())
+
+
+class ArtifactStore():
+    """
+    In-memory store of the artifacts of the recently processed plans, by artifact id.
+
+    At most `max_plans` plans are kept, the oldest are dropped first, and none longer than `ttl_seconds`.
+    Pages mapped from the page cache cost no memory, but with the cache off every plan pins its
+    page on the heap: the oldest plans are also dropped while they hold more than `max_memory_bytes`,
+    the latest one is always kept.
+    """
+
+    def __init__(self, max_plans: int, ttl_seconds: float, max_memory_bytes: int = 1024**3):
+        self.max_plans = max_plans
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_bytes = max_memory_bytes
+        self._plans: "OrderedDict[str, PlanArtifacts]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.misses = 0
+
+    def put(self, artifacts: PlanArtifacts) -> str:
+        artifact_id = uuid.uuid4().hex
+        with self._lock:
+            self._plans[artifact_id] = artifacts
+            self._expire()
+        return artifact_id
+
+    def get(self, artifact_id: str) -> Optional[PlanArtifacts]:
+        with self._lock:
+            self._expire()
+            self.requests += 1
+            artifacts = self._plans.get(artifact_id)
+            if artifacts is None:
+                self.misses += 1
+            return artifacts
+
+    def _expire(self) -> None:
+        now = time.time()
+        for artifact_id in [key for key, plan in self._plans.items() if now - plan.created_at > self.ttl_seconds]:
+            del self._plans[artifact_id]
+        while len(self._plans) > self.max_plans:
+            artifact_id, _ = self._plans.popitem(last=False)
+            logger.debug(f"Dropped the artifacts {artifact_id} from the artifact store")
+        memory_bytes = sum(plan.memory_bytes for plan in self._plans.values())
+        while len(self._plans) > 1 and memory_bytes > self.max_memory_bytes:
+            artifact_id, plan = self._plans.popitem(last=False)
+            memory_bytes -= plan.memory_bytes
+            logger.debug(f"Dropped the artifacts {artifact_id} from the artifact store, over the memory budget")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"plans": len(self._plans),
+                    "memory_bytes": sum(plan.memory_bytes for plan in self._plans.values()),
+                    "requests": self.requests,
+                    "misses": self.misses}
+
+
+def crop_url(artifact_id: str, index: int) -> str:
+    return f"/artifacts/{artifact_id}/crops/{index}.png"
+
+
+def page_url(artifact_id: str, annotated: bool = False) -> str:
+    return f"/artifacts/{artifact_id}/page.png" + ("?annotated=true" if annotated else "")
+
+
+artifact_store = ArtifactStore(max_plans=global_params.artifact_max_plans,
+                               ttl_seconds=global_params.artifact_ttl_seconds,
+                               max_memory_bytes=global_params.artifact_max_memory_bytes)
+metrics.register_gauges("artifact_store", artifact_store.stats)
@@ -0,0 +1,162 @@
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+Box = Tuple[Tuple[int, int], Tuple[int, int]]
+
+
+class BoxSet():
+    """
+    Boxes of a page (or of its sections) stored as numpy columns.
+
+    - xyxy: (N, 4) int64, (x_min, y_min, x_max, y_max).
+    - scores: (N,) float32, detection confidence.
+    - classes: (N,) int32, class predicted by the detector.
+    - section_ids: (N,) int32, section the box was detected in, -1 once the boxes are merged over the page.
+    - symbol_types: (N,) int32, legend symbol the box is matched to, -1 while unmatched.
+
+    Operations return new sets and never modify the arrays they were given, so that selecting
+    with a mask (`boxes[mask]`) or removing (`boxes.remove(mask)`) is a vectorized copy instead
+    of a scan of Python tuples.
+    """
+
+    def __init__(self, xyxy: Optional[np.ndarray] = None,
+                 scores: Optional[np.ndarray] = None,
+                 classes: Optional[np.ndarray] = None,
+                 section_ids: Optional[np.ndarray] = None,
+                 symbol_types: Optional[np.ndarray] = None):
+        self.xyxy = np.zeros((0, 4), dtype=np.int64) if xyxy is None else np.asarray(xyxy, dtype=np.int64).reshape(-1, 4)
+        count = len(self.xyxy)
+        self.scores = self._column(scores, count, np.float32, 1.0)
+        self.classes = self._column(classes, count, np.int32, 0)
+        self.section_ids = self._column(section_ids, count, np.int32, -1)
+        self.symbol_types = self._column(symbol_types, count, np.int32, -1)
+
+    @staticmethod
+    def _column(values, count: int, dtype, default) -> np.ndarray:
+        if values is None:
+            return np.full(count, default, dtype=dtype)
+        values = np.asarray(values, dtype=dtype).reshape(-1)
+        if len(values) != count:
+            raise ValueError(f"Expected {count} values, got {len(values)}")
+        return values
+
+    @classmethod
+    def from_tuples(cls, boxes: Sequence[Box], **columns) -> "BoxSet":
+        """
+        Boxes from a list of ((x_min, y_min), (x_max, y_max)).
+        """
+        return cls(np.asarray(boxes, dtype=np.int64).reshape(-1, 4), **columns)
+
+    @classmethod
+    def from_section_boxes(cls, section_boxes: Sequence[Sequence[Box]]) -> "BoxSet":
+        """
+        Boxes from a list holding, for each section, the list of its ((x_min, y_min), (x_max, y_max)).
+        """
+        counts = [len(boxes) for boxes in section_boxes]
+        xyxy = [np.asarray(boxes, dtype=np.int64).reshape(-1, 4) for boxes in section_boxes]
+        return cls(np.concatenate(xyxy) if xyxy else None,
+                   section_ids=np.repeat(np.arange(len(section_boxes), dtype=np.int32), counts))
+
+    @classmethod
+    def concatenate(cls, box_sets: Sequence["BoxSet"]) -> "BoxSet":
+        if len(box_sets) == 0:
+            return cls()
+        return cls(np.concatenate([boxes.xyxy for boxes in box_sets]),
+                   scores=np.concatenate([boxes.scores for boxes in box_sets]),
+                   classes=np.concatenate([boxes.classes for boxes in box_sets]),
+                   section_ids=np.concatenate([boxes.section_ids for boxes in box_sets]),
+                   symbol_types=np.concatenate([boxes.symbol_types for boxes in box_sets]))
+
+    def __len__(self) -> int:
+        return len(self.xyxy)
+
+    def __getitem__(self, selection: Union[np.ndarray, slice, List[int]]) -> "BoxSet":
+        """
+        Boxes selected by a boolean mask, indices or a slice.
+        """
+        return BoxSet(self.xyxy[selection],
+                      scores=self.scores[selection],
+                      classes=self.classes[selection],
+                      section_ids=self.section_ids[selection],
+                      symbol_types=self.symbol_types[selection])
+
+    def remove(self, mask: np.ndarray) -> "BoxSet":
+        return self[~np.asarray(mask, dtype=bool)]
+
+    def replace(self, **columns) -> "BoxSet":
+        """
+        Same boxes with some columns replaced, e.g. `symbol_types`.
+        """
+        values = {"xyxy": self.xyxy, "scores": self.scores, "classes": self.classes,
+                  "section_ids": self.section_ids, "symbol_types": self.symbol_types}
+        values.update(columns)
+        return BoxSet(**values)
+
+    @property
+    def widths(self) -> np.ndarray:
+        return self.xyxy[:, 2] - self.xyxy[:, 0]
+
+    @property
+    def heights(self) -> np.ndarray:
+        return self.xyxy[:, 3] - self.xyxy[:, 1]
+
+    @property
+    def areas(self) -> np.ndarray:
+        return self.widths * self.heights
+
+    def offset(self, dx: Union[int, np.ndarray], dy: Union[int, np.ndarray]) -> "BoxSet":
+        """
+        Move the boxes, by the same amount or by one (dx, dy) per box.
+        """
+        shift = np.stack(np.broadcast_arrays(dx, dy, dx, dy), axis=-1).reshape(-1, 4)
+        return self.replace(xyxy=self.xyxy + shift.astype(np.int64))
+
+    def pad(self, padding: int) -> "BoxSet":
+        """
+        Grow the boxes by `padding` pixels on every side, see `clip` to keep them in the image.
+        """
+        return self.replace(xyxy=self.xyxy + np.array([-padding, -padding, padding, padding], dtype=np.int64))
+
+    def clip(self, width: int, height: int) -> "BoxSet":
+        """
+        Clamp the boxes to an image of `width` x `height`.
+        """
+        xyxy = self.xyxy.copy()
+        np.clip(xyxy[:, 0::2], 0, width, out=xyxy[:, 0::2])
+        np.clip(xyxy[:, 1::2], 0, height, out=xyxy[:, 1::2])
+        return self.replace(xyxy=xyxy)
+
+    def area_mask(self, min_area: float = 0, min_width: float = 0, min_height: float = 0) -> np.ndarray:
+        """
+        Boxes larger than `min_area` whose sides are longer than `min_width` and `min_height`.
+        """
+        widths, heights = self.widths, self.heights
+        return (widths * heights > min_area) & (widths > min_width) & (heights > min_height)
+
+    def filter_area(self, min_area: float = 0, min_width: float = 0, min_height: float = 0) -> "BoxSet":
+        return self[self.area_mask(min_area, min_width, min_height)]
+
+    def of_section(self, section_id: int) -> "BoxSet":
+        return self[self.section_ids == section_id]
+
+    def of_symbol_type(self, symbol_type: int) -> "BoxSet":
+        return self[self.symbol_types == symbol_type]
+
+    def to_tuples(self) -> List[Box]:
+        """
+        The boxes as ((x_min, y_min), (x_max, y_max)) of Python ints.
+        """
+        return [((x_min, y_min), (x_max, y_max)) for x_min, y_min, x_max, y_max in self.xyxy.tolist()]
+
+    def to_xywh(self) -> List[Tuple[int, int, int, int]]:
+        """
+        The boxes as (x, y, width, height) of Python ints, the `bbox` of the API models.
+        """
+        xywh = self.xyxy.copy()
+        xywh[:, 2:] -= xywh[:, :2]
+        return [tuple(box) for box in xywh.tolist()]
+
+    def __repr__(self) -> str:
+        return f"BoxSet({len(self)} boxes)"
@@ -14,8 +14,8 @@ def configured_logger():
         logger = logging.getLogger("uvicorn")
         logger.setLevel(log_level)
 
-        while logger.hasHandlers():
-            logger.handlers.clear()
+        # hasHandlers() also looks at the root logger, which may have handlers of its own (e.g. under pytest)
+        logger.handlers.clear()
 
         handler = logging.StreamHandler()
         handler.setLevel(log_level)
@@ -36,6 +36,7 @@ def configured_logger():
 class Settings(BaseSettings):
     api_key: str
     logger_level: str
+    openai_api_key: str = ""
 
     class Config:
         env_file = ".env"
@@ -47,33 +48,107 @@ class GlobalParams():
 
 
     # Pdf image to section conversion 
-    intensity_threshold = 0.0 
+    intensity_threshold = 0.0005 # Sections with a share of ink pixels at or below it are not sent to the detector
+    dark_pixel_value = 200 # Gray value under which a pixel counts as ink 
     dpi: int =600
     section_size = (512, 512)
+    page_cache_enabled = True # Keep rendered pages on disk, keyed by the pdf content, page and dpi 
+    page_cache_dir = 'temp/page_cache'
+    page_cache_max_bytes = 10 * 1024**3 # Least recently used pages are evicted above this size 
 
 
     # legend symbol detection 
     legend_yolo_model_path:str = 'core/detection/legend//best.onnx'
     if(not os.path.exists(legend_yolo_model_path)): 
         raise FileNotFoundError(f"{legend_yolo_model_path} not found ") 
-    EP_list = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+    EP_list = ['CUDAExecutionProvider', 'CPUExecutionProvider'] # Providers of the profiles without their own, the ones not installed are skipped
+    preload_onnx_models = True # Load the detection models once at startup instead of on the first request
+    # onnxruntime session settings of every model (legend and symbol YOLO, Siamese network), pick the fastest with `python -m benchmarks.tune_onnx`
+    onnx_profile = os.environ.get("ONNX_PROFILE", "default")
+    onnx_profiles = {
+        # optimization: disable_all, basic, extended or all. threads: 0 lets onnxruntime use all the cores
+        "default": {"optimization": "all", "intra_op_threads": 0, "inter_op_threads": 0, "execution_mode": "sequential",
+                    "cpu_mem_arena": True, "mem_pattern": True, "providers": None},
+        "low_memory": {"optimization": "disable_all", "intra_op_threads": 0, "inter_op_threads": 0, "execution_mode": "sequential",
+                       "cpu_mem_arena": False, "mem_pattern": False, "providers": None},
+        "extended": {"optimization": "extended", "intra_op_threads": 0, "inter_op_threads": 0, "execution_mode": "sequential",
+                     "cpu_mem_arena": True, "mem_pattern": True, "providers": None},
+        "half_cores": {"optimization": "all", "intra_op_threads": max(1, (os.cpu_count() or 1) // 2), "inter_op_threads": 1, "execution_mode": "sequential",
+                       "cpu_mem_arena": True, "mem_pattern": True, "providers": None},
+        "single_thread": {"optimization": "all", "intra_op_threads": 1, "inter_op_threads": 1, "execution_mode": "sequential",
+                          "cpu_mem_arena": True, "mem_pattern": True, "providers": None},
+        "parallel": {"optimization": "all", "intra_op_threads": 0, "inter_op_threads": 2, "execution_mode": "parallel",
+                     "cpu_mem_arena": True, "mem_pattern": True, "providers": None},
+        "cpu": {"optimization": "all", "intra_op_threads": 0, "inter_op_threads": 0, "execution_mode": "sequential",
+                "cpu_mem_arena": True, "mem_pattern": True, "providers": ["CPUExecutionProvider"]},
+    }
 
 
 
 
     # Template matching params 
     threshold = 0.80 
-    nms_threshold = 0.5 
+    nms_threshold = 0.5 # Page level NMS over the boxes of all the sections 
+    seam_tolerance = 2 # Distance in pixels to a section border for a box to be considered cut by it 
+    detection_top_k = 1000 # Max boxes per section sent to NMS, None to keep all of them 
     run_in_parallel = True # Always true, just adjust the number of workers. 
     max_workers = 4
     image_similarity_threshold = 0.3
     image_similarity_imgsize = (64,64)
     image_similarity_weight_file = "core/template_similarity/onnx_weights/siamese_network.onnx"
-    degrees = [0]
-    symbol_yolo_model_path:str = 'core/detection/symbol/best.onnx'
+    image_similarity_batch_size = 64 # Images embedded per run of the Siamese network, split over its two inputs 
+    dino_model_id = 'facebook/dinov2-large'
+    dino_batch_size = 32 # Crops embedded per forward pass 
+    embedding_cache_enabled = True # Reuse the embeddings of identical crops across pages and requests 
+    embedding_cache_max_bytes = 256 * 1024**2 # Memory budget of the embedding cache 
+    embedding_cache_dir = None # Optional folder to also keep the embeddings on disk, e.g. 'temp/embedding_cache' 
+    preload_dino_model = True # Load and warm up the DINOv2 backbone at startup instead of on the first request
+    degrees = [0, 90, 180, 270] # Rotations of the legend symbols queried when matching 
+    rotation_invariant_matching = True # Match symbols drawn at any of the `degrees` rotations 
+    symbol_yolo_model_path:str = 'core/detection/symbol/best.onnx' # Export with dynamic=True so that sections can be batched
+    symbol_detection_batch_size = 16 # Number of sections stacked in one onnx call, tune it per host
+    detection_engine = os.environ.get("DETECTION_ENGINE", "batched") # batched runs in the API process, process_pool spreads the tiles over worker processes
+    detection_workers = None # Worker processes of the process_pool engine, None for the cores divided by detection_intra_op_threads
+    detection_intra_op_threads = None # onnxruntime threads of each worker, None for 4, or the cores divided by detection_workers when it is set
+    detection_tiles_per_task = None # Tiles a worker takes from the queue at a time, None for the batch size
     if(not os.path.exists(symbol_yolo_model_path)): 
         raise FileNotFoundError(f"{symbol_yolo_model_path} not found ") 
 
+    # Jobs of the asynchronous plan processing API 
+    job_backend = "core.jobs.InProcessJobBackend" # Dotted path of the JobBackend running the jobs 
+    job_backend_options = {"workers": 1, # Plans processed at the same time 
+                           "queue_size": 8, # Jobs waiting, submissions are rejected above it 
+                           "retention_seconds": 3600, # Time the results of finished jobs are kept 
+                           "max_finished": 100}
+    stream_progress_interval = 1.0 # Seconds between the progress events of the streaming route 
+
+    # Encoding of the images put in the responses 
+    image_encoding_format = "png" # png, jpeg or webp, for the inline crops and the legend symbols 
+    image_png_compression = 1 # 0-9, higher is smaller and slower 
+    image_jpeg_quality = 90
+    image_webp_quality = 90
+    image_encoding_workers = 4 # Threads encoding the crops of a response in parallel 
+
+    # Crops and pages served by the artifact endpoints instead of inline base64 images 
+    artifact_max_plans = 8 # Plans whose artifacts are kept, the oldest are dropped first 
+    artifact_ttl_seconds = 3600
+    artifact_max_memory_bytes = 1024**3 # Pages held on the heap when the page cache is off, the oldest plans are dropped above it 
+
+    # Debugging images and json files, written by a background thread
+    debug_artifacts_enabled = os.environ.get("DEBUG_ARTIFACTS", str(log_level == logging.DEBUG)).lower() in ("1", "true") # Defaults to on with the DEBUG log level
+    debug_artifacts_sample_rate = 10 # Write 1 in N sections, 1 to write all of them
+    debug_artifacts_max_bytes = 256 * 1024**2 # Budget per request of the encoded images, the ones over it are dropped
+    debug_artifacts_queue_size = 256 # Writes waiting, the ones over it are dropped
+
+    # Vision LLM verification of the matched symbols 
+    openai_base_url = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1") # Point it to a local stub for tests and benchmarks 
+    openai_vision_model = "gpt-4-vision-preview"
+    openai_max_concurrency = 20 # Requests in flight 
+    openai_max_retries = 3 # Retries of rate limits, server errors and timeouts, with exponential backoff 
+    openai_timeout = 60.0
+    openai_montage_size = 16 # Candidates tiled in one montage per request, 1 to ask about each box on its own 
+    openai_montage_max_tokens = 200
+
     # Visualization 
     color_lists = [
         (255,0,0),
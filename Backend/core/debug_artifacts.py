@@ -0,0 +1,194 @@
+import contextvars
+import json
+import os
+import queue
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import cv2
+import numpy as np
+
+from core.config import global_params, logger
+from core.metrics import metrics
+
+
+class DebugRequest():
+    """
+    Bytes of debugging artifacts written for one request, against its budget.
+
+    Images are charged with their encoded size, once the writer thread has encoded them.
+    """
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size: int) -> bool:
+        with self._lock:
+            if self.bytes + size > self.max_bytes:
+                self.dropped += 1
+                return False
+            self.bytes += size
+            return True
+
+    @property
+    def exhausted(self) -> bool:
+        return self.bytes >= self.max_bytes
+
+
+# Request being processed, set by `DebugArtifactWriter.request`
+_current_request: contextvars.ContextVar[Optional[DebugRequest]] = contextvars.ContextVar("debug_request", default=None)
+
+
+class DebugArtifactWriter():
+    """
+    Writes the debugging images and json files of the pipeline on a background thread.
+
+    The hot path only copies what it hands over, the encoding and the disk writes happen on
+    the writer thread, in the order they were queued. The queue is bounded: when the disk
+    can not keep up the writes are dropped instead of slowing the requests down. Inside
+    `request()` the encoded images of a request are also limited to `max_bytes`, and the
+    sections are sampled with `sampled(i)`.
+    """
+
+    def __init__(self, enabled: bool, sample_rate: int = 10, max_bytes: int = 256 * 1024**2, queue_size: int = 256):
+        self.enabled = enabled
+        self.sample_rate = max(1, sample_rate)
+        self.max_bytes = max_bytes
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def sampled(self, index: int) -> bool:
+        """
+        Whether the `index`-th item of a series (e.g. the sections of a page) should be written.
+        """
+        return self.enabled and index % self.sample_rate == 0
+
+    @contextmanager
+    def request(self, name: str) -> Iterator[Optional[DebugRequest]]:
+        """
+        Count the artifacts written inside the block against one request budget.
+        """
+        if not self.enabled:
+            yield None
+            return
+        debug_request = DebugRequest(name, self.max_bytes)
+        token = _current_request.set(debug_request)
+        try:
+            yield debug_request
+        finally:
+            _current_request.reset(token)
+
+    def write_image(self, path: str, image: np.ndarray, rgb: bool = False, copy: bool = True) -> None:
+        """
+        Queue an image, `rgb` images are converted to the BGR order of `cv2.imwrite`.
+
+        The writer gets its own copy of the image, unless `copy` is False for an image nothing
+        modifies anymore, e.g. the rendered page and its sections which are never drawn on.
+        """
+        if not self.enabled:
+            return
+        debug_request = _current_request.get()
+        # Once the budget is spent the images are not even copied
+        if debug_request is not None and debug_request.exhausted and not debug_request.reserve(image.nbytes):
+            self._drop(path, image.nbytes, debug_request)
+            return
+        self._put(self._write_image, path, image.copy() if copy else image, rgb, debug_request)
+
+    def write_json(self, path: str, data: Any) -> None:
+        """
+        Queue a json file, `data` must not be modified once handed over.
+        """
+        if self.enabled:
+            self._put(self._write_json, path, data)
+
+    def clear_dir(self, path: str) -> None:
+        """
+        Queue the removal of a folder, before the writes queued after it.
+        """
+        if self.enabled:
+            self._put(shutil.rmtree, path, True)
+
+    def _put(self, function, *args) -> None:
+        self._start()
+        try:
+            self._queue.put_nowait((function, args))
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Dropped debug artifact {args[0]}, the queue of {self._queue.maxsize} writes is full")
+
+    def _start(self) -> None:
+        if self._thread is None:
+            with self._thread_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="debug-artifacts", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            function, args = self._queue.get()
+            try:
+                # False when the write was dropped
+                if function(*args) is not False:
+                    self.written += 1
+            except Exception as ex:
+                self.failed += 1
+                logger.info(f"Could not write debug artifact {args[0]}: {ex}")
+            finally:
+                self._queue.task_done()
+
+    def _drop(self, path: str, size: int, debug_request: DebugRequest) -> None:
+        self.dropped += 1
+        logger.warning(f"Dropped debug artifact {path} of {size / 1024**2:.1f} MB, over the budget of "
+                       f"{debug_request.max_bytes / 1024**2:.0f} MB of {debug_request.name}")
+
+    def _write_image(self, path: str, image: np.ndarray, rgb: bool, debug_request: Optional[DebugRequest]) -> bool:
+        if rgb:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        ok, encoded = cv2.imencode(os.path.splitext(path)[1] or ".png", image)
+        if not ok:
+            raise ValueError(f"cv2 could not encode {path}")
+        if debug_request is not None and not debug_request.reserve(encoded.nbytes):
+            self._drop(path, encoded.nbytes, debug_request)
+            return False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(encoded.tobytes())
+        return True
+
+    @staticmethod
+    def _write_json(path: str, data: Any) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            # Boxes may hold numpy arrays and scalars
+            json.dump(data, f, indent=4, default=lambda value: value.tolist() if hasattr(value, "tolist") else str(value))
+
+    def flush(self) -> None:
+        """
+        Wait for the queued writes, e.g. on shutdown.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled,
+                "queued": self._queue.qsize(),
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed}
+
+
+debug_artifacts = DebugArtifactWriter(enabled=global_params.debug_artifacts_enabled,
+                                      sample_rate=global_params.debug_artifacts_sample_rate,
+                                      max_bytes=global_params.debug_artifacts_max_bytes,
+                                      queue_size=global_params.debug_artifacts_queue_size)
+metrics.register_gauges("debug_artifacts", debug_artifacts.stats)
@@ -0,0 +1,180 @@
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+import onnxruntime
+
+from core.config import global_params, logger
+from core.detection.inference import preprocess_image, postprocess_predictions
+from core.onnx_sessions import session_registry
+from core.metrics import metrics
+
+
+class BatchedDetectionEngine():
+    """
+    Run YOLO detection over many image sections with a few batched onnx calls.
+
+    Sections are resized into one preallocated (N, 3, H, W) tensor and sent
+    through the model `batch_size` at a time. This needs a model exported with
+    a dynamic batch axis (`model.export(format="onnx", dynamic=True)`); for a
+    model with a fixed batch size the engine falls back to that size.
+
+    The model runs through the shared session of `session_registry`, unless a
+    `session` of its own is given, e.g. by the workers of the process pool engine.
+    """
+
+    def __init__(self, model_path: str,
+                 batch_size: int = 16,
+                 conf_threshold: float = 0.1,
+                 nms_threshold: float = 0.1,
+                 top_k: Optional[int] = None,
+                 session: Optional[onnxruntime.InferenceSession] = None):
+        self.model_path = model_path
+        self.conf_threshold = conf_threshold
+        self.nms_threshold = nms_threshold
+        self.top_k = top_k
+        self.session = session
+
+        if session is None:
+            session = session_registry.get(model_path)
+        model_input = session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.output_name = session.get_outputs()[0].name
+        self.input_size = tuple(model_input.shape[2:])
+
+        fixed_batch_size = model_input.shape[0]
+        self.dynamic_batch = not isinstance(fixed_batch_size, int)
+        if not self.dynamic_batch and fixed_batch_size != batch_size:
+            logger.warning(f"{model_path} is exported with a fixed batch size of {fixed_batch_size}, "
+                           f"using it instead of {batch_size}. Export with dynamic=True to batch sections.")
+            batch_size = fixed_batch_size
+        self.batch_size = max(1, batch_size)
+
+        self._lock = threading.Lock()
+        self.sections_processed = 0
+        self.batches_run = 0
+        self.inference_time = 0.0
+        self.last_sections_per_second = 0.0
+
+    def detect(self, sections: List[np.ndarray],
+               progress: Optional[Callable[[int, int], None]] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Detect symbols in a list of sections.
+
+        Parameters:
+        - sections: List[np.ndarray], image sections (H x W x 3), they may have different sizes.
+        - progress: Callable, called with (sections done, sections total) after every batch.
+
+        Returns:
+        - List[Tuple[np.ndarray, np.ndarray]]: for every section, in the same order, the boxes in
+          (x_min, y_min, x_max, y_max) format relative to the section and their scores. Use the
+          section `locations` (see `adjust_bounding_boxes`) to move them to the page coordinates.
+        """
+        results = []
+        start_time = time.perf_counter()
+        input_height, input_width = self.input_size
+        batch = np.empty((self.batch_size, 3, input_height, input_width), dtype=np.float32)
+        batches_run = 0
+
+        for start in range(0, len(sections), self.batch_size):
+            chunk = sections[start:start + self.batch_size]
+            for i, section in enumerate(chunk):
+                preprocess_image(section, self.input_size, out=batch[i])
+
+            # A fixed batch model always gets a full batch, the unused slots of the last one are ignored.
+            input_tensor = batch[:len(chunk)] if self.dynamic_batch else batch
+            with metrics.timer("symbol_detection_batch"):
+                outputs = self._run(input_tensor)
+            batches_run += 1
+
+            for i, section in enumerate(chunk):
+                results.append(postprocess_predictions(outputs[i],
+                                                       image_size=section.shape[:2],
+                                                       input_size=self.input_size,
+                                                       conf_threshold=self.conf_threshold,
+                                                       nms_threshold=self.nms_threshold,
+                                                       top_k=self.top_k))
+            if progress is not None:
+                progress(len(results), len(sections))
+
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            self.sections_processed += len(sections)
+            self.batches_run += batches_run
+            self.inference_time += elapsed
+            self.last_sections_per_second = len(sections) / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Detected symbols in {len(sections)} sections with {batches_run} batches of up to "
+                    f"{self.batch_size} in {elapsed:.2f}s ({self.last_sections_per_second:.1f} sections/s)")
+        return results
+
+    def detect_tiles(self, page: np.ndarray,
+                     locations: List[Tuple[Tuple[int, int], Tuple[int, int]]],
+                     progress: Optional[Callable[[int, int], None]] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Detect symbols in the tiles of a page, given by their [(y1, y2), (x1, x2)] `locations`.
+
+        The tiles are views of the page, see `detect` for the results.
+        """
+        return self.detect([page[y1:y2, x1:x2] for (y1, y2), (x1, x2) in locations], progress=progress)
+
+    def _run(self, input_tensor: np.ndarray) -> np.ndarray:
+        if self.session is not None:
+            return self.session.run([self.output_name], {self.input_name: input_tensor})[0]
+        return session_registry.run(self.model_path, {self.input_name: input_tensor}, [self.output_name])[0]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "model_path": self.model_path,
+                "batch_size": self.batch_size,
+                "sections_processed": self.sections_processed,
+                "batches_run": self.batches_run,
+                "inference_time": self.inference_time,
+                "sections_per_second": (self.sections_processed / self.inference_time
+                                        if self.inference_time > 0 else 0.0),
+                "last_sections_per_second": self.last_sections_per_second,
+            }
+
+
+_symbol_engine = None
+_symbol_engine_lock = threading.Lock()
+
+
+def get_symbol_detection_engine() -> BatchedDetectionEngine:
+    """
+    Engine of the symbol detector, created on first use and shared by all requests.
+
+    `global_params.detection_engine` picks the engine, `batched` runs in this process and
+    `process_pool` spreads the tiles over worker processes (see `ProcessPoolDetectionEngine`).
+    """
+    global _symbol_engine
+    if _symbol_engine is None:
+        with _symbol_engine_lock:
+            if _symbol_engine is None:
+                engine_options = dict(model_path=global_params.symbol_yolo_model_path,
+                                      batch_size=global_params.symbol_detection_batch_size,
+                                      top_k=global_params.detection_top_k)
+                if global_params.detection_engine == "process_pool":
+                    from core.detection.process_pool import ProcessPoolDetectionEngine
+                    _symbol_engine = ProcessPoolDetectionEngine(workers=global_params.detection_workers,
+                                                                intra_op_threads=global_params.detection_intra_op_threads,
+                                                                tiles_per_task=global_params.detection_tiles_per_task,
+                                                                **engine_options)
+                elif global_params.detection_engine == "batched":
+                    _symbol_engine = BatchedDetectionEngine(**engine_options)
+                else:
+                    raise ValueError(f"Unknown detection engine {global_params.detection_engine}, "
+                                     f"expected batched or process_pool")
+    return _symbol_engine
+
+
+def shutdown_symbol_detection_engine() -> None:
+    """
+    Stop the worker processes of the engine, if it has any.
+    """
+    global _symbol_engine
+    with _symbol_engine_lock:
+        engine, _symbol_engine = _symbol_engine, None
+    if engine is not None and hasattr(engine, "shutdown"):
+        engine.shutdown()
@@ -1,14 +1,9 @@
-import onnxruntime
 import numpy as np 
 import cv2 
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from core.config import global_params, logger
-
-opt_session = onnxruntime.SessionOptions()
-opt_session.enable_mem_pattern = False
-opt_session.enable_cpu_mem_arena = False
-opt_session.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
-
+from core.onnx_sessions import session_registry
+from core.metrics import metrics
 
 #model = YOLO('detect/train2/weights/best.pt')
 #model.export(format="onnx",imgsz=[1024])  # export the model to ONNX format
@@ -82,6 +77,71 @@ def xywh2xyxy(x):
     return y
 
 
+def preprocess_image(image: np.ndarray, input_size: Tuple[int, int], out: np.ndarray = None) -> np.ndarray:
+    """
+    Resize an image to the model input size and convert it to a normalized CHW float32 tensor.
+
+    Parameters:
+    - image: np.array, input image (H x W x 3).
+    - input_size: Tuple[int, int], (input_height, input_width) of the model.
+    - out: np.array, optional (3, input_height, input_width) float32 buffer to write into, e.g. one slot of a batch.
+
+    Returns:
+    - out: np.array, the (3, input_height, input_width) tensor.
+    """
+    input_height, input_width = input_size
+    resized = cv2.resize(image, (input_width, input_height))
+    if out is None:
+        out = np.empty((3, input_height, input_width), dtype=np.float32)
+    np.multiply(resized.transpose(2, 0, 1), 1.0 / 255.0, out=out, casting='unsafe') # Normalize pixel values to 0-1 in CHW format
+    return out
+
+
+def postprocess_predictions(predictions: np.ndarray,
+                            image_size: Tuple[int, int],
+                            input_size: Tuple[int, int],
+                            conf_threshold: float = 0.1,
+                            nms_threshold: float = 0.1,
+                            top_k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Turn the raw YOLO output of one image into boxes in the image coordinates.
+
+    Parameters:
+    - predictions: np.array, raw output of one image with shape (4+C, num_anchors).
+    - image_size: Tuple[int, int], (height, width) of the original image.
+    - input_size: Tuple[int, int], (input_height, input_width) of the model.
+    - conf_threshold: float, confidence threshold for filtering predictions.
+    - nms_threshold: float, IoU threshold for Non-Maximum Suppression.
+    - top_k: int, optional cap on the number of boxes, by score, sent to Non-Maximum Suppression.
+
+    Returns:
+    - boxes_xyxy: np.array, filtered boxes in (x_min, y_min, x_max, y_max) format.
+    - scores: np.array, confidence of each kept box.
+    """
+    image_height, image_width = image_size
+    input_height, input_width = input_size
+
+    # Work on the (4+C, num_anchors) layout directly, only the anchors above the threshold are gathered.
+    scores = np.max(predictions[4:], axis=0)
+    valid_indices = np.flatnonzero(scores > conf_threshold)
+    if top_k is not None and len(valid_indices) > top_k:
+        valid_indices = valid_indices[np.argpartition(-scores[valid_indices], top_k - 1)[:top_k]]
+    scores = scores[valid_indices]
+
+    boxes_xywh = predictions[:4, valid_indices].T
+    #rescale box
+    scale = np.array([image_width / input_width, image_height / input_height,
+                      image_width / input_width, image_height / input_height], dtype=np.float32)
+    boxes_xywh = (boxes_xywh * scale).astype(np.int32)
+
+    boxes_xyxy = xywh2xyxy(boxes_xywh)
+
+    indices = nms(boxes_xyxy, scores, iou_threshold=nms_threshold)
+
+    return boxes_xyxy[indices], scores[indices]
+
+
+@metrics.timed("infer_onnx")
 def infer_onnx(model_path:str, 
                image: np.ndarray = np.zeros((640, 640, 3)), 
                conf_threshold: float = 0.1, 
@@ -90,6 +150,7 @@ def infer_onnx(model_path:str,
     Perform inference on an image using an ONNX model and apply post-processing.
 
     Parameters:
+    - model_path: str, path of the onnx model. The session is shared through `session_registry`.
     - image: np.array, input image.
     - conf_threshold: float, confidence threshold for filtering predictions.
     - nms_threshold: float, IoU threshold for Non-Maximum Suppression.
@@ -98,37 +159,20 @@ def infer_onnx(model_path:str,
     - boxes_xyxy[indices]: np.array, filtered and processed bounding boxes.
     """
     logger.debug(f"Predicting symbols...")
-    ort_session = onnxruntime.InferenceSession(model_path)
+    ort_session = session_registry.get(model_path)
     input_shape = ort_session.get_inputs()[0].shape
     input_name = ort_session.get_inputs()[0].name
     output_name = ort_session.get_outputs()[0].name
+    input_size = tuple(input_shape[2:])
 
-    image_height, image_width = image.shape[:2]
-    input_height, input_width = input_shape[2:]
-
-    resized = cv2.resize(image, (input_width, input_height))
-    input_image = resized / 255.0  # Normalize pixel values to 0-1
-    input_image = input_image.transpose(2, 0, 1)  # Rearrange to CHW format
-    input_tensor = np.expand_dims(input_image, axis=0).astype(np.float32)
+    input_tensor = np.expand_dims(preprocess_image(image, input_size), axis=0)
 
-    outputs = ort_session.run([output_name], {input_name: input_tensor})[0]
-    predictions = np.squeeze(outputs).T
+    outputs = session_registry.run(model_path, {input_name: input_tensor}, [output_name])[0]
     logger.debug(f"Prediction complete...")
 
-    scores = np.max(predictions[:, 4:], axis=1)
-    valid_indices = scores > conf_threshold
-    predictions = predictions[valid_indices]
-    scores = scores[valid_indices]
-
-    boxes_xywh = predictions[:, :4]
-    #rescale box
-    input_shape = np.array([input_width, input_height, input_width, input_height])
-    boxes_xywh = np.divide(boxes_xywh, input_shape, dtype=np.float32)
-    boxes_xywh *= np.array([image_width, image_height, image_width, image_height])
-    boxes_xywh = boxes_xywh.astype(np.int32)
-
-    boxes_xyxy = xywh2xyxy(boxes_xywh)
-
-    indices = nms(boxes_xyxy, scores, iou_threshold=nms_threshold)
-
-    return boxes_xyxy[indices]
\ No newline at end of file
+    boxes_xyxy, _ = postprocess_predictions(outputs[0],
+                                            image_size=image.shape[:2],
+                                            input_size=input_size,
+                                            conf_threshold=conf_threshold,
+                                            nms_threshold=nms_threshold)
+    return boxes_xyxy
@@ -3,6 +3,8 @@ import cv2
 from core.config import global_params, logger
 from fastapi import HTTPException
 from core.detection.inference import infer_onnx
+from core.debug_artifacts import debug_artifacts
+from core.metrics import run_in_executor
 import os
 from typing import Tuple, List
 import io
@@ -12,35 +14,43 @@ import logging
 
 
     
-async def detection_legend(file, save_symbols_path) -> Tuple[str, int, List[np.ndarray]]:
+async def detection_legend(file, save_symbols_path) -> List[np.ndarray]:
     """
-    Process an uploaded image file.
+    Detect the symbols of an uploaded legend image, see `detection_legend_bytes`.
+    """
+    image_data = await file.read()
+    return await detection_legend_bytes(image_data, save_symbols_path)
+
+
+async def detection_legend_bytes(image_data: bytes, save_symbols_path) -> List[np.ndarray]:
+    """
+    Detect the symbols of a legend image off the event loop, see `detection_legend_bytes_sync`.
+    """
+    return await run_in_executor(detection_legend_bytes_sync, image_data, save_symbols_path)
 
-    This function reads the uploaded file, processes it, and returns a message and status code.
+
+def detection_legend_bytes_sync(image_data: bytes, save_symbols_path) -> List[np.ndarray]:
+    """
+    Process a legend image file.
+
+    This function decodes the image, detects the symbols of the legend and returns their crops.
 
     Args:
-    - file: An uploaded file object from FastAPI.
+    - image_data: Content of the legend image file.
+    - save_symbols_path: Folder the symbols are saved to, in the background, when the debug artifacts are on.
 
     Returns:
-    - Tuple[str, int]: A message and HTTP status code.
+    - List[np.ndarray]: The symbols cropped from the legend.
     """
-    logger_active = logger.isEnabledFor(logging.DEBUG)
-
     symbols_generated = []
     try:
-        # Read the image file
-        image_data = await file.read()
+        # Decode the image file
         image_array = np.frombuffer(image_data, np.uint8)
         image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
         logger.info(f"Legend image shape: {image.shape}")
 
-        image_to_show_legend = image.copy()
-        if(logger_active):
-            try: 
-                shutil.rmtree(save_symbols_path)
-            except:
-                pass 
-            os.makedirs(save_symbols_path, exist_ok=True)
+        image_to_show_legend = image.copy() if debug_artifacts.enabled else None
+        debug_artifacts.clear_dir(save_symbols_path)
 
         bboxes = infer_onnx(image=image,model_path=global_params.legend_yolo_model_path)
 
@@ -52,14 +62,12 @@ async def detection_legend(file, save_symbols_path) -> Tuple[str, int, List[np.n
             if area > 0:
                 roi = image[int(y): int(y_end), int(x): int(x_end)]
                 logger.debug(f" idx: {i} cropped detected symbol shape: {roi.shape}")
-                if logger_active:
+                if debug_artifacts.enabled:
                     cv2.rectangle(image_to_show_legend, (int(x), int(y)), (int(x_end), int(y_end)), (255, 0, 0), 2)
-                    file_path = f"{save_symbols_path}/symbol{i}.jpg"
-                    cv2.imwrite(file_path, cv2.cvtColor(roi, cv2.COLOR_RGB2BGR))
-                    logger.debug(f"Symbol {i} with shape {roi.shape}")
+                    debug_artifacts.write_image(f"{save_symbols_path}/symbol{i}.jpg", roi, rgb=True, copy=False)
                 symbols_generated.append(roi)
-        if logger_active:
-            cv2.imwrite(f"{save_symbols_path}/all_symbol.jpg", image_to_show_legend)
+        if debug_artifacts.enabled:
+            debug_artifacts.write_image(f"{save_symbols_path}/all_symbol.jpg", image_to_show_legend, copy=False)
         return symbols_generated
     except Exception as ex:
         logging.exception("An error occurred while processing symbol using yolov8 method: %s", str(ex))
@@ -0,0 +1,158 @@
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+
+def grid_nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float,
+             cell_size: Optional[int] = None) -> np.ndarray:
+    """
+    Non-Maximum Suppression over a whole page using a spatial grid.
+
+    Every kept box is registered in the grid cells it covers, so a candidate is only
+    compared with the kept boxes of its own cells instead of all of them. With cells
+    about the size of a symbol the cost stays near-linear in the number of boxes.
+
+    Parameters:
+    - boxes: np.array, (N, 4) boxes in (x_min, y_min, x_max, y_max) format.
+    - scores: np.array, (N,) confidence of each box.
+    - iou_threshold: float, IoU above which the lower scored box is suppressed.
+    - cell_size: int, size of the grid cells in pixels. Defaults to twice the median box side.
+
+    Returns:
+    - keep_indices: np.array, indices of the kept boxes, highest score first.
+    """
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    if cell_size is None:
+        sides = np.concatenate([boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]])
+        cell_size = max(16, int(2 * np.median(sides)))
+
+    cells = np.floor_divide(boxes, cell_size).astype(np.int64).tolist()
+    box_list = boxes.tolist()
+    areas = ((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])).tolist()
+    order = np.argsort(-scores, kind="stable").tolist()
+    grid: Dict[Tuple[int, int], List[int]] = {}
+    keep_indices = []
+
+    # A candidate only has a handful of kept neighbours, plain python beats a numpy call per box here.
+    for index in order:
+        cx1, cy1, cx2, cy2 = cells[index]
+        x1, y1, x2, y2 = box_list[index]
+        area = areas[index]
+        covered = [(cx, cy) for cy in range(cy1, cy2 + 1) for cx in range(cx1, cx2 + 1)]
+        suppressed = False
+        seen = set()
+        for cell in covered:
+            for other in grid.get(cell, ()):
+                if other in seen:
+                    continue
+                seen.add(other)
+                ox1, oy1, ox2, oy2 = box_list[other]
+                intersection = max(0.0, min(x2, ox2) - max(x1, ox1)) * max(0.0, min(y2, oy2) - max(y1, oy1))
+                union = max(area + areas[other] - intersection, 1e-9)
+                if intersection / union >= iou_threshold:
+                    suppressed = True
+                    break
+            if suppressed:
+                break
+        if suppressed:
+            continue
+        keep_indices.append(index)
+        for cell in covered:
+            grid.setdefault(cell, []).append(index)
+
+    return np.array(keep_indices, dtype=np.int64)
+
+
+def _find(parent: np.ndarray, i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def merge_seam_boxes(boxes: np.ndarray, scores: np.ndarray, locations: List,
+                     tolerance: int = 2, min_overlap: float = 0.5) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge the two halves of symbols that straddle the border of two sections.
+
+    A symbol cut by a seam is detected once on each side. The halves touch the seam
+    and overlap along it, but not across it, so NMS does not see them as duplicates.
+    Boxes touching the same seam from opposite sides whose extents along the seam
+    overlap by at least `min_overlap` (of the shorter one) are replaced by their union.
+
+    Parameters:
+    - boxes: np.array, (N, 4) page level boxes in (x_min, y_min, x_max, y_max) format.
+    - scores: np.array, (N,) confidence of each box.
+    - locations: list, [(y1, y2), (x1, x2)] of each section as returned by `split_image_into_sections`.
+    - tolerance: int, distance in pixels to the seam for a box to be considered cut by it.
+    - min_overlap: float, minimum overlap along the seam, relative to the shorter box.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: merged boxes and their scores (max of the merged ones).
+    """
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float32).reshape(-1)
+    if len(boxes) == 0:
+        return boxes, scores
+
+    seams_x = sorted({x1 for (_, (x1, _)) in locations if x1 > 0})
+    seams_y = sorted({y1 for ((y1, _), _) in locations if y1 > 0})
+    parent = np.arange(len(boxes))
+
+    # axis 0 -> vertical seams (x), axis 1 -> horizontal seams (y)
+    for axis, seams in ((0, seams_x), (1, seams_y)):
+        low, high = boxes[:, axis], boxes[:, axis + 2]
+        other_low, other_high = boxes[:, 1 - axis], boxes[:, 3 - axis]
+        for seam in seams:
+            before = np.nonzero(np.abs(high - seam) <= tolerance)[0]
+            after = np.nonzero(np.abs(low - seam) <= tolerance)[0]
+            if len(before) == 0 or len(after) == 0:
+                continue
+            overlap = (np.minimum(other_high[before][:, None], other_high[after][None, :])
+                       - np.maximum(other_low[before][:, None], other_low[after][None, :]))
+            lengths = other_high - other_low
+            shorter = np.minimum(lengths[before][:, None], lengths[after][None, :])
+            pairs = np.argwhere(overlap >= min_overlap * np.maximum(shorter, 1))
+            for i, j in pairs:
+                root_i, root_j = _find(parent, before[i]), _find(parent, after[j])
+                if root_i != root_j:
+                    parent[root_j] = root_i
+
+    roots = np.array([_find(parent, i) for i in range(len(boxes))])
+    unique_roots, group = np.unique(roots, return_inverse=True)
+    if len(unique_roots) == len(boxes):
+        return boxes, scores
+
+    merged_boxes = np.empty((len(unique_roots), 4), dtype=np.int64)
+    merged_boxes[:, :2] = np.iinfo(np.int64).max
+    merged_boxes[:, 2:] = np.iinfo(np.int64).min
+    np.minimum.at(merged_boxes[:, 0], group, boxes[:, 0])
+    np.minimum.at(merged_boxes[:, 1], group, boxes[:, 1])
+    np.maximum.at(merged_boxes[:, 2], group, boxes[:, 2])
+    np.maximum.at(merged_boxes[:, 3], group, boxes[:, 3])
+    merged_scores = np.zeros(len(unique_roots), dtype=np.float32)
+    np.maximum.at(merged_scores, group, scores)
+    return merged_boxes, merged_scores
+
+
+def deduplicate_page_boxes(boxes: np.ndarray, scores: np.ndarray, locations: List,
+                           iou_threshold: float, seam_tolerance: int = 2) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Merge the boxes cut by section seams, then run one NMS over the whole page.
+
+    Parameters:
+    - boxes: np.array, (N, 4) page level boxes in (x_min, y_min, x_max, y_max) format.
+    - scores: np.array, (N,) confidence of each box.
+    - locations: list, locations of the sections in the page.
+    - iou_threshold: float, IoU threshold of the page level NMS.
+    - seam_tolerance: int, distance in pixels to a seam for a box to be considered cut by it.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: deduplicated boxes and scores, highest score first.
+    """
+    boxes, scores = merge_seam_boxes(boxes, scores, locations, tolerance=seam_tolerance)
+    keep_indices = grid_nms(boxes, scores, iou_threshold)
+    return boxes[keep_indices], scores[keep_indices]
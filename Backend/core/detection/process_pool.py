@@ -0,0 +1,212 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from core.config import global_params, logger
+from core.detection.batch_inference import BatchedDetectionEngine
+from core.onnx_sessions import create_session, profile_providers
+from core.metrics import metrics
+
+
+Location = Tuple[Tuple[int, int], Tuple[int, int]]
+
+
+def available_cores() -> int:
+    """
+    Cores this process may run on, which can be fewer than the cores of the host in a container.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def divide_cores(cores: int, workers: Optional[int] = None, intra_op_threads: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Divide the cores between worker processes and the onnxruntime threads of each of them.
+
+    Parameters:
+    - cores: int, cores to divide, see `available_cores`.
+    - workers: int, worker processes, None to derive it from the threads.
+    - intra_op_threads: int, onnxruntime intra-op threads of each worker, None to derive it from the workers.
+
+    Returns:
+    - Tuple[int, int]: (workers, intra_op_threads). Without either, workers get 4 threads each,
+      e.g. 8 workers of 4 threads on 32 cores.
+    """
+    if workers is None and intra_op_threads is None:
+        intra_op_threads = min(4, cores)
+    if workers is None:
+        workers = max(1, cores // intra_op_threads)
+    if intra_op_threads is None:
+        intra_op_threads = max(1, cores // workers)
+    return workers, intra_op_threads
+
+
+# Engine of a worker process, set by `_init_worker`
+_worker_engine: Optional[BatchedDetectionEngine] = None
+
+
+def _init_worker(model_path: str, profile: str, intra_op_threads: int, providers: List[str], engine_options: dict) -> None:
+    global _worker_engine
+    # The parent logs the totals of every page
+    logger.setLevel(logging.WARNING)
+    # The inference profile, with the threads the worker was given
+    session = create_session(model_path, profile=profile, providers=providers,
+                             intra_op_threads=intra_op_threads, inter_op_threads=1, execution_mode="sequential")
+    _worker_engine = BatchedDetectionEngine(model_path, session=session, **engine_options)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _detect_task(shm_name: str, shape: Tuple[int, ...], dtype: str,
+                 locations: List[Location]) -> Tuple[List[Tuple[np.ndarray, np.ndarray]], float]:
+    """
+    Detect the symbols of a few tiles of the page held in the shared memory `shm_name`.
+    """
+    start_time = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        page = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        results = _worker_engine.detect_tiles(page, locations)
+        # The buffer can only be closed once no array points to it
+        del page
+    finally:
+        shm.close()
+    return results, time.perf_counter() - start_time
+
+
+class ProcessPoolDetectionEngine(BatchedDetectionEngine):
+    """
+    Run the symbol detection of a page over a pool of worker processes.
+
+    In one process the preprocessing and the decoding of the outputs contend for the GIL, and
+    the onnxruntime threads of concurrent calls oversubscribe the cores. Here every worker holds
+    its own session, with the settings of the inference profile but limited to `intra_op_threads`,
+    and `divide_cores` splits the cores between the workers and their threads.
+
+    `detect_tiles` copies the page once into shared memory and queues its tiles in tasks of
+    `tiles_per_task`. The workers take the next task as soon as they are done with one, so the
+    faster ones take more of the page, and read their tiles as views of the shared page instead
+    of receiving pickled copies. `detect` of a list of sections still runs in this process.
+    """
+
+    def __init__(self, model_path: str,
+                 batch_size: int = 16,
+                 conf_threshold: float = 0.1,
+                 nms_threshold: float = 0.1,
+                 top_k: Optional[int] = None,
+                 workers: Optional[int] = None,
+                 intra_op_threads: Optional[int] = None,
+                 tiles_per_task: Optional[int] = None):
+        super().__init__(model_path, batch_size=batch_size, conf_threshold=conf_threshold,
+                         nms_threshold=nms_threshold, top_k=top_k)
+        self.workers, self.intra_op_threads = divide_cores(available_cores(), workers, intra_op_threads)
+        self.tiles_per_task = max(1, tiles_per_task or self.batch_size)
+        self.tasks_run = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    engine_options = {"batch_size": self.batch_size,
+                                      "conf_threshold": self.conf_threshold,
+                                      "nms_threshold": self.nms_threshold,
+                                      "top_k": self.top_k}
+                    # Forking a process running onnxruntime and the server threads is not safe
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=_init_worker,
+                                                     initargs=(os.path.abspath(self.model_path),
+                                                               global_params.onnx_profile,
+                                                               self.intra_op_threads,
+                                                               profile_providers(),
+                                                               engine_options))
+                    logger.info(f"Started {self.workers} detection workers with {self.intra_op_threads} "
+                                f"onnxruntime threads each")
+        return self._pool
+
+    def warm_up(self) -> None:
+        """
+        Start the workers and load their sessions ahead of the first request.
+        """
+        pool = self._get_pool()
+        pids = {future.result() for future in [pool.submit(_ping) for _ in range(self.workers)]}
+        logger.info(f"{len(pids)} detection workers ready")
+
+    def detect_tiles(self, page: np.ndarray,
+                     locations: List[Location],
+                     progress: Optional[Callable[[int, int], None]] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Detect symbols in the tiles of a page over the worker processes, see `BatchedDetectionEngine.detect_tiles`.
+        """
+        if len(locations) == 0:
+            return []
+        start_time = time.perf_counter()
+        pool = self._get_pool()
+        shm = shared_memory.SharedMemory(create=True, size=max(1, page.nbytes))
+        futures: Dict[Future, int] = {}
+        try:
+            shared_page = np.ndarray(page.shape, dtype=page.dtype, buffer=shm.buf)
+            shared_page[...] = page
+            del shared_page
+            for start in range(0, len(locations), self.tiles_per_task):
+                future = pool.submit(_detect_task, shm.name, page.shape, page.dtype.str,
+                                     locations[start:start + self.tiles_per_task])
+                futures[future] = start
+
+            results: List[Optional[Tuple[np.ndarray, np.ndarray]]] = [None] * len(locations)
+            done_tiles = 0
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task_results, task_seconds = future.result()
+                    metrics.observe("symbol_detection_task", task_seconds)
+                    start = futures[future]
+                    results[start:start + len(task_results)] = task_results
+                    done_tiles += len(task_results)
+                if progress is not None:
+                    progress(done_tiles, len(locations))
+        finally:
+            # Tasks not started yet are dropped when the detection fails or is cancelled
+            for future in futures:
+                future.cancel()
+            shm.close()
+            shm.unlink()
+
+        elapsed = time.perf_counter() - start_time
+        with self._lock:
+            self.sections_processed += len(locations)
+            self.tasks_run += len(futures)
+            self.inference_time += elapsed
+            self.last_sections_per_second = len(locations) / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Detected symbols in {len(locations)} tiles with {len(futures)} tasks on {self.workers} "
+                    f"workers in {elapsed:.2f}s ({self.last_sections_per_second:.1f} sections/s)")
+        return results
+
+    def shutdown(self) -> None:
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        with self._lock:
+            stats.update({"workers": self.workers,
+                          "intra_op_threads": self.intra_op_threads,
+                          "tiles_per_task": self.tiles_per_task,
+                          "tasks_run": self.tasks_run})
+        return stats
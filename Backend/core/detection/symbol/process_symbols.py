@@ -1,83 +1,56 @@
-import copy
 import numpy as np
-import cv2
-from fastapi import HTTPException
-from core.detection.inference import infer_onnx
-from typing import Tuple, List
-from concurrent.futures import ThreadPoolExecutor
-import time 
-import asyncio
+from core.detection.batch_inference import get_symbol_detection_engine
+from core.pdf_to_images.getimages import find_blank_sections
+from typing import Callable, Optional, Tuple, List
 from core.config import global_params, logger
+from core.metrics import metrics, run_in_executor
+from core.boxes import BoxSet
 
 
-async def getBoundingBoxes(source_image: np.ndarray) -> Tuple[
-                                                    np.ndarray, 
-                                                    List[Tuple[Tuple[int, int], Tuple[int, int]]], str, 
-                                                    int]:
+def detect_symbols_sync(image_sections_nparray_list: List[np.ndarray],
+                        progress: Optional[Callable[[int, int], None]] = None,
+                        page: Optional[np.ndarray] = None,
+                        locations: Optional[List[Tuple[Tuple[int, int], Tuple[int, int]]]] = None) -> Tuple[BoxSet, int]:
     """
-    Performs template matching to find instances of the template image in the source image.
-    
-    Args:
-    - source_image (np.ndarray): The source image in which to find templates.
-    - template_image (np.ndarray): The template image to match in the source image.
+    Detects the symbols of all the sections with batched inference.
 
-    Returns:
-    - Tuple[np.ndarray, List[Tuple[Tuple[int, int], Tuple[int, int]]], str, int]: A tuple containing the image with drawn bounding boxes, list of bounding boxes, a status message, and a status code.
+    Sections without ink (see `find_blank_sections`) are not sent to the model, they get no boxes.
+    The sections are read as they are, usually views of the page, nothing is drawn on them.
 
-    TIPS: Use more degrees and use a value of 0.85 for the first processing to get ALL the correct symbols. This will also give some garbage but we can later filter it out. 
+    Args:
+    - image_sections_nparray_list (List[np.ndarray]): Sections of the page.
+    - progress (Callable): Called with (sections done, sections total) as the batches complete, blank sections count as done.
+    - page (np.ndarray): Optional page the sections are views of, with their `locations`, so that the engine can read the sections from the page (see `ProcessPoolDetectionEngine`).
+    - locations (List): [(y1, y2), (x1, x2)] of the sections in the page.
 
-    Raises:
-    - HTTPException: Specific HTTP errors encountered during processing.
-    - IOError: If there is an issue in file operations.
-    - RuntimeError: For errors specific to image processing or feature extraction.
+    Returns:
+    - Tuple[BoxSet, int]: The boxes relative to their section with their scores and `section_ids`, and the number of blank sections skipped.
     """
-    logger.debug("Getting bboxes of a section... ")
-    draw_on_image = source_image.copy()
-    valid_boxes = []
-    symbols_detected_list_numpy = []
-    try: 
-        bboxes = infer_onnx(image=source_image,model_path=global_params.symbol_yolo_model_path)
-        for i , box in enumerate(bboxes):
-            x, y, x_end, y_end = box
-            area = (x_end - x) * (y_end - y)
-            if area > 0:
-                roi = source_image[int(y): int(y_end), int(x): int(x_end)]
-                valid_boxes.append([(int(x), int(y)), (int(x_end), int(y_end))])
-                cv2.rectangle(draw_on_image, (int(x), int(y)), (int(x_end), int(y_end)), (255, 0, 0), 2)
-                logger.debug(f"Symbol {i} with shape {roi.shape}")
-                symbols_detected_list_numpy.append(roi)
-
-        return draw_on_image, valid_boxes
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))      
-
-def process_section_sync(idx,section_nparray):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    # Call the async function from the synchronous function
-    boxes_drawn_image, boxes = loop.run_until_complete(
-        getBoundingBoxes(
-            source_image=section_nparray        )
-    )
-    return boxes_drawn_image, boxes
-
-async def detect_symbols(image_sections_nparray_list):
-    processed_sections = []
-    processed_boxes = []
-    with ThreadPoolExecutor(max_workers=global_params.max_workers) as executor:
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(
-                executor, 
-                process_section_sync,
-                idx,  
-                section_nparray
-            )
-            for idx,section_nparray in enumerate(image_sections_nparray_list)
-        ]
-        results = await asyncio.gather(*tasks)
-        for idx, (boxes_drawn_image, boxes) in enumerate(results):
-            processed_sections.append(boxes_drawn_image)
-            processed_boxes.append(boxes)
-    return processed_sections, processed_boxes
\ No newline at end of file
+    blank_sections = find_blank_sections(image_sections_nparray_list)
+    inked_indices = np.flatnonzero(~blank_sections)
+    sections_skipped = int(blank_sections.sum())
+    logger.info(f"Skipping {sections_skipped} blank sections out of {len(image_sections_nparray_list)}")
+
+    batch_progress = None
+    if progress is not None:
+        progress(sections_skipped, len(image_sections_nparray_list))
+        batch_progress = lambda done, _: progress(sections_skipped + done, len(image_sections_nparray_list))
+    engine = get_symbol_detection_engine()
+    if page is not None and locations is not None:
+        detections = engine.detect_tiles(page, [locations[i] for i in inked_indices], progress=batch_progress)
+    else:
+        detections = engine.detect([image_sections_nparray_list[i] for i in inked_indices], progress=batch_progress)
+    empty_detection = (np.zeros((0, 4), dtype=np.int32), np.zeros((0,), dtype=np.float32))
+    all_detections = [empty_detection] * len(image_sections_nparray_list)
+    for i, detection in zip(inked_indices, detections):
+        all_detections[i] = detection
+
+    section_boxes_list = [BoxSet(bboxes, scores=scores, section_ids=np.full(len(bboxes), section_id)).filter_area()
+                          for section_id, (bboxes, scores) in enumerate(all_detections)]
+    return BoxSet.concatenate(section_boxes_list), sections_skipped
+
+
+async def detect_symbols(image_sections_nparray_list, progress=None, page=None, locations=None):
+    # The batches already use all the cores through onnxruntime or the detection workers, run them off the event loop.
+    with metrics.timer("symbol_detection"):
+        return await run_in_executor(detect_symbols_sync, image_sections_nparray_list, progress, page, locations)
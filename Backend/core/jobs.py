@@ -0,0 +1,234 @@
+import asyncio
+import importlib
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from core.config import global_params, logger
+from core.pipeline import PlanCancelled, PlanProgress, process_plan
+
+
+class JobQueueFull(Exception):
+    """
+    Raised by `JobBackend.submit` when no more jobs can be queued.
+    """
+
+
+class PlanJobRequest():
+    """
+    Inputs of a full plan processing job.
+    """
+
+    def __init__(self, pdf_bytes: bytes, pdf_filename: str, legend_bytes: bytes, page_num: int = 1,
+                 inline_crops: bool = False, include_timings: bool = False):
+        self.pdf_bytes = pdf_bytes
+        self.pdf_filename = pdf_filename
+        self.legend_bytes = legend_bytes
+        self.page_num = page_num
+        self.inline_crops = inline_crops
+        self.include_timings = include_timings
+
+
+class Job():
+    """
+    A plan processing job, its progress and, once finished, its result or error.
+
+    Status goes from `queued` to `running`, then to `succeeded`, `failed` or `cancelled`.
+    """
+
+    FINISHED = ("succeeded", "failed", "cancelled")
+
+    def __init__(self, request: PlanJobRequest):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.status = "queued"
+        self.progress = PlanProgress()
+        self.result = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in self.FINISHED
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"job_id": self.id,
+                "status": self.status,
+                "progress": self.progress.snapshot(),
+                "error": self.error,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at}
+
+
+class JobBackend():
+    """
+    Interface of the backends running the plan processing jobs.
+
+    The default `InProcessJobBackend` runs them in the API process. Another backend, e.g. one
+    handing the requests to a broker and its workers, can be plugged in through
+    `global_params.job_backend` by implementing these methods.
+    """
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    async def submit(self, request: PlanJobRequest) -> Job:
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InProcessJobBackend(JobBackend):
+    """
+    Runs the jobs on a pool of asyncio workers of the API process, fed by a bounded queue.
+
+    Submitting to a full queue raises `JobQueueFull` instead of piling up uploads in memory.
+    Finished jobs are kept for `retention_seconds`, and at most `max_finished` of them, so
+    that their results can be fetched.
+    """
+
+    def __init__(self, workers: int = 1, queue_size: int = 8,
+                 retention_seconds: float = 3600, max_finished: int = 100):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.retention_seconds = retention_seconds
+        self.max_finished = max_finished
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks = []
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.submitted = 0
+        self.rejected = 0
+
+    async def start(self) -> None:
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._worker_tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Started {self.workers} job workers with a queue of {self.queue_size}")
+
+    async def stop(self) -> None:
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._queue = None
+
+    async def submit(self, request: PlanJobRequest) -> Job:
+        await self.start()
+        self._expire()
+        job = Job(request)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise JobQueueFull(f"The job queue is full ({self.queue_size} jobs waiting)")
+        self._jobs[job.id] = job
+        self.submitted += 1
+        logger.info(f"Queued job {job.id} for page {request.page_num} of {request.pdf_filename}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    async def cancel(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return job
+        job.progress.cancel()
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            # Still in the queue, the worker drops it when it gets there
+            self._finish(job, "cancelled")
+        return job
+
+    async def _worker(self, worker_index: int) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.finished:
+                    continue
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job) -> None:
+        job.status = "running"
+        job.started_at = time.time()
+        request = job.request
+        job.task = asyncio.create_task(process_plan(pdf_bytes=request.pdf_bytes,
+                                                    pdf_filename=request.pdf_filename,
+                                                    legend_bytes=request.legend_bytes,
+                                                    page_num=request.page_num,
+                                                    progress=job.progress,
+                                                    inline_crops=request.inline_crops,
+                                                    include_timings=request.include_timings))
+        try:
+            job.result = await job.task
+            self._finish(job, "succeeded")
+        except (asyncio.CancelledError, PlanCancelled):
+            if not job.progress.cancelled:
+                raise # The worker itself is being stopped
+            self._finish(job, "cancelled")
+        except Exception as ex:
+            logger.exception(f"Job {job.id} failed: {ex}")
+            job.error = getattr(ex, "detail", None) or str(ex)
+            self._finish(job, "failed")
+        finally:
+            job.task = None
+
+    def _finish(self, job: Job, status: str) -> None:
+        job.status = status
+        job.finished_at = time.time()
+        job.request = None # The uploads are not needed anymore
+        logger.info(f"Job {job.id} {status} in {job.finished_at - job.created_at:.1f}s")
+
+    def _expire(self) -> None:
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.finished]
+        expired = [job for job in finished if now - job.finished_at > self.retention_seconds]
+        expired += finished[:max(0, len(finished) - self.max_finished)]
+        for job in expired:
+            self._jobs.pop(job.id, None)
+
+    def stats(self) -> dict:
+        statuses: Dict[str, int] = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return {"workers": self.workers,
+                "queue_size": self.queue_size,
+                "queued": self._queue.qsize() if self._queue is not None else 0,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "jobs": statuses}
+
+
+_job_backend: Optional[JobBackend] = None
+
+
+def get_job_backend() -> JobBackend:
+    """
+    Backend named by `global_params.job_backend`, created on first use and shared by all requests.
+    """
+    global _job_backend
+    if _job_backend is None:
+        module_name, class_name = global_params.job_backend.rsplit(".", 1)
+        backend_class = getattr(importlib.import_module(module_name), class_name)
+        _job_backend = backend_class(**global_params.job_backend_options)
+    return _job_backend
@@ -0,0 +1,202 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from core.config import logger
+
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Timings of the request being processed, set by `MetricsRegistry.request_timings`
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram():
+    """
+    Cumulative histogram of durations in seconds, Prometheus style.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+
+class MetricsRegistry():
+    """
+    Process-wide timers and counters of the processing pipeline.
+
+    - `timer(name)` (context manager) and `timed(name)` (decorator) record durations in histograms.
+    - `inc(name, value)` adds to a counter, e.g. tiles, candidates and matches.
+    - Inside `request_timings()`, durations are also summed per name for the current request,
+      work sent to threads keeps them with `run_in_executor`.
+    - `register_gauges(component, collect)` adds the numeric values of a `stats()` dict, e.g. of a
+      cache or a model, read every time the metrics are rendered.
+    - `render_prometheus()` exposes everything, with the peak RSS of the process, for `/metrics`.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Callable[[], dict]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            timings = _request_timings.get()
+            if timings is not None:
+                timings[name] = timings.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time)
+
+    def timed(self, name: Optional[str] = None):
+        """
+        Decorator timing every call of a function or coroutine function, named after it by default.
+        """
+        def decorator(function):
+            timer_name = name or function.__qualname__
+            if inspect.iscoroutinefunction(function):
+                @functools.wraps(function)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(timer_name):
+                        return await function(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(timer_name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def inc(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register_gauges(self, component: str, collect: Callable[[], dict]) -> None:
+        """
+        Expose the numbers (and booleans) of the dict returned by `collect`, nested dicts are
+        flattened with `_`, e.g. `metrics.register_gauges("page_cache", page_cache.stats)`.
+        """
+        with self._lock:
+            self._gauges[component] = collect
+
+    def gauges(self) -> Dict[str, Dict[str, float]]:
+        """
+        Current values of the registered gauges, per component.
+        """
+        with self._lock:
+            collectors = list(self._gauges.items())
+        values = {}
+        for component, collect in collectors:
+            try:
+                values[component] = _numeric_values(collect())
+            except Exception as ex:
+                logger.warning(f"Could not collect the {component} metrics: {ex}")
+        return values
+
+    @contextmanager
+    def request_timings(self) -> Iterator[Dict[str, float]]:
+        """
+        Collect the durations of the timers run by the current request, summed per name.
+        """
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        try:
+            yield timings
+        finally:
+            _request_timings.reset(token)
+
+    @staticmethod
+    def peak_rss_bytes() -> int:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def snapshot(self) -> dict:
+        # The collectors are called without the lock, `gauges` takes it itself
+        gauges = self.gauges()
+        with self._lock:
+            return {"durations": {name: {"count": histogram.count, "sum": histogram.sum}
+                                  for name, histogram in self._histograms.items()},
+                    "counters": dict(self._counters),
+                    "gauges": gauges,
+                    "peak_rss_bytes": self.peak_rss_bytes()}
+
+    def render_prometheus(self) -> str:
+        """
+        All the metrics in the Prometheus text exposition format.
+        """
+        lines: List[str] = ["# HELP pipeline_duration_seconds Duration of the pipeline stages and hot functions.",
+                            "# TYPE pipeline_duration_seconds histogram"]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                    lines.append(f'pipeline_duration_seconds_bucket{{name="{name}",le="{bound}"}} {count}')
+                lines.append(f'pipeline_duration_seconds_bucket{{name="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'pipeline_duration_seconds_sum{{name="{name}"}} {histogram.sum}')
+                lines.append(f'pipeline_duration_seconds_count{{name="{name}"}} {histogram.count}')
+            lines += ["# HELP pipeline_items_total Items processed by the pipeline.",
+                      "# TYPE pipeline_items_total counter"]
+            for name, value in sorted(self._counters.items()):
+                lines.append(f'pipeline_items_total{{name="{name}"}} {value}')
+        lines += ["# HELP pipeline_component_value Stats of the models, caches and stores of the process.",
+                  "# TYPE pipeline_component_value gauge"]
+        for component, values in sorted(self.gauges().items()):
+            for name, value in sorted(values.items()):
+                lines.append(f'pipeline_component_value{{component="{component}",name="{name}"}} {value}')
+        lines += ["# HELP process_peak_rss_bytes Peak resident memory of the process.",
+                  "# TYPE process_peak_rss_bytes gauge",
+                  f"process_peak_rss_bytes {self.peak_rss_bytes()}"]
+        return "\n".join(lines) + "\n"
+
+
+def _numeric_values(stats: dict, prefix: str = "") -> Dict[str, float]:
+    values = {}
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            values[prefix + key] = int(value)
+        elif isinstance(value, (int, float)):
+            values[prefix + key] = value
+        elif isinstance(value, dict):
+            values.update(_numeric_values(value, prefix=f"{prefix}{key}_"))
+    return values
+
+
+async def run_in_executor(function, *args):
+    """
+    `loop.run_in_executor` on the default executor, keeping the context so that the timers
+    of the function count in the timings of the current request.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, function, *args))
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import onnxruntime
+
+from core.config import global_params, logger
+from core.metrics import metrics
+
+
+def available_providers(requested: Optional[Sequence[str]] = None) -> List[str]:
+    """
+    Filter a list of execution providers down to the ones installed on this host.
+
+    Parameters:
+    - requested: Sequence[str], providers in order of preference. Defaults to `global_params.EP_list`.
+
+    Returns:
+    - List[str]: providers that onnxruntime can actually use, in the requested order.
+      Falls back to the CPU provider if none of the requested ones are available.
+    """
+    requested = list(requested if requested is not None else global_params.EP_list)
+    installed = set(onnxruntime.get_available_providers())
+    providers = [provider for provider in requested if provider in installed]
+    return providers or ['CPUExecutionProvider']
+
+
+GRAPH_OPTIMIZATION_LEVELS = {"disable_all": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                             "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                             "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                             "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL}
+EXECUTION_MODES = {"sequential": onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+                   "parallel": onnxruntime.ExecutionMode.ORT_PARALLEL}
+
+
+def inference_profile(name: Optional[str] = None) -> dict:
+    """
+    Settings of a named inference profile of `global_params.onnx_profiles`.
+
+    Parameters:
+    - name: str, name of the profile. Defaults to `global_params.onnx_profile`.
+
+    Returns:
+    - dict: optimization, intra_op_threads, inter_op_threads, execution_mode, cpu_mem_arena, mem_pattern and providers.
+    """
+    name = name or global_params.onnx_profile
+    if name not in global_params.onnx_profiles:
+        raise ValueError(f"Unknown onnx profile {name}, expected one of {sorted(global_params.onnx_profiles)}")
+    return global_params.onnx_profiles[name]
+
+
+def session_options(profile: Optional[str] = None, **overrides) -> onnxruntime.SessionOptions:
+    """
+    Session options of an inference profile, with some of its settings overridden, e.g. `intra_op_threads`.
+    """
+    settings = {**inference_profile(profile), **overrides}
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[settings["optimization"]]
+    options.intra_op_num_threads = settings["intra_op_threads"]
+    options.inter_op_num_threads = settings["inter_op_threads"]
+    options.execution_mode = EXECUTION_MODES[settings["execution_mode"]]
+    options.enable_cpu_mem_arena = settings["cpu_mem_arena"]
+    options.enable_mem_pattern = settings["mem_pattern"]
+    return options
+
+
+def profile_providers(profile: Optional[str] = None) -> List[str]:
+    """
+    Installed providers of an inference profile, `global_params.EP_list` for the profiles without their own.
+    """
+    return available_providers(inference_profile(profile)["providers"])
+
+
+def create_session(model_path: str, profile: Optional[str] = None,
+                   providers: Optional[Sequence[str]] = None, **overrides) -> onnxruntime.InferenceSession:
+    """
+    A new session of a model with the settings of an inference profile, outside of the registry.
+    """
+    return onnxruntime.InferenceSession(model_path,
+                                        sess_options=session_options(profile, **overrides),
+                                        providers=available_providers(providers) if providers is not None
+                                                  else profile_providers(profile))
+
+
+class _SessionEntry():
+    def __init__(self, session: onnxruntime.InferenceSession, model_path: str, profile: str,
+                 providers: List[str], load_time: float):
+        self.session = session
+        self.model_path = model_path
+        self.profile = profile
+        self.providers = providers
+        self.load_time = load_time
+        self.runs = 0
+
+
+class OnnxSessionRegistry():
+    """
+    Process-wide registry of onnxruntime sessions.
+
+    Each model is loaded (and graph-optimized) once per process, keyed by its
+    absolute path, its inference profile (see `inference_profile`) and the list
+    of execution providers. `InferenceSession.run`
+    is safe to call from several threads at once, so the same warm session is
+    shared by every request and every worker thread.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[Tuple[str, str, Tuple[str, ...]], _SessionEntry] = {}
+        self._lock = threading.Lock()
+        self._load_locks: Dict[Tuple[str, str, Tuple[str, ...]], threading.Lock] = {}
+
+    @staticmethod
+    def _key(model_path: str, providers: Optional[Sequence[str]],
+             profile: Optional[str]) -> Tuple[str, str, Tuple[str, ...]]:
+        profile = profile or global_params.onnx_profile
+        providers = available_providers(providers) if providers is not None else profile_providers(profile)
+        return os.path.abspath(os.path.normpath(model_path)), profile, tuple(providers)
+
+    def _entry(self, model_path: str, providers: Optional[Sequence[str]] = None,
+               profile: Optional[str] = None) -> _SessionEntry:
+        key = self._key(model_path, providers, profile)
+        entry = self._sessions.get(key)
+        if entry is not None:
+            return entry
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        # Only one thread loads a given model, the others wait for it instead of loading a copy.
+        with load_lock:
+            entry = self._sessions.get(key)
+            if entry is not None:
+                return entry
+            path, profile, provider_list = key
+            start_time = time.perf_counter()
+            session = create_session(path, profile=profile, providers=list(provider_list))
+            load_time = time.perf_counter() - start_time
+            entry = _SessionEntry(session, path, profile, list(provider_list), load_time)
+            with self._lock:
+                self._sessions[key] = entry
+            logger.info(f"Loaded onnx model {path} with the {profile} profile and {list(provider_list)} "
+                        f"in {load_time:.3f}s ({len(self._sessions)} sessions loaded)")
+        return entry
+
+    def get(self, model_path: str, providers: Optional[Sequence[str]] = None,
+            profile: Optional[str] = None) -> onnxruntime.InferenceSession:
+        """
+        Return the shared session of a model, loading it on first use.
+        """
+        return self._entry(model_path, providers, profile).session
+
+    def run(self, model_path: str,
+            feeds: Dict[str, np.ndarray],
+            output_names: Optional[List[str]] = None,
+            providers: Optional[Sequence[str]] = None,
+            profile: Optional[str] = None) -> List[np.ndarray]:
+        """
+        Run a model through its shared session.
+
+        Parameters:
+        - model_path: str, path of the onnx model.
+        - feeds: Dict[str, np.ndarray], input name to input tensor.
+        - output_names: List[str], outputs to fetch. Defaults to all outputs.
+        - providers: Sequence[str], execution providers. Defaults to the ones of the profile.
+        - profile: str, inference profile. Defaults to `global_params.onnx_profile`.
+
+        Returns:
+        - List[np.ndarray]: the requested outputs.
+        """
+        entry = self._entry(model_path, providers, profile)
+        outputs = entry.session.run(output_names, feeds)
+        with self._lock:
+            entry.runs += 1
+        return outputs
+
+    def preload(self, model_paths: Sequence[str], providers: Optional[Sequence[str]] = None,
+                profile: Optional[str] = None) -> None:
+        """
+        Load a list of models ahead of the first request.
+        """
+        for model_path in model_paths:
+            self._entry(model_path, providers, profile)
+
+    def stats(self) -> dict:
+        """
+        Number of loaded sessions along with the load time and run count of each one.
+        """
+        with self._lock:
+            entries = list(self._sessions.values())
+        return {
+            "session_count": len(entries),
+            "total_load_time": sum(entry.load_time for entry in entries),
+            "total_runs": sum(entry.runs for entry in entries),
+            "sessions": [
+                {"model_path": entry.model_path,
+                 "profile": entry.profile,
+                 "providers": entry.providers,
+                 "load_time": entry.load_time,
+                 "runs": entry.runs}
+                for entry in entries
+            ],
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._sessions.clear()
+            self._load_locks.clear()
+
+
+session_registry = OnnxSessionRegistry()
+metrics.register_gauges("onnx_sessions", session_registry.stats)
@@ -1,17 +1,16 @@
 import os
-from PIL import Image
 import numpy as np 
 import shutil 
+import cv2
 from core.config import global_params, logger
-import logging
-
-logger_active = logger.isEnabledFor(logging.DEBUG)
+from core.debug_artifacts import debug_artifacts
+from core.boxes import BoxSet
 
 def split_image_into_sections(image, image_name):
     """
-    Splits an image into sections of specified size and saves the sections.
+    Splits an image into sections of specified size, the sections are views of the image.
 
-    This function divides a given image into smaller sections based on the specified section size. Each section is saved as a separate image file. The function also generates a list of these sections and their corresponding locations in the original image.
+    This function divides a given image into smaller sections based on the specified section size. When the debug artifacts are on, a sample of the sections is saved in the background. The function also generates a list of these sections and their corresponding locations in the original image.
 
     Args:
     - image (numpy.ndarray): The image to be split, in the form of a numpy array.
@@ -29,6 +28,8 @@ def split_image_into_sections(image, image_name):
     y_max, x_max, _ = image.shape
     x_step = min(x_step,x_max) # Handle images of lower size than the section 
     y_step = min(y_step,y_max)
+    if(debug_artifacts.enabled):
+        save_sections_path = f'{global_params.temp_dir}/sections/{os.path.splitext(image_name)[0]}'
 
 
     count = 0 
@@ -38,15 +39,43 @@ def split_image_into_sections(image, image_name):
             x_end = min(x + x_step, x_max)
             section = image[y:y_end, x:x_end]
             sections.append(section)
-            if(logger_active):
-                image_name = os.path.splitext(image_name)[0]
-                save_sections_path = f'{global_params.temp_dir}/sections/{image_name}'
-                os.makedirs(save_sections_path, exist_ok=True)
-                Image.fromarray(section).save(f'{save_sections_path}/section_{count}.jpg')
+            if(debug_artifacts.sampled(count)):
+                debug_artifacts.write_image(f'{save_sections_path}/section_{count}.jpg', section, rgb=True, copy=False)
             count+=1
             locations.append([(y, y_end), (x, x_end)])
     return save_sections_path, sections, locations
 
+def find_blank_sections(sections, intensity_threshold=None, dark_pixel_value=None):
+    """
+    Flags the sections which have no ink, they can be skipped by the detector.
+
+    A pixel is ink when its gray value is below `dark_pixel_value`. A section is blank when the
+    share of ink pixels is not above `intensity_threshold`, so a threshold of 0 only skips sections
+    without a single dark pixel.
+
+    Args:
+    - sections (list): A list of numpy arrays (RGB) representing the image sections.
+    - intensity_threshold (float): Share of ink pixels a section needs to be processed. Defaults to `global_params.intensity_threshold`.
+    - dark_pixel_value (int): Gray value under which a pixel counts as ink. Defaults to `global_params.dark_pixel_value`.
+
+    Returns:
+    - numpy.ndarray: Boolean array, True for the blank sections.
+    """
+    if intensity_threshold is None:
+        intensity_threshold = global_params.intensity_threshold
+    if dark_pixel_value is None:
+        dark_pixel_value = global_params.dark_pixel_value
+
+    blank = np.zeros(len(sections), dtype=bool)
+    for i, section in enumerate(sections):
+        if section.size == 0:
+            blank[i] = True
+            continue
+        gray = cv2.cvtColor(section, cv2.COLOR_RGB2GRAY)
+        _, ink = cv2.threshold(gray, dark_pixel_value - 1, 255, cv2.THRESH_BINARY_INV)
+        blank[i] = cv2.countNonZero(ink) <= intensity_threshold * gray.size
+    return blank
+
 def patch_sections_together(sections, original_size, locations):
     """
     Reconstructs an image from its section arrays.
@@ -76,22 +105,15 @@ def adjust_bounding_boxes(processed_boxes, locations):
     Adjust bounding boxes from sections to the complete image.
 
     Parameters:
-    - processed_boxes (list): Nested list of bounding boxes for each section.
+    - processed_boxes (BoxSet or list): Boxes relative to their section, with their `section_ids`, or a nested list of ((x1, y1), (x2, y2)) for each section.
     - locations (list): List of tuples indicating the locations of each section in the original image.
 
     Returns:
-    - list: Adjusted bounding boxes for the complete image.
+    - BoxSet: Adjusted bounding boxes for the complete image.
     """
-    adjusted_boxes = []
-
-    for section_index, section_boxes in enumerate(processed_boxes):
-        # Get the offset for the current section from the locations list
-        (y1, y2), (x1, x2) = locations[section_index]
-
-        for box in section_boxes:
-            # Adjust each box
-            (bx1, by1), (bx2, by2) = box
-            adjusted_box = ((bx1 + x1, by1 + y1), (bx2 + x1, by2 + y1))
-            adjusted_boxes.append(adjusted_box)
-
-    return adjusted_boxes
+    if not isinstance(processed_boxes, BoxSet):
+        processed_boxes = BoxSet.from_section_boxes(processed_boxes)
+    # (x1, y1) of each section, every box is moved by the one of its section at once
+    section_offsets = np.array([(x1, y1) for (y1, _), (x1, _) in locations], dtype=np.int64).reshape(-1, 2)
+    offsets = section_offsets[processed_boxes.section_ids]
+    return processed_boxes.offset(offsets[:, 0], offsets[:, 1])
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+import uuid
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from core.config import global_params, logger
+from core.metrics import metrics
+
+
+class RenderedPageCache():
+    """
+    On-disk cache of rendered pdf pages stored as raw `.npy` files.
+
+    Pages are keyed by the hash of the pdf bytes, the page number and the dpi. A hit maps
+    the file back with `np.load(mmap_mode='c')`: nothing is read up front, the OS pages the
+    pixels in as they are used and writes (e.g. drawn boxes) stay private to the process.
+    The least recently used pages are evicted once the cache grows over `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(pdf_bytes: bytes, page_num: int, dpi: int) -> str:
+        return f"{hashlib.sha256(pdf_bytes).hexdigest()}_page{page_num}_dpi{dpi}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """
+        Returns the cached page as a copy-on-write memory map, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            page_image = np.load(path, mmap_mode='c')
+            os.utime(path) # Mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return page_image
+
+    def put(self, key: str, shape: Tuple[int, int, int], render: Callable[[np.ndarray], None]) -> np.ndarray:
+        """
+        Renders a page straight into a new cache file and returns it mapped like `get`.
+
+        Parameters:
+        - key: str, key of the page, see `make_key`.
+        - shape: Tuple[int, int, int], (height, width, 3) of the rendered page.
+        - render: Callable, fills the uint8 array it is given with the page pixels.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}.npy.tmp")
+        try:
+            page_image = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+            render(page_image)
+            page_image.flush()
+            del page_image
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+        return np.load(path, mmap_mode='c')
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used pages until the cache fits in `max_bytes`.
+        """
+        with self._lock:
+            try:
+                entries = [entry for entry in os.scandir(self.cache_dir)
+                           if entry.is_file() and entry.name.endswith(".npy")]
+            except FileNotFoundError:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            total_bytes = sum(entry.stat().st_size for entry in entries)
+            for entry in entries:
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path) # Pages already mapped by a request stay readable until unmapped
+                    total_bytes -= size
+                    self.evictions += 1
+                    logger.debug(f"Evicted rendered page {entry.name} from the page cache")
+                except FileNotFoundError:
+                    pass
+
+    def disk_usage(self) -> Tuple[int, int]:
+        """
+        Number of cached pages and their size in bytes.
+        """
+        try:
+            sizes = [entry.stat().st_size for entry in os.scandir(self.cache_dir)
+                     if entry.is_file() and entry.name.endswith(".npy")]
+        except FileNotFoundError:
+            return 0, 0
+        return len(sizes), sum(sizes)
+
+    def stats(self) -> dict:
+        pages, size = self.disk_usage()
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "pages": pages,
+                "bytes": size,
+            }
+
+
+page_cache = RenderedPageCache(cache_dir=global_params.page_cache_dir,
+                               max_bytes=global_params.page_cache_max_bytes)
+metrics.register_gauges("page_cache", page_cache.stats)
@@ -3,16 +3,17 @@ from core.config import global_params, logger
 from PIL import Image
 from fastapi import HTTPException, UploadFile
 import numpy as np 
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 from io import BytesIO
 from .getimages import split_image_into_sections
+from .page_cache import page_cache
+from core.metrics import metrics, run_in_executor
+from core.debug_artifacts import debug_artifacts
 import fitz
 import aiofiles
 import shutil 
 import logging
 
-logger_active = logger.isEnabledFor(logging.DEBUG)
-
 def get_images_from_pdf(pdf_file_path: str, 
                         dpi: int = 200) -> List[Image.Image]:
     """
@@ -54,12 +55,104 @@ def get_images_from_pdf(pdf_file_path: str,
     return images
 
 
+def get_page_size(page: fitz.Page, dpi: int) -> Tuple[int, int]:
+    """
+    Size (height, width) in pixels of a page rendered at the given dpi, same as `page.get_pixmap(dpi=dpi)`.
+    """
+    zoom = dpi / 72.0
+    irect = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return irect.height, irect.width
+
+
+def iter_page_tiles(page: fitz.Page,
+                    dpi: int,
+                    section_size: Tuple[int, int] = None) -> Iterator[Tuple[np.ndarray, list]]:
+    """
+    Renders a page section by section instead of as a single pixmap.
+
+    The page is parsed once into a display list, then every section is rasterized on its own with a
+    clip rectangle, so only the objects crossing the section are drawn. Tiles are produced lazily,
+    the memory in use is bounded by the tiles the caller keeps rather than by the page size.
+
+    Parameters:
+    page (fitz.Page): The page to render.
+    dpi (int): Dots Per Inch (DPI) used for rendering.
+    section_size (Tuple[int, int]): (width, height) of the sections. Defaults to `global_params.section_size`.
+
+    Yields:
+    Tuple[np.ndarray, list]: The RGB section and its location [(y1, y2), (x1, x2)] in the page, in the
+                             order of `split_image_into_sections`. The section is a read-only view of the
+                             pixmap samples, only valid until the next section is requested: copy it to keep it.
+    """
+    zoom = dpi / 72.0
+    matrix = fitz.Matrix(zoom, zoom)
+    inverse = ~matrix
+    display_list = page.get_displaylist()
+    y_max, x_max = get_page_size(page, dpi)
+    x_step, y_step = global_params.section_size if section_size is None else section_size
+    x_step = min(x_step, x_max)
+    y_step = min(y_step, y_max)
+
+    for y in range(0, y_max, y_step):
+        for x in range(0, x_max, x_step):
+            y_end = min(y + y_step, y_max)
+            x_end = min(x + x_step, x_max)
+            clip = fitz.Rect(x, y, x_end, y_end) * inverse
+            # `pix` owns the samples the tile is a view of, it is only released once the next tile is rendered
+            pix = display_list.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+            tile = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+            tile.flags.writeable = False
+            if tile.shape[:2] != (y_end - y, x_end - x):
+                # Rounding of the clip can be off by a pixel, pad with white to the expected size
+                padded = np.full((y_end - y, x_end - x, 3), 255, dtype=np.uint8)
+                h, w = min(tile.shape[0], y_end - y), min(tile.shape[1], x_end - x)
+                padded[:h, :w] = tile[:h, :w, :3]
+                tile = padded
+            yield tile, [(y, y_end), (x, x_end)]
+
+
+def render_page(page: fitz.Page, dpi: int, section_size: Tuple[int, int] = None, out: np.ndarray = None) -> np.ndarray:
+    """
+    Renders a page into a single RGB array by writing the tiles of `iter_page_tiles` into it.
+
+    This avoids the full page pixmap and its PNG encode/decode, the page buffer is the only page sized allocation.
+    `out` can be given to render into an existing (height, width, 3) uint8 buffer, e.g. a memory mapped file.
+    """
+    height, width = get_page_size(page, dpi)
+    page_image = np.empty((height, width, 3), dtype=np.uint8) if out is None else out
+    for tile, ((y1, y2), (x1, x2)) in iter_page_tiles(page, dpi, section_size):
+        page_image[y1:y2, x1:x2] = tile
+    return page_image
+
+
 async def process_pdf(file: UploadFile, page_num: int = 1) -> Tuple[str, List[str], List[np.ndarray], List[tuple], int, str]:
+    """
+    Process an uploaded PDF file, see `process_pdf_bytes`.
+    """
+    pdf_bytes = await file.read()
+    return await process_pdf_bytes(pdf_bytes, filename=file.filename, page_num=page_num)
+
+
+async def process_pdf_bytes(pdf_bytes: bytes, filename: str, page_num: int = 1) -> Tuple[str, List[str], List[np.ndarray], List[tuple], int, str]:
+    """
+    Process a PDF file off the event loop, see `process_pdf_bytes_sync`.
+
+    Rendering a page at 600 dpi takes seconds, the loop keeps answering the other requests
+    (job status, cancellation, progress events) in the meantime.
+    """
+    return await run_in_executor(process_pdf_bytes_sync, pdf_bytes, filename, page_num)
+
+
+def process_pdf_bytes_sync(pdf_bytes: bytes, filename: str, page_num: int = 1) -> Tuple[str, List[str], List[np.ndarray], List[tuple], int, str]:
     """
     Process a PDF file to extract a specific page as an image, handling the file in memory.
 
+    Rendered pages are kept in the on-disk `page_cache`, a page already rendered at the same dpi
+    is mapped back from the cache without opening the PDF.
+
     Args:
-    - file (UploadFile): An uploaded file object from FastAPI.
+    - pdf_bytes (bytes): Content of the PDF file.
+    - filename (str): Name of the PDF file, used to name the debug outputs.
     - page_num (int): The page number to extract from the PDF. Defaults to 1.
 
     Returns:
@@ -74,32 +167,43 @@ async def process_pdf(file: UploadFile, page_num: int = 1) -> Tuple[str, List[st
       
     selected_page_image_path = ""
     try:
-        # Read PDF into memory
-        pdf_bytes = await file.read()
-        pdf_stream = BytesIO(pdf_bytes)
-        doc = fitz.open(stream=pdf_stream, filetype="pdf")
-
-        if page_num < 1 or page_num > len(doc):
-            raise HTTPException(status_code=400, detail="Invalid page number")
-
-        # Extract the specified page
-        page = doc.load_page(page_num - 1)
-        pix = page.get_pixmap(dpi= global_params.dpi)
-        img = Image.open(BytesIO(pix.tobytes("png")))
+        selected_page_image = None
+        if global_params.page_cache_enabled:
+            cache_key = page_cache.make_key(pdf_bytes, page_num, global_params.dpi)
+            selected_page_image = page_cache.get(cache_key)
+            logger.info(f"Page cache {'hit' if selected_page_image is not None else 'miss'} for page {page_num} of {filename}, {page_cache.stats()}")
+
+        if selected_page_image is None:
+            pdf_stream = BytesIO(pdf_bytes)
+            doc = fitz.open(stream=pdf_stream, filetype="pdf")
+
+            if page_num < 1 or page_num > len(doc):
+                raise HTTPException(status_code=400, detail="Invalid page number")
+
+            # Extract the specified page, section by section
+            page = doc.load_page(page_num - 1)
+            with metrics.timer("render"):
+                if global_params.page_cache_enabled:
+                    height, width = get_page_size(page, global_params.dpi)
+                    selected_page_image = page_cache.put(cache_key, (height, width, 3),
+                                                         lambda out: render_page(page, dpi=global_params.dpi,
+                                                                                 section_size=global_params.section_size,
+                                                                                 out=out))
+                else:
+                    selected_page_image = render_page(page, dpi=global_params.dpi, section_size=global_params.section_size)
+            doc.close()
 
         # Optionally save the extracted page for debugging
-        if logger_active:
-            os.makedirs(global_params.temp_dir, exist_ok=True)
-            selected_page_image_path = os.path.join(global_params.temp_dir, f'{file.filename}_page_{page_num}.png')
-            img.save(selected_page_image_path, 'PNG')
-
-        selected_page_image = np.array(img)
-
-        # Split image into sections
-        save_sections_path, sections, locations = split_image_into_sections(
-            image=selected_page_image, 
-            image_name=file.filename
-        )
+        if debug_artifacts.enabled:
+            selected_page_image_path = os.path.join(global_params.temp_dir, f'{filename}_page_{page_num}.png')
+            debug_artifacts.write_image(selected_page_image_path, selected_page_image, rgb=True, copy=False)
+
+        # Split image into sections, the sections are views of the page
+        with metrics.timer("tiling"):
+            save_sections_path, sections, locations = split_image_into_sections(
+                image=selected_page_image, 
+                image_name=filename
+            )
 
         return selected_page_image,selected_page_image_path, save_sections_path, sections, locations
     except Exception as ex:
@@ -0,0 +1,336 @@
+from models import ProcessPDFTemplateMatchingResponse2, LegendTemplateResponse2
+from core.pdf_to_images.processpdf import process_pdf_bytes
+from core.detection.symbol.process_symbols import detect_symbols
+from core.pdf_to_images.getimages import adjust_bounding_boxes
+from core.detection.page_nms import deduplicate_page_boxes
+from core.template_similarity.dino_vectorbase import match_templates
+from core.detection.legend.process_legend import detection_legend_bytes
+from core.config import global_params, logger
+from core.artifacts import PlanArtifacts, artifact_store, crop_url, page_url
+from core.image_encoding import EncodingReport, image_encoder
+from core.metrics import metrics, run_in_executor
+from core.debug_artifacts import debug_artifacts
+from core.boxes import BoxSet
+from typing import Awaitable, Callable, Optional, List, Tuple
+import os
+import cv2
+import numpy as np
+import asyncio
+import threading
+import time
+import logging
+
+
+class PlanCancelled(Exception):
+    """
+    Raised inside the pipeline once the processing of a plan has been cancelled.
+    """
+
+
+class PlanProgress():
+    """
+    Progress of a plan through the stages of the pipeline.
+
+    Stages are `queued`, `render`, `legend_detection`, `symbol_detection`, `template_matching`,
+    `response` and `done`. It is updated from the event loop and from the detection threads,
+    every update raises `PlanCancelled` once `cancel` has been called so that the work stops
+    at the next batch.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.stage = "queued"
+        self.counters = {"tiles_detected": 0,
+                         "tiles_total": 0,
+                         "legend_symbols": 0,
+                         "templates_matched": 0,
+                         "templates_total": 0}
+        self.updated_at = time.time()
+
+    def set_stage(self, stage: str, **counters) -> None:
+        self.check_cancelled()
+        with self._lock:
+            self.stage = stage
+            self.counters.update(counters)
+            self.updated_at = time.time()
+        logger.debug(f"Plan stage {stage}, {self.counters}")
+
+    def update(self, **counters) -> None:
+        self.check_cancelled()
+        with self._lock:
+            self.counters.update(counters)
+            self.updated_at = time.time()
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check_cancelled(self) -> None:
+        if self._cancelled.is_set():
+            raise PlanCancelled(f"Cancelled during {self.stage}")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"stage": self.stage, **self.counters, "updated_at": self.updated_at}
+
+
+async def process_symbols_detection(image: np.ndarray,
+                                  sections_in_folder: str ,
+                                  sections_list: List[np.ndarray],
+                                  locations_sections: List[Tuple[int, int]],
+                                  progress: Optional[PlanProgress] = None) -> Tuple[BoxSet, int]:
+    """
+    Detect the symbols of the sections and merge their boxes over the page.
+
+    Nothing is drawn on the page or its sections, the boxes are drawn once at the end from the final
+    box set (see `PlanArtifacts.page`), only when the annotated page is asked for or to debug.
+
+    Parameters:
+    - image (np.ndarray): Original complete image, the sections are views of it.
+    - sections_list (str): List of numpy array of image sections.
+    - locations_sections (List[Tuple[int, int]]): Locations of the sections in the original image.
+    - progress (PlanProgress): Optional progress, updated with the number of tiles detected.
+
+    Returns:
+    - Tuple[BoxSet, int]: Adjusted bounding boxes and the number of blank sections skipped by the detector.
+
+    Raises:
+    - FileNotFoundError: If the image file or sections are not found.
+    - PlanCancelled: If the plan is cancelled during the detection.
+    - Exception: For other processing errors.
+    """
+
+    logger.debug(f"Full image shape {image.shape}")
+    logger.debug(f"Sucessfully processed the patches of the image, found {len(sections_list)} sections")
+    processed_boxes = BoxSet()
+    sections_skipped = 0
+    tiles_progress = None
+    if progress is not None:
+        tiles_progress = lambda done, total: progress.update(tiles_detected=done, tiles_total=total)
+    # Step2: Process each section for template matching
+    try:
+      processed_boxes, sections_skipped = await detect_symbols(sections_list, progress=tiles_progress,
+                                                               page=image, locations=locations_sections)
+    except PlanCancelled:
+        raise
+    except Exception as ex:
+        logger.info(f"Got error while performing detection of symbols: {ex}")
+
+    logger.debug(f"Detected {len(processed_boxes)} symbols in the complete plan.")
+    if(debug_artifacts.enabled):
+        debug_artifacts.write_json(sections_in_folder+f"/processed/all-symbol-detected.json",
+                                   {f"section_bbox-{i}": processed_boxes.of_section(i).to_tuples() for i in range(len(sections_list))})
+
+    # Step3: Put together everything wrt to the original image
+    # Step3.1: Adjust the bounding boxes of the sections to get bounding boxes wrt. to complete image.
+    adjusted_boxes = adjust_bounding_boxes(processed_boxes, locations_sections)
+    logger.debug("adjusting boxes")
+    # Step3.2: Draw the boxes of the sections on a copy of the page, only needed to debug
+    if(debug_artifacts.enabled):
+        process_complete_image = image.copy()
+        for x_min, y_min, x_max, y_max in adjusted_boxes.xyxy.tolist():
+            cv2.rectangle(process_complete_image, (x_min, y_min), (x_max, y_max), (255, 0, 0), 2)
+        debug_artifacts.write_image(sections_in_folder+f"/processed/all-symbols-detected.png",process_complete_image, copy=False)
+        debug_artifacts.write_image(f"static/images/all_result.png",process_complete_image, copy=False)
+
+    # Step3.3: Merge the symbols cut by the section borders and run one NMS over the whole page
+    if(len(adjusted_boxes) > 0):
+        with metrics.timer("page_nms"):
+            page_boxes, page_scores = deduplicate_page_boxes(adjusted_boxes.xyxy,
+                                               adjusted_boxes.scores,
+                                               locations_sections,
+                                               iou_threshold=global_params.nms_threshold,
+                                               seam_tolerance=global_params.seam_tolerance)
+        logger.debug(f"Kept {len(page_boxes)} out of {len(adjusted_boxes)} symbols after the page level NMS")
+        # Merged boxes may span several sections
+        adjusted_boxes = BoxSet(page_boxes, scores=page_scores)
+
+    if(debug_artifacts.enabled):
+        debug_artifacts.write_json(sections_in_folder+f"/processed/adjusted_symbols.json",
+                                   {f"bbox-{i}": box for i, box in enumerate(adjusted_boxes.to_tuples())})
+
+    return adjusted_boxes, sections_skipped
+
+
+async def process_plan(pdf_bytes: bytes,
+                       pdf_filename: str,
+                       legend_bytes: bytes,
+                       page_num: int = 1,
+                       progress: Optional[PlanProgress] = None,
+                       on_template: Optional[Callable[[int, List[LegendTemplateResponse2]], Awaitable[None]]] = None,
+                       inline_crops: bool = False,
+                       include_timings: bool = False) -> ProcessPDFTemplateMatchingResponse2:
+    """
+    Match the symbols of a legend against a page of a PDF plan.
+
+    Shared by the `/process_complete_plan` route and the job API, see the route for the details of the response.
+
+    Parameters:
+    - pdf_bytes (bytes): Content of the PDF file of the plan.
+    - pdf_filename (str): Name of the PDF file.
+    - legend_bytes (bytes): Content of the legend image file.
+    - page_num (int): Page of the PDF to process.
+    - progress (PlanProgress): Optional progress, updated at every stage.
+    - on_template (Callable): Optional coroutine awaited with the index of each legend symbol and its responses, as soon as they are built.
+    - inline_crops (bool): Also put the PNG of each crop in `mask_base64`, otherwise clients fetch it from its `crop_url`.
+    - include_timings (bool): Put the seconds spent in each stage and hot function in the `timings` of the response.
+
+    Returns:
+    - ProcessPDFTemplateMatchingResponse2: The matched symbols.
+
+    Raises:
+    - HTTPException: If the PDF or the legend can not be processed.
+    - PlanCancelled: If the plan is cancelled.
+    """
+    with metrics.request_timings() as timings, debug_artifacts.request(f"{pdf_filename} page {page_num}"):
+        with metrics.timer("plan"):
+            response = await _process_plan(pdf_bytes=pdf_bytes,
+                                           pdf_filename=pdf_filename,
+                                           legend_bytes=legend_bytes,
+                                           page_num=page_num,
+                                           progress=progress,
+                                           on_template=on_template,
+                                           inline_crops=inline_crops)
+    metrics.inc("plans")
+    logger.info(f"Plan {pdf_filename} page {page_num} timings: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items()))
+    if include_timings:
+        response.timings = dict(timings)
+    return response
+
+
+async def _process_plan(pdf_bytes: bytes,
+                        pdf_filename: str,
+                        legend_bytes: bytes,
+                        page_num: int,
+                        progress: Optional[PlanProgress],
+                        on_template: Optional[Callable[[int, List[LegendTemplateResponse2]], Awaitable[None]]],
+                        inline_crops: bool) -> ProcessPDFTemplateMatchingResponse2:
+    if progress is None:
+        progress = PlanProgress()
+
+    template_response = []
+
+    save_symbols_path = global_params.temp_dir
+    start_time = time.time()
+    # Step1: Get the sections of the page of the pdf which can be found in sections_in_folder
+    progress.set_stage("render")
+    process_pdf_response = await process_pdf_bytes(pdf_bytes,
+                                                   filename=pdf_filename,
+                                                   page_num=page_num)
+    selected_page_image, image_path, sections_in_folder,sections_nparray_list,locations_sections= process_pdf_response
+    logger.debug(f"Obtained {len(locations_sections)} sections from the pdf image")
+
+    if(debug_artifacts.enabled):
+        save_symbols_path = sections_in_folder+"/symbols"
+
+    logger.debug(f"Detecting symbols in legend image")
+    progress.set_stage("legend_detection", tiles_total=len(sections_nparray_list))
+    with metrics.timer("legend_detection"):
+        symbols_nparray_list = await detection_legend_bytes(legend_bytes,
+                                                            save_symbols_path=save_symbols_path)
+    metrics.inc("legend_symbols", len(symbols_nparray_list))
+
+    logger.debug(f"Detected {len(symbols_nparray_list)} symbols in the legend image")
+    progress.set_stage("symbol_detection",
+                       legend_symbols=len(symbols_nparray_list),
+                       templates_total=len(symbols_nparray_list))
+    all_adjusted_boxes, sections_skipped = await process_symbols_detection(selected_page_image,
+                                                                                      sections_in_folder,
+                                                                                      sections_nparray_list,
+                                                                                      locations_sections,
+                                                                                      progress=progress)
+    metrics.inc("tiles", len(sections_nparray_list))
+    metrics.inc("tiles_skipped", sections_skipped)
+    metrics.inc("candidates", len(all_adjusted_boxes))
+
+    # The crops and the annotated page are served from the artifact store when asked for
+    artifacts = PlanArtifacts(selected_page_image)
+    artifact_id = artifact_store.put(artifacts)
+    encoding_report = EncodingReport()
+    json_data = {}
+
+    # Step4: Match all the legend symbols at once, every candidate box goes to its nearest symbol
+    progress.set_stage("template_matching")
+    matched_boxes = await match_templates(boxes=all_adjusted_boxes,
+                                          full_image=selected_page_image,
+                                          target_template_list=symbols_nparray_list)
+    metrics.inc("matches", int((matched_boxes.symbol_types >= 0).sum()))
+    # The annotated page is drawn from the final boxes, see `draw_plan_boxes`
+    artifacts.boxes = matched_boxes
+
+    progress.set_stage("response")
+    for idx in range(len(symbols_nparray_list)):
+        # Step5: Build the response of each template with the bounding boxes wrt to the full complete image along with the bounding boxes drawn complete image
+        logger.debug(f"Processing template matching for symbol {idx+1} out of {len(symbols_nparray_list)}")
+        refined_bounding_boxes = matched_boxes.of_symbol_type(idx)
+
+        if(debug_artifacts.enabled):
+            json_data.update({f"template-{idx}":refined_bounding_boxes.to_tuples()})
+
+        responses_this_template = []
+        crop_indices = []
+        for (x, y, x_end, y_end), xywh, area in zip(refined_bounding_boxes.xyxy.tolist(),
+                                                    refined_bounding_boxes.to_xywh(),
+                                                    refined_bounding_boxes.areas.tolist()):
+            # Proceed only if the area is greater than 0
+            if area > 10:
+                crop_index = artifacts.add_crop((x, y, x_end, y_end))
+                response_this_template = LegendTemplateResponse2(crop_url=crop_url(artifact_id, crop_index),
+                                                                bbox=[xywh],
+                                                                 score=1.0,
+                                                                 point_coord=[(0.0,0.0)],
+                                                                 uncertain_iou=1.0,
+                                                                 area=area,
+                                                                 color=[(255,255,255)],
+                                                                 symbol_type=idx)
+                responses_this_template.append(response_this_template)
+                crop_indices.append(crop_index)
+        if inline_crops and crop_indices:
+            # The crops of the symbol are encoded in parallel, off the event loop
+            masks_base64 = await run_in_executor(image_encoder.encode_many_base64,
+                                                 [artifacts.crop(i) for i in crop_indices], None, encoding_report)
+            for response_this_template, mask_base64 in zip(responses_this_template, masks_base64):
+                response_this_template.mask_base64 = mask_base64
+        template_response.extend(responses_this_template)
+
+        logger.debug(f"Found {len(refined_bounding_boxes)} templates out of {len(matched_boxes)}")
+        logger.debug(f"Template matching completed for {idx+1} out of {len(symbols_nparray_list)}")
+        progress.update(templates_matched=idx + 1)
+        if on_template is not None:
+            await on_template(idx, responses_this_template)
+
+    total_time_taken = (time.time() - start_time)/60.0
+    if inline_crops:
+        encoding = encoding_report.as_dict()
+        logger.info(f"Encoded {encoding['images']} crops to {image_encoder.image_format}, "
+                    f"{encoding['bytes'] / 1024:.0f} KB in {encoding['encode_time']:.3f}s of encoder time")
+
+    if(debug_artifacts.enabled):
+        debug_artifacts.write_json(sections_in_folder+f"/processed/all-symbol-refined-detected.json", json_data)
+        all_symbols_drawn_image = artifacts.page(annotated=True)
+        debug_artifacts.write_image(sections_in_folder+f"/processed/all-symbols-refined-detected.png",all_symbols_drawn_image, copy=False)
+        debug_artifacts.write_image(f"static/images/result.png",all_symbols_drawn_image, copy=False)
+
+    if(len(template_response)==0):
+        response_this_template = LegendTemplateResponse2(mask_base64="",
+                                                        bbox=[(0,0,0,0)],
+                                                        score=1.0,
+                                                        point_coord=[(0.0,0.0)],
+                                                        uncertain_iou=1.0,
+                                                        area=0,
+                                                        color=[(255,255,255)],
+                                                        symbol_type=0)
+        template_response.append(response_this_template)
+
+    progress.set_stage("done")
+    return ProcessPDFTemplateMatchingResponse2(template_response=template_response,
+                                               processing_time=total_time_taken,
+                                               sections_total=len(sections_nparray_list),
+                                               sections_skipped=sections_skipped,
+                                               artifact_id=artifact_id,
+                                               page_url=page_url(artifact_id),
+                                               annotated_page_url=page_url(artifact_id, annotated=True))
@@ -0,0 +1,204 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from transformers import AutoModel
+
+from core.config import global_params, logger
+from core.template_similarity.embedding_cache import embedding_cache
+from core.metrics import metrics
+
+
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+# Side of the square patches of DINOv2
+PATCH_SIZE = 14
+
+
+def resized_size(height: int, width: int, img_size: int = 224) -> Tuple[int, int]:
+    """
+    (height, width) of a crop once its short side is resized to `img_size`, the long side keeps
+    the aspect ratio and is truncated like `torchvision.transforms.Resize(img_size)` does.
+    """
+    height, width = max(1, height), max(1, width)
+    if width <= height:
+        return int(img_size * height / width), img_size
+    return img_size, int(img_size * width / height)
+
+
+def patch_grid_size(height: int, width: int, img_size: int = 224, patch_size: int = PATCH_SIZE) -> Tuple[int, int]:
+    """
+    Part of the resized crop (see `resized_size`) the model sees: the patch embedding of DINOv2
+    drops the last rows and columns that do not fill a whole patch.
+    """
+    height, width = resized_size(height, width, img_size)
+    return max(patch_size, height - height % patch_size), max(patch_size, width - width % patch_size)
+
+
+def preprocess_crop_into(crop: np.ndarray, out: np.ndarray, img_size: int = 224) -> None:
+    """
+    Resize a crop so that its short side is `img_size`, keeping its aspect ratio, and write the
+    `patch_grid_size` part of it into `out`.
+
+    Same pixels as the `transforms.Resize(img_size)` the embeddings (and the similarity thresholds)
+    were made with: a bilinear PIL resize. The bilinear resize of cv2 rounds differently, off by one
+    on about a fifth of the pixels, which moves the distances more than `benchmarks/dino_preprocessing.py`
+    tolerates.
+
+    Parameters:
+    - crop: np.ndarray, RGB crop of any size (H x W x 3), or grayscale (H x W).
+    - out: np.ndarray, (H', W', 3) uint8 array of the `patch_grid_size` of the crop, e.g. a slot of a batch.
+    - img_size: int, side the short side is resized to.
+    """
+    if crop.ndim == 2:
+        crop = cv2.cvtColor(crop, cv2.COLOR_GRAY2RGB)
+    crop = crop[:, :, :3]
+    height, width = resized_size(*crop.shape[:2], img_size)
+    if (height, width) != crop.shape[:2]:
+        crop = np.asarray(Image.fromarray(np.ascontiguousarray(crop)).resize((width, height), Image.BILINEAR))
+    out[...] = crop[:out.shape[0], :out.shape[1]]
+
+
+def size_buckets(crops: List[np.ndarray], img_size: int = 224) -> Dict[Tuple[int, int], List[int]]:
+    """
+    Indices of the crops grouped by their `patch_grid_size`, crops of a bucket are batched together.
+
+    The short side is always `img_size` and the long side a whole number of patches, so there are
+    at most two buckets (portrait and landscape) per 14 pixels of long side, e.g. 65 up to an
+    aspect ratio of 3, whatever the number of crops.
+    """
+    buckets = defaultdict(list)
+    for i, crop in enumerate(crops):
+        buckets[patch_grid_size(*crop.shape[:2], img_size)].append(i)
+    return buckets
+
+
+def normalize_batch(batch: np.ndarray) -> np.ndarray:
+    """
+    Turn a (N, H, W, 3) uint8 batch into the normalized (N, 3, H, W) float32 input of DINOv2.
+    """
+    normalized = (batch.astype(np.float32) * (1.0 / 255.0) - IMAGENET_MEAN) / IMAGENET_STD
+    return np.ascontiguousarray(normalized.transpose(0, 3, 1, 2))
+
+
+class DinoBackbone():
+    """
+    Process-wide holder of the DINOv2 backbone used to embed symbol crops.
+
+    The model is loaded once, at startup or on first use, put in eval mode and warmed up
+    with a dummy forward pass. Every `VectorStore` shares it instead of loading its own copy.
+    """
+
+    def __init__(self, model_id: str, img_size: int = 224):
+        self.model_id = model_id
+        self.img_size = img_size
+        self.device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
+        self._model = None
+        self._lock = threading.Lock()
+        self.load_time = 0.0
+        self.warmup_time = 0.0
+        self.parameter_bytes = 0
+        self.crops_embedded = 0
+        self.forward_passes = 0
+
+    @property
+    def model(self) -> torch.nn.Module:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._load()
+        return self._model
+
+    def _load(self) -> torch.nn.Module:
+        start_time = time.perf_counter()
+        model = AutoModel.from_pretrained(self.model_id).to(self.device)
+        model.eval()
+        self.load_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        with torch.inference_mode():
+            model(pixel_values=torch.zeros((1, 3, self.img_size, self.img_size), device=self.device))
+        self.warmup_time = time.perf_counter() - start_time
+
+        self.parameter_bytes = sum(tensor.numel() * tensor.element_size()
+                                   for tensor in list(model.parameters()) + list(model.buffers()))
+        logger.info(f"Loaded {self.model_id} on {self.device} in {self.load_time:.2f}s, "
+                    f"warmup {self.warmup_time:.2f}s, {self.parameter_bytes / 1024**2:.0f} MB of weights")
+        return model
+
+    @property
+    def embedding_size(self) -> int:
+        return self.model.config.hidden_size
+
+    def embed(self, crops: List[np.ndarray], batch_size: int = 32) -> np.ndarray:
+        """
+        Embed crops with batched forward passes.
+
+        Crops are batched by the size the model sees once they are resized (see `size_buckets`),
+        each chunk of a bucket is resized into one preallocated array. Each resized crop is looked
+        up in the `embedding_cache` first, only the misses go through the model.
+
+        Parameters:
+        - crops: List[np.ndarray], RGB crops of any size.
+        - batch_size: int, number of crops per forward pass.
+
+        Returns:
+        - np.ndarray: (N, D) float32 matrix, the mean of the last hidden state of each crop.
+        """
+        model = self.model
+        use_cache = global_params.embedding_cache_enabled
+        embeddings = np.empty((len(crops), self.embedding_size), dtype=np.float32)
+        with torch.inference_mode():
+            for (height, width), indices in size_buckets(crops, self.img_size).items():
+                for start in range(0, len(indices), batch_size):
+                    chunk = indices[start:start + batch_size]
+                    resized = np.empty((len(chunk), height, width, 3), dtype=np.uint8)
+                    for i, crop_index in enumerate(chunk):
+                        preprocess_crop_into(crops[crop_index], resized[i], self.img_size)
+                    missing = list(range(len(chunk)))
+                    if use_cache:
+                        keys = [embedding_cache.make_key(image) for image in resized]
+                        missing = []
+                        for i, key in enumerate(keys):
+                            vector = embedding_cache.get(key)
+                            if vector is None:
+                                missing.append(i)
+                            else:
+                                embeddings[chunk[i]] = vector
+                    if not missing:
+                        continue
+                    batch = normalize_batch(resized[missing])
+                    outputs = model(pixel_values=torch.from_numpy(batch).to(self.device))
+                    vectors = outputs.last_hidden_state.mean(dim=1).float().cpu().numpy()
+                    self.forward_passes += 1
+                    for i, vector in zip(missing, vectors):
+                        embeddings[chunk[i]] = vector
+                        if use_cache:
+                            embedding_cache.put(keys[i], vector)
+        self.crops_embedded += len(crops)
+        return embeddings
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def stats(self) -> dict:
+        return {
+            "model_id": self.model_id,
+            "device": str(self.device),
+            "loaded": self.loaded,
+            "load_time": self.load_time,
+            "warmup_time": self.warmup_time,
+            "parameter_bytes": self.parameter_bytes,
+            "crops_embedded": self.crops_embedded,
+            "forward_passes": self.forward_passes,
+        }
+
+
+dino_backbone = DinoBackbone(model_id=global_params.dino_model_id)
+metrics.register_gauges("dino_backbone", dino_backbone.stats)
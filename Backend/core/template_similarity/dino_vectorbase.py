@@ -2,12 +2,14 @@ import numpy as np
 from core.config import global_params, logger
 import logging
 import torch
-from torchvision import transforms
-from transformers import AutoImageProcessor, AutoModel
+from core.template_similarity.dino_model import dino_backbone
+from core.metrics import metrics, run_in_executor
+from core.boxes import BoxSet
 from sklearn.decomposition import PCA
 import faiss
 import numpy as np
 import os
+import asyncio
 from PIL import Image ,ImageOps
 
 
@@ -38,58 +40,24 @@ def equalize_hist_rgb(img):
     
     return rgb_eq_img
 
-def transform_image(img,img_size=224):
-    """
-    Load an image and return a tensor that can be used as an input to DINOv2.
-    """
-    img = Image.fromarray(img)
-    #img = equalize_hist_rgb(img)
-
-    # img_gray = img.convert("L")
-    # img_thresholded = img_gray.point(lambda p: p > 20 and 255)
-    # img = img_thresholded.convert("RGB")
-
-    transform_image = transforms.Compose(
-            [
-                transforms.Resize(img_size),
-                transforms.ToTensor(),
-                transforms.Normalize(
-                    mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-                ),
-            ]
-        )
-
-    transformed_img = transform_image(img)[:3].unsqueeze(0)
-
-    return transformed_img
-
 class VectorStore():
+    @metrics.timed("VectorStore.__init__")
     def __init__(self,imgs, n_pca_components=10):
         self.imgs = imgs 
-        self.index = faiss.IndexFlatL2(1024)
+        self.index = faiss.IndexFlatL2(dino_backbone.embedding_size)
         self.n_pca_components = n_pca_components
-        #Load the model and processor
-        self.device = torch.device('cuda' if torch.cuda.is_available() else "cpu")
-        self.processor = AutoImageProcessor.from_pretrained('facebook/dinov2-large')
-        self.model = AutoModel.from_pretrained('facebook/dinov2-large').to(self.device)
+        # The backbone is loaded once per process and shared by all the vector stores
+        self.device = dino_backbone.device
+        self.model = dino_backbone.model
         self.pca = PCA(n_components=n_pca_components)
 
-        feature_vectors = []
-        for idx,image in enumerate(imgs):
-            with torch.no_grad():
-                inputs = {'pixel_values': transform_image(image).to(self.device)}
-                # inputs = self.processor(images=image, return_tensors="pt").to(self.device)
-                outputs = self.model(**inputs)
-            features = outputs.last_hidden_state
-            feature_vector = features.mean(dim=1).detach().cpu().numpy()
-            feature_vectors.append(feature_vector.squeeze(0))
-
-            if(n_pca_components==0):
-                self.add_vectors_to_index(feature_vector)
+        # All the crops are embedded with batched forward passes
+        feature_vectors = dino_backbone.embed(imgs, batch_size=global_params.dino_batch_size)
+        if(n_pca_components==0):
+            self.add_vectors_to_index(feature_vectors)
 
         if(n_pca_components!=0):
             # Fit PCA on extracted feature vectors
-            feature_vectors = np.array(feature_vectors)
             self.pca.fit(feature_vectors)
 
             # Transform feature vectors with PCA and add to FAISS index
@@ -104,17 +72,9 @@ class VectorStore():
         #Add to index
         self.index.add(feature_vector)
 
+    @metrics.timed("VectorStore.find_index")
     def find_index(self,given_image,threshold=0.34):
-        with torch.no_grad():
-            inputs = {'pixel_values': transform_image(given_image).to(self.device)}
-            # inputs = self.processor(images=given_image, return_tensors="pt").to(self.device)
-            outputs = self.model(**inputs)
-
-        #Normalize the features before search
-        embeddings = outputs.last_hidden_state
-        embeddings = embeddings.mean(dim=1)
-
-        vector = embeddings.detach().cpu().numpy()
+        vector = dino_backbone.embed([given_image])
         if(self.n_pca_components!=0):
             vector = self.pca.transform(vector)  # Transform with PCA
 
@@ -128,6 +88,19 @@ class VectorStore():
 
         #return matched_indices  # for find_matches_for_template function 
 
+    def find_index_batch(self,given_images,k=None):
+        """
+        Search several images with one embedding batch and one multi-query search.
+
+        Returns the (Q, k) distances and indices, k defaults to all the indexed crops.
+        """
+        vectors = dino_backbone.embed(given_images, batch_size=global_params.dino_batch_size)
+        if(self.n_pca_components!=0):
+            vectors = self.pca.transform(vectors)
+        vectors = np.float32(vectors)
+        faiss.normalize_L2(vectors)
+        return self.index.search(vectors, k or self.index.ntotal)
+
 def offset_bboxes(bbox,full_image,offset = 10):
     (x, y), (x_end, y_end) = bbox
     area = (x_end - x) * (y_end - y)
@@ -174,99 +147,50 @@ def rotate_image(image, angle):
     else:
         return image
 
-def find_matches_for_template(boxes,target_template, vectorstore):
+def rotated_queries(target_template_list, angles=None):
+    """
+    All the rotations of all the templates, with the template index of each one.
+    """
+    if angles is None:
+        angles = global_params.degrees if global_params.rotation_invariant_matching else [0]
+    images = []
+    labels = []
+    for label, target_template in enumerate(target_template_list):
+        for angle in angles:
+            images.append(rotate_image(target_template, angle))
+            labels.append(label)
+    return images, np.array(labels, dtype=np.int64)
+
+
+def find_matches_for_template(boxes,target_template, vectorstore, threshold=0.4):
     """
     Rotate the target_template by 90, 180, 270 degrees, and find matches for each rotation.
     Returns the union of all matches.
+
+    The rotations are embedded in one batch and searched with a single multi-query search, a box
+    matches when its smallest distance over the rotations is under the threshold.
     """
-    angles = [90, 180, 270]
-    all_matches = set()  # Using a set to automatically handle duplicates
-    
-    # Original
-    matches_indices = vectorstore.find_index(given_image=target_template, 
-                                             threshold=0.4)
-    all_matches.update(matches_indices)
-    
-    # Rotated versions
-    for angle in angles:
-        rotated_image = rotate_image(target_template, angle)
-        matches_indices = vectorstore.find_index(given_image=rotated_image, 
-                                                 threshold=0.4)
-        all_matches.update(matches_indices)
-    
+    images, _ = rotated_queries([target_template], angles=[0, 90, 180, 270])
+    d, I = vectorstore.find_index_batch(images)
+
+    # Minimum distance of each box over all the rotations
+    min_distances = np.full(vectorstore.index.ntotal, np.inf, dtype=np.float32)
+    valid = I >= 0
+    np.minimum.at(min_distances, I[valid], d[valid])
+
     refined_bounding_boxes = []
-    for idx in list(all_matches):
+    for idx in np.flatnonzero(min_distances < threshold):
         refined_bounding_boxes.append(boxes[idx])
 
     return refined_bounding_boxes
 
 
 async def filter_bounding_boxes2(boxes,full_image,target_template_list):
-    all_matches_indices_distance = []
-    aggregated_matches = []
-    threshold = 0.39
-
-    
-    imgs = []
-    for idx,bbox in enumerate(boxes):
-        try:
-            new_bbox = offset_bboxes(bbox,full_image,offset = 0)
-            (x1,y1), (x2,y2) = new_bbox
-            cropped_template = full_image[int(y1):int(y2), int(x1):int(x2)]  
-            imgs.append(cropped_template)
-        except:
-            pass 
-        
-    vectorstore = VectorStore(imgs=imgs, n_pca_components=10)
-
-    # Step 1: Aggregate Matches
-    for idx, target_template in enumerate(target_template_list):
-        # Assuming `vectorstore.find_index` returns a list of tuples (index, distance)
-        matches_indices = vectorstore.find_index(given_image=target_template, 
-                                                 threshold=threshold)
-        # Append matches with template identifier (idx here)
-        aggregated_matches.append((idx,)+matches_indices) # (template_idx, match_idx, distance)
-
-        
-        
-    # Create a dictionary to hold each index and its minimum distance and label
-    index_min_distance_simple = {}
-
-    # Go through each label, distance, and index array in the simplified data
-    for label, distances, indices in aggregated_matches:
-        for dist, idx in zip(distances, indices):
-            if idx not in index_min_distance_simple or dist < index_min_distance_simple[idx][0]:
-                if(dist < threshold):
-                    index_min_distance_simple[idx] = (dist, label)
-
-    # Rebuild the distance and index arrays for each label based on minimum distances for the simplified example
-    cleaned_matches_indices_distance = []
-    for label, _, _ in aggregated_matches:
-        new_distances = []
-        new_indices = []
-        for idx, (dist, assigned_label) in index_min_distance_simple.items():
-            if assigned_label == label:
-                new_distances.append(dist)
-                new_indices.append(idx)
-
-        # Sort the new distances and indices to maintain order
-        sorted_indices_distances = sorted(zip(new_indices, new_distances), key=lambda x: x[0])
-        sorted_indices, sorted_distances = zip(*sorted_indices_distances) if sorted_indices_distances else ([], [])
-        
-        cleaned_matches_indices_distance.append((label, np.array(sorted_distances), np.array(sorted_indices)))
-
-        refined_bounding_boxes_list = []
-        for idx in range(len(cleaned_matches_indices_distance)):
-            _, d, I = cleaned_matches_indices_distance[idx]
-            matched_indices = [I[i] for i, distance in enumerate(d)]
-            refined_bounding_boxes = []
-            for i in matched_indices:
-                refined_bounding_boxes.append(boxes[i])
-
-            refined_bounding_boxes_list.append(refined_bounding_boxes)
-
-
-        return refined_bounding_boxes_list
+    """
+    Matches all the templates at once, see `match_templates`, and returns the boxes of each template.
+    """
+    matched_boxes = await match_templates(boxes, full_image, target_template_list)
+    return [matched_boxes.of_symbol_type(i).to_tuples() for i in range(len(target_template_list))]
 
 
 
@@ -351,4 +275,115 @@ async def filter_bounding_boxes4(boxes,full_image,target_template):
 
 
 
-    return refined_bounding_boxes
\ No newline at end of file
+    return refined_bounding_boxes
+
+def crop_candidates(boxes,full_image,min_size=5):
+    """
+    Crop the candidate boxes out of the page, skipping the ones too small to be a symbol.
+
+    Returns the crops and the index in `boxes` of each crop.
+    """
+    if not isinstance(boxes, BoxSet):
+        boxes = BoxSet.from_tuples(boxes)
+    height, width = full_image.shape[:2]
+    clipped = boxes.clip(width, height)
+    img_indices = np.flatnonzero(clipped.area_mask(min_area=min_size, min_width=min_size, min_height=min_size))
+    imgs = [full_image[y1:y2, x1:x2] for x1, y1, x2, y2 in clipped.xyxy[img_indices].tolist()]
+    return imgs, img_indices
+
+
+def normalized_embeddings(imgs):
+    with metrics.timer("embedding"):
+        vectors = dino_backbone.embed(imgs, batch_size=global_params.dino_batch_size)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def assign_to_templates(candidate_vectors, query_vectors, query_labels, threshold):
+    """
+    Give every candidate the label of its nearest query, if it is closer than the threshold.
+
+    Parameters:
+    - candidate_vectors: np.ndarray, (N, D) normalized embeddings of the candidate boxes.
+    - query_vectors: np.ndarray, (Q, D) normalized embeddings of the queries (templates and their variants).
+    - query_labels: np.ndarray, (Q,) template index of each query.
+    - threshold: float, max squared L2 distance of a match.
+
+    Returns:
+    - np.ndarray: (N,) template index of each candidate, -1 when nothing is close enough.
+    - np.ndarray: (N,) distance to the nearest query.
+    """
+    labels = np.full(len(candidate_vectors), -1, dtype=np.int64)
+    if len(candidate_vectors) == 0 or len(query_vectors) == 0:
+        return labels, np.full(len(candidate_vectors), np.inf, dtype=np.float32)
+
+    # One search of all the candidates against all the queries
+    with metrics.timer("faiss_search"):
+        index = faiss.IndexFlatL2(query_vectors.shape[1])
+        index.add(query_vectors)
+        d, I = index.search(candidate_vectors, 1)
+    distances, nearest = d[:, 0], I[:, 0]
+    matched = distances < threshold
+    labels[matched] = np.asarray(query_labels)[nearest[matched]]
+    return labels, distances
+
+
+def expand_queries(candidate_vectors, query_vectors, query_labels, threshold, num_expansions=2):
+    """
+    Add the closest candidates of each query as extra queries of the same template.
+
+    Symbols in the plan look more like each other than like the legend crop, so querying with
+    the best plan matches finds the instances the legend crop alone misses.
+    """
+    if len(candidate_vectors) == 0 or len(query_vectors) == 0 or num_expansions == 0:
+        return query_vectors, query_labels
+    with metrics.timer("faiss_search"):
+        index = faiss.IndexFlatL2(candidate_vectors.shape[1])
+        index.add(candidate_vectors)
+        d, I = index.search(query_vectors, min(num_expansions, len(candidate_vectors)))
+    close = d < threshold
+    expansion_vectors = candidate_vectors[I[close]]
+    expansion_labels = np.repeat(np.asarray(query_labels)[:, None], d.shape[1], axis=1)[close]
+    return np.concatenate([query_vectors, expansion_vectors]), np.concatenate([query_labels, expansion_labels])
+
+
+def match_templates_sync(boxes,full_image,target_template_list):
+    """
+    Match all the legend symbols against the candidate boxes of a page at once.
+
+    The candidates are cropped and embedded once, all the templates are embedded in one batch,
+    then every box goes to its nearest template under `global_params.image_similarity_threshold`.
+    A box is assigned to at most one template. With `global_params.rotation_invariant_matching` the
+    templates are also queried rotated by `global_params.degrees`, a box is matched by its closest rotation.
+
+    Parameters:
+    - boxes: BoxSet, or list of ((x1, y1), (x2, y2)), candidate boxes in the page.
+    - full_image: np.ndarray, the page.
+    - target_template_list: List[np.ndarray], the legend symbols.
+
+    Returns:
+    - BoxSet: the candidates with the index of the template matched to each one in `symbol_types`, -1 when unmatched.
+    """
+    if not isinstance(boxes, BoxSet):
+        boxes = BoxSet.from_tuples(boxes)
+    threshold = global_params.image_similarity_threshold
+    symbol_types = np.full(len(boxes), -1, dtype=np.int32)
+    imgs, img_indices = crop_candidates(boxes, full_image)
+    if len(imgs) == 0 or len(target_template_list) == 0:
+        return boxes.replace(symbol_types=symbol_types)
+
+    candidate_vectors = normalized_embeddings(imgs)
+    # All the rotations of all the templates go through the model in one batch
+    query_images, query_labels = rotated_queries(target_template_list)
+    query_vectors = normalized_embeddings(query_images)
+    query_vectors, query_labels = expand_queries(candidate_vectors, query_vectors, query_labels, threshold)
+
+    labels, _ = assign_to_templates(candidate_vectors, query_vectors, query_labels, threshold)
+    symbol_types[img_indices] = labels
+    logger.debug(f"Matched {int((labels >= 0).sum())} out of {len(imgs)} candidates to {len(target_template_list)} templates")
+    return boxes.replace(symbol_types=symbol_types)
+
+
+async def match_templates(boxes,full_image,target_template_list):
+    with metrics.timer("template_matching"):
+        return await run_in_executor(match_templates_sync, boxes, full_image, target_template_list)
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from core.config import global_params, logger
+from core.metrics import metrics
+
+
+class EmbeddingCache():
+    """
+    Content-addressed cache of crop embeddings.
+
+    Embeddings are keyed by a hash of the resized crop pixels fed to the model, with their shape,
+    and the model id, so the same symbol gets the same key on every page and request.
+    The memory tier is an LRU bounded by `max_bytes`; when `disk_dir` is set, embeddings are also
+    written there as `.npy` files and survive restarts.
+    """
+
+    def __init__(self, model_id: str, max_bytes: int, disk_dir: Optional[str] = None):
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def make_key(self, image: np.ndarray) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(self.model_id.encode())
+        digest.update(str(image.shape).encode())
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector
+
+        if self.disk_dir is not None:
+            try:
+                vector = np.load(self._disk_path(key))
+            except (FileNotFoundError, ValueError, OSError):
+                vector = None
+            if vector is not None:
+                self._put_memory(key, vector)
+                with self._lock:
+                    self.disk_hits += 1
+                return vector
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        vector = np.array(vector, dtype=np.float32, copy=True)
+        self._put_memory(key, vector)
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                with open(tmp_path, "wb") as file:
+                    np.save(file, vector)
+                os.replace(tmp_path, path)
+            except OSError as ex:
+                logger.debug(f"Could not write embedding {key} to the disk cache: {ex}")
+
+    def _put_memory(self, key: str, vector: np.ndarray) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = vector
+            self._bytes += vector.nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+embedding_cache = EmbeddingCache(model_id=global_params.dino_model_id,
+                                 max_bytes=global_params.embedding_cache_max_bytes,
+                                 disk_dir=global_params.embedding_cache_dir)
+metrics.register_gauges("embedding_cache", embedding_cache.stats)
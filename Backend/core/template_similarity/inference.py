@@ -4,6 +4,7 @@ import cv2
 import onnx
 import os 
 from core.config import global_params, logger
+from core.onnx_sessions import session_registry
 import logging
 from fastapi import HTTPException
 
@@ -29,12 +30,87 @@ def preprocess_image(image):
     return image
 
 
+def preprocess_batch(images):
+    """
+    Resize images to the Siamese input size and stack them in one (N, 3, H, W) float32 tensor.
+    """
+    width, height = global_params.image_similarity_imgsize
+    batch = np.empty((len(images), 3, height, width), dtype=np.float32)
+    for i, image in enumerate(images):
+        np.multiply(cv2.resize(image, (width, height)).transpose(2, 0, 1), 1.0 / 255.0, out=batch[i], casting='unsafe')
+    return batch
+
+
+def pairwise_distance_matrix(vectors1, vectors2):
+    """
+    Euclidean distance between every row of vectors1 and every row of vectors2.
+
+    Returns:
+    np.ndarray: (len(vectors1), len(vectors2)) distances.
+    """
+    squared = (np.sum(vectors1 ** 2, axis=1)[:, None]
+               + np.sum(vectors2 ** 2, axis=1)[None, :]
+               - 2.0 * vectors1 @ vectors2.T)
+    return np.sqrt(np.maximum(squared, 0.0))
+
+
+class SiameseEmbedder():
+    """
+    Uses the Siamese network as an embedding model.
+
+    Both branches share their weights, so instead of running every candidate/template pair the
+    engine embeds each image once: a batch of images is split over the two inputs of the network
+    and both outputs are kept. Distances are then computed in numpy for all the pairs at once.
+    """
+
+    def __init__(self, weights_path, batch_size=64):
+        self.weights_path = weights_path
+        session = session_registry.get(weights_path)
+        self.input_names = [model_input.name for model_input in session.get_inputs()]
+        fixed_batch_size = session.get_inputs()[0].shape[0]
+        self.dynamic_batch = not isinstance(fixed_batch_size, int)
+        # Number of images given to each of the two inputs per run
+        self.branch_batch_size = max(1, batch_size // 2) if self.dynamic_batch else fixed_batch_size
+
+    def embed(self, images):
+        """
+        Embed a list of images.
+
+        Returns:
+        np.ndarray: (N, D) embeddings, in the order of the images.
+        """
+        embeddings = []
+        step = 2 * self.branch_batch_size
+        for start in range(0, len(images), step):
+            chunk = images[start:start + step]
+            size = self.branch_batch_size if not self.dynamic_batch else (len(chunk) + 1) // 2
+            batch = np.zeros((2 * size, 3) + tuple(global_params.image_similarity_imgsize[::-1]), dtype=np.float32)
+            batch[:len(chunk)] = preprocess_batch(chunk)
+            outputs = session_registry.run(self.weights_path, {self.input_names[0]: batch[:size],
+                                                               self.input_names[1]: batch[size:]})
+            embeddings.append(np.concatenate([outputs[0], outputs[1]])[:len(chunk)])
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(embeddings).astype(np.float32)
+
+
+_embedder = None
+
+
+def get_siamese_embedder():
+    global _embedder
+    if _embedder is None:
+        _embedder = SiameseEmbedder(global_params.image_similarity_weight_file,
+                                    batch_size=global_params.image_similarity_batch_size)
+    return _embedder
+
+
 def predict_similarity(input_data1, input_data2):
-    # Load the ONNX model
+    # The shared session of the model
     weights_path = global_params.image_similarity_weight_file
-    ort_session = ort.InferenceSession(weights_path)
-    outputs = ort_session.run(None, {'onnx::Pad_0': input_data1, 
-                                     'onnx::Pad_1': input_data2})
+    input_names = get_siamese_embedder().input_names
+    outputs = session_registry.run(weights_path, {input_names[0]: input_data1, 
+                                                  input_names[1]: input_data2})
     euclidean_distance = pairwise_distance_numpy(outputs[0], outputs[1])
     if(euclidean_distance < global_params.image_similarity_threshold):
         category = "Similar"
@@ -42,19 +118,34 @@ def predict_similarity(input_data1, input_data2):
         category = "Different"
     return category
 
-async def filter_bounding_boxes(boxes,full_image,target_template):
-    refined_bounding_boxes = []
-    input_data2 = preprocess_image(target_template) # Target template image 
-    for idx,bbox in enumerate(boxes):
-        try:
+
+async def filter_bounding_boxes_multi(boxes,full_image,target_templates):
+    """
+    Filter the candidate boxes against several templates at once.
+
+    Every crop and every template is embedded exactly once, the full candidates x templates
+    distance matrix is computed in numpy.
+
+    Returns:
+    List[List]: for each template, the boxes closer to it than `global_params.image_similarity_threshold`.
+    """
+    try:
+        crops = []
+        for bbox in boxes:
             (x1,y1), (x2,y2) = bbox
-            cropped_template = full_image[int(y1):int(y2), int(x1):int(x2)]  
-            input_data1 = preprocess_image(cropped_template)
-            predicted_category = predict_similarity(input_data2.astype(np.float32), 
-                                                    input_data1.astype(np.float32))
-            if(predicted_category=="Similar"):
-                refined_bounding_boxes.append(bbox)
-        except Exception as ex:
-            logging.exception("An error occurred while filtering the bboxes: %s", str(ex))
-            raise HTTPException(status_code=500, detail=f"An error occurred while filtering the bboxes: {ex}")
-    return refined_bounding_boxes
\ No newline at end of file
+            crops.append(full_image[int(y1):int(y2), int(x1):int(x2)])
+        embedder = get_siamese_embedder()
+        if len(crops) == 0 or len(target_templates) == 0:
+            return [[] for _ in target_templates]
+        distances = pairwise_distance_matrix(embedder.embed(crops), embedder.embed(list(target_templates)))
+        similar = distances < global_params.image_similarity_threshold
+        return [[boxes[i] for i in np.flatnonzero(similar[:, template_idx])]
+                for template_idx in range(len(target_templates))]
+    except Exception as ex:
+        logging.exception("An error occurred while filtering the bboxes: %s", str(ex))
+        raise HTTPException(status_code=500, detail=f"An error occurred while filtering the bboxes: {ex}")
+
+
+async def filter_bounding_boxes(boxes,full_image,target_template):
+    refined_bounding_boxes_list = await filter_bounding_boxes_multi(boxes, full_image, [target_template])
+    return refined_bounding_boxes_list[0]
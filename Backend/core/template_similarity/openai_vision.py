@@ -1,94 +1,206 @@
-import matplotlib
-matplotlib.use('Agg')  # Use the Agg backend for non-interactive plotting
-
 import numpy as np
-import cv2 
-import onnx
-import os 
-import matplotlib.pyplot as plt 
+import cv2
+import os
 import base64
-from io import BytesIO
+import hashlib
+import json
+import math
+import re
+from collections import OrderedDict
+from typing import List, Optional
 from core.config import global_params, logger, settings
+from core.image_encoding import image_encoder
+from core.debug_artifacts import debug_artifacts
 import logging
-import openai 
-import requests
-from concurrent.futures import ThreadPoolExecutor
-import time 
+import httpx
+import time
 import asyncio
 
-logger_active = logger.isEnabledFor(logging.DEBUG)
-
-
-async def call_openai_vision(base64_image: bytes):
-    headers = {
-    "Content-Type": "application/json",
-    "Authorization": f"Bearer {settings.openai_key}"
-    }
-
-    payload = {
-    "model": "gpt-4-vision-preview",
-    "messages": [
-        {
-            "role": "system",
-        "content": [
-            {
-            "type": "text",
-            "text": """
-You are provided with the an image. You have to carefully analyse the image and provide detailed analysis of the image. Make responsible assumptions about the image. 
+
+
+SYSTEM_PROMPT = """
+You are provided with the an image. You have to carefully analyse the image and provide detailed analysis of the image. Make responsible assumptions about the image.
 """
-            },
-        ]            
-        },
-        {
-        "role": "user",
-        "content": [
-            {
-            "type": "text",
-            "text": """
-There are two symbols shown in the image labelled (a) and (b). You have to carefully analyse the two symbols and provide aetailed anaylysis of the two symbols. They might of different size. The images might be rotated, scaled and consider it while making a decision. Start the analysis by answering are the two symbols same (Yes/No) ? 
+
+PAIR_PROMPT = """
+There are two symbols shown in the image labelled (a) and (b). You have to carefully analyse the two symbols and provide aetailed anaylysis of the two symbols. They might of different size. The images might be rotated, scaled and consider it while making a decision. Start the analysis by answering are the two symbols same (Yes/No) ?
+"""
+
+MONTAGE_PROMPT = """
+The image is a grid of symbols. The cell labelled T is the reference symbol, the other cells are candidates numbered 1 to {count}. The candidates might be rotated or scaled. Find the candidates that show the same symbol as T. Answer only with JSON in the form {{"matches": [<numbers of the matching candidates>]}}, use an empty list if none match.
 """
-            },
-            {
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/jpeg;base64,{base64_image}", 
-                "detail": "high"
-
-            },
-            }
-        ]
+
+
+class VisionVerifier():
+    """
+    Asynchronous client of the OpenAI chat completions API used to verify symbol crops.
+
+    - One pooled `httpx.AsyncClient` is shared by all the calls of an event loop.
+    - A semaphore bounds the number of requests in flight.
+    - Rate limits, server errors and timeouts are retried with exponential backoff.
+    - Answers are cached by the hash of the image sent, the same crop pair is only asked once.
+
+    The base url comes from `global_params.openai_base_url`, point it to a local stub
+    (see `benchmarks/openai_stub.py`) to run without the real API.
+    """
+
+    def __init__(self, base_url: str, api_key: str, model: str,
+                 max_concurrency: int = 20, max_retries: int = 3,
+                 timeout: float = 60.0, cache_size: int = 4096):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._clients = {}
+        self._semaphores = {}
+        self.requests_sent = 0
+        self.retries = 0
+        self.cache_hits = 0
+
+    def _client(self) -> httpx.AsyncClient:
+        # Clients and semaphores are bound to the event loop they are created in
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(base_url=self.base_url,
+                                       timeout=self.timeout,
+                                       limits=httpx.Limits(max_connections=self.max_concurrency,
+                                                           max_keepalive_connections=self.max_concurrency))
+            self._clients[loop] = client
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return client
+
+    async def aclose(self) -> None:
+        loop = asyncio.get_running_loop()
+        client = self._clients.pop(loop, None)
+        self._semaphores.pop(loop, None)
+        if client is not None:
+            await client.aclose()
+
+    def _payload(self, base64_image: str, prompt: str, max_tokens: int) -> dict:
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": [{"type": "text", "text": SYSTEM_PROMPT}]},
+                {"role": "user", "content": [
+                    {"type": "text", "text": prompt},
+                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{base64_image}",
+                                                        "detail": "high"}},
+                ]},
+            ],
+            "max_tokens": max_tokens,
         }
-    ],
-    "max_tokens": 20
-    }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload).json()
-    analysis_of_image = response["choices"][0]["message"]["content"]
-    return analysis_of_image
+    async def ask(self, base64_image: str, prompt: str = PAIR_PROMPT, max_tokens: int = 20,
+                  refresh: bool = False) -> str:
+        """
+        Ask a question about an image, returns the text of the answer.
+
+        `refresh` skips the cached answer, e.g. to ask again after a refusal.
+        """
+        cache_key = hashlib.sha1(f"{self.model}|{max_tokens}|{prompt}|{base64_image}".encode()).hexdigest()
+        if not refresh and cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            self.cache_hits += 1
+            return self._cache[cache_key]
+
+        client = self._client()
+        semaphore = self._semaphores[asyncio.get_running_loop()]
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        payload = self._payload(base64_image, prompt, max_tokens)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with semaphore:
+                    self.requests_sent += 1
+                    response = await client.post("/chat/completions", headers=headers, json=payload)
+            except httpx.TransportError as ex:
+                error = ex
+            else:
+                # Only rate limits and server errors are worth retrying
+                if response.status_code != 429 and response.status_code < 500:
+                    response.raise_for_status()
+                    answer = response.json()["choices"][0]["message"]["content"]
+                    break
+                error = httpx.HTTPStatusError(f"Got status {response.status_code}",
+                                              request=response.request, response=response)
+            if attempt == self.max_retries:
+                raise error
+            self.retries += 1
+            delay = min(0.5 * 2 ** attempt, 8.0)
+            logger.debug(f"Vision request failed ({error}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+        self._cache[cache_key] = answer
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return answer
+
+    def stats(self) -> dict:
+        return {
+            "requests_sent": self.requests_sent,
+            "retries": self.retries,
+            "cache_hits": self.cache_hits,
+            "cache_entries": len(self._cache),
+        }
+
+
+vision_verifier = VisionVerifier(base_url=global_params.openai_base_url,
+                                 api_key=settings.openai_api_key,
+                                 model=global_params.openai_vision_model,
+                                 max_concurrency=global_params.openai_max_concurrency,
+                                 max_retries=global_params.openai_max_retries,
+                                 timeout=global_params.openai_timeout)
 
-async def images_to_base64(img1,img2):
-    # Plot the images side by side
-    fig, axs = plt.subplots(1, 2, figsize=(2, 1))
-    axs[0].imshow(img1, cmap='gray')
-    axs[0].axis('off')  # Remove axis
-    axs[0].set_title('(a)',fontsize=4)
 
-    axs[1].imshow(img2, cmap='gray')
-    axs[1].axis('off')  # Remove axis
-    axs[1].set_title('(b)',fontsize=4)
+async def call_openai_vision(base64_image: str, refresh: bool = False):
+    return await vision_verifier.ask(base64_image, refresh=refresh)
 
-    plt.tight_layout()
-    if(logger_active):
-        plt.savefig("temp/openai_input.png", bbox_inches="tight")
-    buf = BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
 
-    # Convert PNG byte array to base64 string
-    b64_string = base64.b64encode(buf.read()).decode('utf-8')
+def fit_in_square(img, size):
+    """
+    Resize an image to fit a white size x size square, keeping its aspect ratio.
+    """
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+    img = np.ascontiguousarray(img[:, :, :3])
+    height, width = img.shape[:2]
+    scale = size / max(height, width, 1)
+    resized = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))))
+    square = np.full((size, size, 3), 255, dtype=np.uint8)
+    top, left = (size - resized.shape[0]) // 2, (size - resized.shape[1]) // 2
+    square[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return square
 
-    plt.close(fig)
-    return b64_string
+
+def label_cell(cell, label, label_height=24):
+    """
+    Put a text label above an image cell.
+    """
+    canvas = np.full((cell.shape[0] + label_height, cell.shape[1], 3), 255, dtype=np.uint8)
+    canvas[label_height:] = cell
+    cv2.putText(canvas, label, (4, label_height - 6), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 1, cv2.LINE_AA)
+    return canvas
+
+
+def compose_pair_image(img1, img2, cell_size=128, gap=16):
+    """
+    Put two RGB images side by side, labelled (a) and (b), with numpy and cv2.
+    """
+    spacer = np.full((cell_size + 24, gap, 3), 255, dtype=np.uint8)
+    return np.hstack([label_cell(fit_in_square(img1, cell_size), "(a)"),
+                      spacer,
+                      label_cell(fit_in_square(img2, cell_size), "(b)")])
+
+
+async def images_to_base64(img1,img2):
+    pair_image = cv2.cvtColor(compose_pair_image(img1, img2), cv2.COLOR_RGB2BGR)
+    debug_artifacts.write_image(f"{global_params.temp_dir}/openai_input.png", pair_image)
+    return image_encoder.encode_base64(pair_image, image_format="png")
 
 
 
@@ -96,13 +208,13 @@ async def filter_bounding_boxes(bbox,full_image,target_template):
     refined_bbox = None
     try:
         (x1,y1), (x2,y2) = bbox
-        cropped_template = full_image[int(y1):int(y2), int(x1):int(x2)]  
-        b64_string = await images_to_base64(target_template, 
+        cropped_template = full_image[int(y1):int(y2), int(x1):int(x2)]
+        b64_string = await images_to_base64(target_template,
                                         cropped_template)
-        
+
         analysis_of_image = await call_openai_vision(base64_image=b64_string)
-        if("Sorry" in analysis_of_image): 
-            analysis_of_image = await call_openai_vision(base64_image=b64_string)
+        if("Sorry" in analysis_of_image):
+            analysis_of_image = await call_openai_vision(base64_image=b64_string, refresh=True)
         analysis_of_image = analysis_of_image.replace("\n\n","\n")
         logger.info(f"Image Analysis: {analysis_of_image}" )
         if ("yes" in analysis_of_image.lower() ):
@@ -111,39 +223,120 @@ async def filter_bounding_boxes(bbox,full_image,target_template):
         logger.info(f"Could not process bbox , got error {e}")
     return refined_bbox
 
-def process_section_sync(idx,bbox, full_image,template_np_image):
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    # Call the async function from the synchronous function
-    refined_bbox = loop.run_until_complete(
-        filter_bounding_boxes(
-            bbox=bbox, 
-            full_image = full_image, 
-            target_template=template_np_image
-        )
-    )
-    return refined_bbox
+
+def compose_montage(template, crops, cell_size=128, gap=8):
+    """
+    Tile a template and numbered candidate crops into one grid image.
+
+    The template comes first, labelled T, followed by the crops labelled 1 to len(crops).
+    """
+    cells = [label_cell(fit_in_square(template, cell_size), "T")]
+    cells += [label_cell(fit_in_square(crop, cell_size), str(i + 1)) for i, crop in enumerate(crops)]
+    columns = math.ceil(math.sqrt(len(cells)))
+    rows = math.ceil(len(cells) / columns)
+    cell_height, cell_width = cells[0].shape[:2]
+    montage = np.full((rows * (cell_height + gap) - gap, columns * (cell_width + gap) - gap, 3), 255, dtype=np.uint8)
+    for i, cell in enumerate(cells):
+        top, left = (i // columns) * (cell_height + gap), (i % columns) * (cell_width + gap)
+        montage[top:top + cell_height, left:left + cell_width] = cell
+    # Thin grid lines keep neighbouring symbols apart
+    for row in range(1, rows):
+        top = row * (cell_height + gap) - gap // 2
+        montage[top, :] = 160
+    for column in range(1, columns):
+        left = column * (cell_width + gap) - gap // 2
+        montage[:, left] = 160
+    return montage
+
+
+def parse_match_indices(answer: str, count: int) -> Optional[List[int]]:
+    """
+    Read the candidate numbers out of a montage answer.
+
+    Parameters:
+    - answer: str, text of the answer, expected to hold {"matches": [...]}.
+    - count: int, number of candidates in the montage.
+
+    Returns:
+    - List[int]: zero based indices of the matching candidates, None if the answer can not be read.
+    """
+    numbers = None
+    match = re.search(r"\{.*\}", answer, re.DOTALL)
+    if match:
+        try:
+            numbers = json.loads(match.group(0)).get("matches")
+        except (ValueError, AttributeError):
+            numbers = None
+    if numbers is None:
+        match = re.search(r"\[([\d,\s]*)\]", answer)
+        if match is None:
+            return None
+        numbers = [int(number) for number in re.findall(r"\d+", match.group(1))]
+    if not isinstance(numbers, list):
+        return None
+    indices = []
+    for number in numbers:
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            continue
+        if 1 <= number <= count and number - 1 not in indices:
+            indices.append(number - 1)
+    return sorted(indices)
+
+
+async def filter_bounding_boxes_montage(boxes, full_image, target_template):
+    """
+    Verify a chunk of boxes with a single request, the template and the crops tiled in one montage.
+
+    Returns the verified boxes. If the answer can not be read the boxes are verified one by one.
+    """
+    crops = [full_image[int(y1):int(y2), int(x1):int(x2)] for (x1, y1), (x2, y2) in boxes]
+    montage = cv2.cvtColor(compose_montage(target_template, crops), cv2.COLOR_RGB2BGR)
+    debug_artifacts.write_image(f"{global_params.temp_dir}/openai_montage_input.png", montage)
+    b64_string = image_encoder.encode_base64(montage, image_format="png")
+
+    indices = None
+    try:
+        answer = await vision_verifier.ask(b64_string,
+                                           prompt=MONTAGE_PROMPT.format(count=len(boxes)),
+                                           max_tokens=global_params.openai_montage_max_tokens)
+        logger.info(f"Montage Analysis: {answer}")
+        indices = parse_match_indices(answer, len(boxes))
+    except Exception as e:
+        logger.info(f"Could not process montage of {len(boxes)} boxes, got error {e}")
+    if indices is None:
+        logger.info(f"Could not read the montage answer, verifying {len(boxes)} boxes one by one")
+        results = await asyncio.gather(*[filter_bounding_boxes(bbox=bbox,
+                                                               full_image=full_image,
+                                                               target_template=target_template)
+                                         for bbox in boxes])
+        return [bbox for bbox in results if bbox]
+    return [boxes[i] for i in indices]
 
 
 async def filter_bounding_parallel(boxes,full_image,target_template):
+    """
+    Verify all the boxes concurrently, the verifier bounds the number of requests in flight.
+
+    With `global_params.openai_montage_size` above 1, boxes are verified by chunks of that
+    size, one montage request per chunk, instead of one request per box.
+    """
+    montage_size = global_params.openai_montage_size
+    if montage_size > 1:
+        chunks = [boxes[start:start + montage_size] for start in range(0, len(boxes), montage_size)]
+        results = await asyncio.gather(*[filter_bounding_boxes_montage(boxes=chunk,
+                                                                       full_image=full_image,
+                                                                       target_template=target_template)
+                                         for chunk in chunks])
+        return [bbox for verified in results for bbox in verified]
+
     refined_bounding_boxes = []
-    max_workers = 20
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        loop = asyncio.get_event_loop()
-        tasks = [
-            loop.run_in_executor(
-                executor, 
-                process_section_sync,
-                idx,  
-                bbox, 
-                full_image,
-                target_template
-            )
-            for idx,bbox in enumerate(boxes)
-        ]
-        results = await asyncio.gather(*tasks)
-        for idx, (refined_bbox) in enumerate(results):
-            if(refined_bbox):
-                refined_bounding_boxes.append(refined_bbox)
-    return refined_bounding_boxes
\ No newline at end of file
+    results = await asyncio.gather(*[filter_bounding_boxes(bbox=bbox,
+                                                           full_image=full_image,
+                                                           target_template=target_template)
+                                     for bbox in boxes])
+    for idx, (refined_bbox) in enumerate(results):
+        if(refined_bbox):
+            refined_bounding_boxes.append(refined_bbox)
+    return refined_bounding_boxes
@@ -2,6 +2,12 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from api.routes import router as api_router
 from fastapi.staticfiles import StaticFiles
+from core.config import global_params
+from core.onnx_sessions import session_registry
+from core.detection.batch_inference import get_symbol_detection_engine, shutdown_symbol_detection_engine
+from core.template_similarity.dino_model import dino_backbone
+from core.jobs import get_job_backend
+from core.debug_artifacts import debug_artifacts
 import os 
 
 app = FastAPI()
@@ -29,4 +35,35 @@ app.add_middleware(
     allow_headers=["*", "secret"]  # Explicitly list 'secret'
 )
 
-app.include_router(api_router)
\ No newline at end of file
+app.include_router(api_router)
+
+
+@app.on_event("startup")
+def preload_models():
+    if global_params.preload_onnx_models:
+        session_registry.preload([global_params.legend_yolo_model_path,
+                                  global_params.symbol_yolo_model_path])
+        if global_params.detection_engine == "process_pool":
+            get_symbol_detection_engine().warm_up()
+    if global_params.preload_dino_model:
+        dino_backbone.model
+
+
+@app.on_event("startup")
+async def start_job_backend():
+    await get_job_backend().start()
+
+
+@app.on_event("shutdown")
+async def stop_job_backend():
+    await get_job_backend().stop()
+
+
+@app.on_event("shutdown")
+def stop_detection_workers():
+    shutdown_symbol_detection_engine()
+
+
+@app.on_event("shutdown")
+def flush_debug_artifacts():
+    debug_artifacts.flush()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Optional
 
 
 
@@ -64,7 +64,8 @@ class ProcessPDFTemplateAreaDetectionResponse(BaseModel):
 
 
 class LegendTemplateResponse2(BaseModel):
-    mask_base64: str
+    mask_base64: str = ""  # PNG of the crop, only filled when the crops are asked inline, see crop_url
+    crop_url: Optional[str] = None  # Path of the PNG of the crop in the artifact store
     bbox : List[Tuple[int,int,int,int]]
     score : float
     point_coord: List[Tuple[int, int]]
@@ -103,4 +104,30 @@ class ProcessPDFTemplateMatchingResponse2(BaseModel):
     """
     template_response: List[LegendTemplateResponse2]
     processing_time: float  # Total time taken for processing in minutes
-
+    sections_total: int = 0  # Number of sections the page was split into
+    sections_skipped: int = 0  # Blank sections which were not sent to the symbol detector
+    artifact_id: Optional[str] = None  # Id of the images of this plan in the artifact store
+    page_url: Optional[str] = None  # Path of the PNG of the page
+    annotated_page_url: Optional[str] = None  # Path of the PNG of the page with the matched symbols drawn
+    timings: Optional[Dict[str, float]] = None  # Seconds spent per stage, only with include=timings
+
+
+
+class JobProgress(BaseModel):
+    stage: str  # queued, render, legend_detection, symbol_detection, template_matching, response or done
+    tiles_detected: int = 0  # Sections of the page already through the symbol detector, blank ones included
+    tiles_total: int = 0
+    legend_symbols: int = 0  # Symbols detected in the legend
+    templates_matched: int = 0  # Legend symbols whose matches are in the response
+    templates_total: int = 0
+    updated_at: float
+
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, succeeded, failed or cancelled
+    progress: JobProgress
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
@@ -0,0 +1,25 @@
+import threading
+
+from core.metrics import MetricsRegistry
+
+
+def test_snapshot_with_registered_gauges():
+    registry = MetricsRegistry()
+    registry.register_gauges("cache", lambda: {"hits": 3, "enabled": True, "name": "page", "disk": {"bytes": 10}})
+    registry.inc("plans")
+
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(registry.snapshot()), daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive(), "snapshot() deadlocked"
+    assert result["gauges"] == {"cache": {"hits": 3, "enabled": 1, "disk_bytes": 10}}
+    assert result["counters"] == {"plans": 1}
+
+
+def test_render_prometheus_includes_gauges():
+    registry = MetricsRegistry()
+    registry.register_gauges("cache", lambda: {"hits": 3})
+
+    assert 'pipeline_component_value{component="cache",name="hits"} 3' in registry.render_prometheus()